@@ -0,0 +1,256 @@
+'''
+Execution of services on a single asyncio event loop, waiting for converters
+without holding a thread for each of them.
+'''
+
+
+import os
+import time
+import shlex
+import signal
+import asyncio
+import logging
+import functools
+import threading
+from concurrent import futures
+
+import tracing
+import pipeline
+import scheduler
+
+
+from typing import (
+    List,
+    Union,
+)
+
+
+async def execute_converter(binary: str, *arguments: list, timeout: float = None) -> bool:
+    ''' Check the converter exit code of service binary. The converter and
+        everything it started are killed when the wait is cancelled or takes
+        longer than timeout seconds. '''
+
+    command = shlex.split(binary) + list(arguments)
+    logging.debug('starting conversion: %s', arguments[0])
+    process = await asyncio.create_subprocess_exec(*command, start_new_session=True)
+    try:
+        with tracing.span('converter', 'convert', path=arguments[0]):
+            returncode = await asyncio.wait_for(process.wait(), timeout)
+    except asyncio.TimeoutError as error:
+        raise pipeline.JobTimeout(f'{arguments[0]} timed out after {timeout:.0f}s') from error
+    finally:
+        if process.returncode is None:
+            logging.debug('killing conversion: %s', arguments[0])
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            await process.wait()
+
+    if returncode < 0:
+        raise pipeline.TransientError(f'converter killed by signal {-returncode}')
+    return returncode == 0
+
+
+class AsyncSlotScheduler(scheduler.SlotScheduler):
+    ''' Slot scheduler whose workers are tasks of the running event loop, so
+        jobs are coroutines and many of them wait at almost no cost '''
+
+    def start(self) -> None:
+        ''' Start the worker tasks on the running loop '''
+
+        self._cond = asyncio.Condition()
+        self._workers = [asyncio.create_task(self._work(), name=f'converter-{number}')
+                         for number in range(self.threads)]
+
+    async def submit(self, job: scheduler.Job) -> None:
+        ''' Queue a job, waiting while the queue is full '''
+
+        async with self._cond:
+            await self._cond.wait_for(self._has_room)
+            self._push(job)
+            self._cond.notify_all()
+
+    async def _take(self) -> Union[None, scheduler.Job]:
+        async with self._cond:
+            while True:
+                job = self._pick()
+                if job is not None:
+                    self._account(job)
+                    self._cond.notify_all()
+                    return job
+
+                if self._closed and not self._pending:
+                    return None
+                await self._cond.wait()
+
+    async def _release(self, job: scheduler.Job) -> None:
+        async with self._cond:
+            self._unaccount(job)
+            self._cond.notify_all()
+
+    async def _work(self) -> None:
+        while True:
+            job = await self._take()
+            if job is None:
+                return
+
+            logging.debug('running %s using %d of %d', job, self.used, self.budget)
+            tracing.complete('queued', 'wait', job.created, service=job.service)
+            try:
+                await job.func(*job.args)
+            finally:
+                await self._release(job)
+
+    async def close(self) -> None:
+        ''' Let the workers finish the queued jobs and wait for them '''
+
+        async with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        await asyncio.gather(*self._workers)
+
+    def cancel(self) -> None:
+        ''' Stop the workers right away, killing running converters '''
+
+        for task in self._workers:
+            task.cancel()
+
+
+class AsyncPipeline(pipeline.Pipeline):
+    ''' Pipeline running conversions as tasks of one event loop.
+
+        Services with an async worker wait for their converter on the loop,
+        the others run on a pool of threads. The walk, archive extraction and
+        the services without a weight stay on their own threads, as they are
+        made of blocking file operations, and hand files to the loop. A job
+        taking longer than timeout seconds is cancelled and fails, which only
+        stops async workers. '''
+
+    scheduler_class = AsyncSlotScheduler
+
+    def __init__(self, *args, timeout: float = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timeout = timeout
+        self._loop: asyncio.AbstractEventLoop = None
+        self._executor: futures.ThreadPoolExecutor = None
+
+    def _job(self, service: str, paths: List[str], cost: float,
+             batch: bool = False) -> scheduler.Job:
+        weight = self.service_options[service]['weight']
+        return scheduler.Job(service, weight, self.process_async, service, paths, batch,
+                             cost=cost, rank=self._rank(service, paths))
+
+    def _part_job(self, service: str, path: str, options: dict,
+                  cost: float) -> scheduler.Job:
+        return scheduler.Job(service, options['weight'], self.process_part_async, service,
+                             path, options, cost=cost, rank=self._rank(service, [path]))
+
+    async def process_part_async(self, service: str, path: str, options: dict) -> bool:
+        ''' Run the worker of options on a part of a file on a thread '''
+
+        return await self._in_thread(self.process_part, service, path, options)
+
+    def _submit(self, job: scheduler.Job) -> None:
+        # files are always dispatched from the walk or worker threads
+        asyncio.run_coroutine_threadsafe(self.scheduler.submit(job), self._loop).result()
+
+    def _in_thread(self, func: callable, *args) -> asyncio.Future:
+        return self._loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    def _share(self, service: str, source: str, paths: List[str]) -> None:
+        # outputs are copied with blocking file operations
+        self._in_thread(super()._share, service, source, paths)
+
+    async def process_async(self, service: str, paths: List[str],
+                            batch: bool = False) -> List[bool]:
+        ''' Run the service worker on paths keeping track of the outcome of
+            each one '''
+
+        options = self.service_options[service]
+        if batch:
+            call = self._in_thread(options['batch_worker'], paths, options)
+        elif options['aio_worker'] is not None:
+            call = options['aio_worker'](paths[0], options)
+        else:
+            call = self._in_thread(options['worker'], paths[0], options)
+
+        self._started(service, paths)
+        results, error = [False] * len(paths), None
+        start = time.perf_counter()
+        try:
+            with tracing.span(service, 'run', paths=paths):
+                outcome = await asyncio.wait_for(call, self.timeout)
+            results = list(outcome) if batch else [outcome]
+        except asyncio.TimeoutError:
+            error = pipeline.JobTimeout(f'timed out after {self.timeout}s')
+        except Exception as exception:  # pylint: disable=broad-except
+            error = exception
+
+        self._conclude(service, paths, batch, results, error,
+                       elapsed=time.perf_counter() - start)
+        return results
+
+    def _walk(self, directory: str, walked: asyncio.Future) -> None:
+        def settle(error: BaseException = None):
+            if walked.done():
+                return
+            if error is None:
+                walked.set_result(None)
+            else:
+                walked.set_exception(error)
+
+        try:
+            self.index.walk(directory)
+            logging.debug('walk done, waiting for pending files')
+            self._drain()
+        except BaseException as error:  # pylint: disable=broad-except
+            outcome = error
+        else:
+            outcome = None
+
+        try:
+            self._loop.call_soon_threadsafe(settle, outcome)
+        except RuntimeError:
+            logging.debug('event loop closed before the walk was over')
+
+    async def run_async(self, directory: str) -> dict:
+        ''' Walk directory processing files while they are found, on the
+            running event loop '''
+
+        self._loop = asyncio.get_running_loop()
+        self._executor = futures.ThreadPoolExecutor(max_workers=self.scheduler.threads,
+                                                    thread_name_prefix='converter')
+        workers = self._start_workers()
+        self.scheduler.start()
+        self.started = time.perf_counter()
+
+        # a daemon thread does not hold the interpreter when cancelled
+        walked = self._loop.create_future()
+        walker = threading.Thread(target=self._walk,
+                                  args=(directory, walked),
+                                  name='walk',
+                                  daemon=True)
+        self.walking = True
+        try:
+            walker.start()
+            await walked
+            await self.scheduler.close()
+        except BaseException:
+            self.scheduler.cancel()
+            raise
+        finally:
+            self.walking = False
+            for service, _ in workers:
+                self._queues[service].put(pipeline.STOP)
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+        for _, thread in workers:
+            thread.join()
+        return self.summary()
+
+    def run(self, directory: str) -> dict:
+        ''' Walk directory processing files while they are found. Return the
+            number of files and the failed ones for each service. '''
+
+        return asyncio.run(self.run_async(directory))
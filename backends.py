@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+'''
+Converter backends kept alive between jobs, taking them over a framed
+protocol on their standard input and output.
+
+Each frame is a 4 bytes big endian length followed by as many bytes of
+UTF-8 JSON. The client sends {"args": [...]}, the same arguments a one-shot
+converter gets on its command line, and the worker answers {"ok": bool}
+with an optional "error" message, one job at a time.
+
+Run as a script, this module is a reference worker converting files by
+copying them, meant for tests:
+
+    backends.py --pdf    # like qvm-convert-pdf FILE...
+    backends.py --img    # like qvm-convert-img SOURCE DEST
+'''
+
+
+import os
+import sys
+import json
+import time
+import queue
+import shlex
+import atexit
+import select
+import shutil
+import signal
+import struct
+import logging
+import threading
+import subprocess
+
+import pipeline
+
+
+from typing import (
+    Dict,
+    List,
+    Union,
+)
+
+
+BACKENDS = ('spawn', 'persistent')
+
+HEADER = struct.Struct('>I')
+
+# frames larger than this are taken as a broken stream
+MAX_FRAME = 16 * 1024 * 1024
+
+
+class ProtocolError(pipeline.TransientError):
+    ''' Raised when a worker breaks the protocol or goes away mid job '''
+
+
+def write_frame(writer, message: dict) -> None:
+    ''' Send message as a single frame '''
+
+    payload = json.dumps(message).encode()
+    writer.write(HEADER.pack(len(payload)) + payload)
+    writer.flush()
+
+
+def read_frame(reader) -> Union[dict, None]:
+    ''' Receive the next message, None once the stream is closed '''
+
+    header = reader.read(HEADER.size)
+    if not header:
+        return None
+    if len(header) < HEADER.size:
+        raise ProtocolError('stream closed inside a frame header')
+
+    length, = HEADER.unpack(header)
+    if length > MAX_FRAME:
+        raise ProtocolError(f'frame of {length} bytes is too large')
+    payload = reader.read(length)
+    if len(payload) < length:
+        raise ProtocolError('stream closed inside a frame')
+    return json.loads(payload)
+
+
+class WorkerProcess:
+    ''' A converter process taking jobs one after another '''
+
+    def __init__(self, command: str):
+        self.command = command
+        self.jobs = 0
+        # unbuffered, so waiting on the pipe sees every byte
+        self.process = subprocess.Popen(shlex.split(command),
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        bufsize=0,
+                                        start_new_session=True)
+        logging.debug('started converter worker %d: %s', self.process.pid, command)
+
+    def alive(self) -> bool:
+        ''' Tell whether the worker may take another job '''
+
+        return self.process.poll() is None
+
+    def _read(self, count: int, deadline: Union[float, None]) -> bytes:
+        data = b''
+        while len(data) < count:
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select([self.process.stdout], [], [],
+                                                       remaining)[0]:
+                    raise pipeline.JobTimeout(f'worker {self.process.pid} timed out')
+
+            chunk = os.read(self.process.stdout.fileno(), count - len(data))
+            if not chunk:
+                raise ProtocolError(f'worker {self.process.pid} exited with '
+                                    f'{self.process.wait()}')
+            data += chunk
+        return data
+
+    def request(self, arguments: List[str], timeout: float = None) -> dict:
+        ''' Send a job and wait up to timeout seconds for its answer '''
+
+        deadline = time.monotonic() + timeout if timeout else None
+        try:
+            write_frame(self.process.stdin, {'args': arguments})
+        except BrokenPipeError as error:
+            raise ProtocolError(f'worker {self.process.pid} is gone') from error
+
+        length, = HEADER.unpack(self._read(HEADER.size, deadline))
+        if length > MAX_FRAME:
+            raise ProtocolError(f'frame of {length} bytes is too large')
+        self.jobs += 1
+        return json.loads(self._read(length, deadline))
+
+    def stop(self, kill: bool = False) -> None:
+        ''' Let the worker finish by closing its input, or kill it '''
+
+        if self.alive() and not kill:
+            self.process.stdin.close()
+            try:
+                self.process.wait(5)
+            except subprocess.TimeoutExpired:
+                kill = True
+
+        if kill and self.alive():
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        self.process.wait()
+        for stream in (self.process.stdin, self.process.stdout):
+            if not stream.closed:
+                stream.close()
+
+
+class PersistentBackend:
+    ''' Run conversions on up to processes long lived workers started from
+        command. Workers are started when first needed, and one that timed
+        out, broke the protocol or exited is replaced on the next job. '''
+
+    def __init__(self, command: str, processes: int = 2):
+        self.command = command
+        self.processes = processes
+        self.started = 0
+        self._idle = queue.LifoQueue()
+        self._slots = threading.Semaphore(processes)
+        self._lock = threading.Lock()
+        self._workers: List[WorkerProcess] = []
+
+    def _take(self) -> WorkerProcess:
+        self._slots.acquire()
+        try:
+            worker = self._idle.get_nowait()
+            if worker.alive():
+                return worker
+            self._discard(worker)
+        except queue.Empty:
+            pass
+
+        try:
+            worker = WorkerProcess(self.command)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.started += 1
+            self._workers.append(worker)
+        return worker
+
+    def _discard(self, worker: WorkerProcess) -> None:
+        worker.stop(kill=True)
+        with self._lock:
+            if worker in self._workers:
+                self._workers.remove(worker)
+
+    def _give_back(self, worker: WorkerProcess, healthy: bool) -> None:
+        if healthy:
+            self._idle.put(worker)
+        else:
+            self._discard(worker)
+        self._slots.release()
+
+    def convert(self, arguments: List[str], timeout: float = None) -> bool:
+        ''' Have a worker convert arguments, telling whether it succeeded '''
+
+        worker = self._take()
+        healthy = False
+        try:
+            reply = worker.request(arguments, timeout=timeout)
+            healthy = True
+        finally:
+            self._give_back(worker, healthy)
+
+        if reply.get('error'):
+            logging.warning('converter worker failed on %s: %s', arguments[0], reply['error'])
+        return bool(reply.get('ok'))
+
+    def close(self) -> None:
+        ''' Stop every worker '''
+
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.stop()
+
+
+_backends: Dict[tuple, PersistentBackend] = {}
+_backends_lock = threading.Lock()
+
+
+def open_backend(command: str, processes: int = 2) -> PersistentBackend:
+    ''' Return the persistent backend running command, shared by every caller '''
+
+    with _backends_lock:
+        backend = _backends.get((command, processes))
+        if backend is None:
+            backend = _backends[(command, processes)] = PersistentBackend(command, processes)
+        return backend
+
+
+@atexit.register
+def close_backends() -> None:
+    ''' Stop the workers of every persistent backend '''
+
+    with _backends_lock:
+        backends = list(_backends.values())
+        _backends.clear()
+    for backend in backends:
+        backend.close()
+
+
+def serve(convert: callable, reader=None, writer=None) -> None:
+    ''' Answer the jobs read from reader calling convert with their
+        arguments, until reader is closed. Meant for worker programs. '''
+
+    reader = reader or sys.stdin.buffer
+    writer = writer or sys.stdout.buffer
+    while True:
+        request = read_frame(reader)
+        if request is None:
+            return
+        try:
+            reply = {'ok': bool(convert(*request['args']))}
+        except Exception as error:  # pylint: disable=broad-except
+            reply = {'ok': False, 'error': str(error)}
+        write_frame(writer, reply)
+
+
+def _trusted_path(path: str) -> str:
+    root, extension = os.path.splitext(path)
+    return f'{root}.trusted{extension}'
+
+
+def reference_pdf(*paths) -> bool:
+    ''' Convert pdfs the way qvm-convert-pdf lays them out, by copying '''
+
+    for path in paths:
+        shutil.copyfile(path, _trusted_path(path))
+        os.unlink(path)
+    return True
+
+
+def reference_image(source: str, dest: str) -> bool:
+    ''' Convert an image to dest the way qvm-convert-img does, by copying '''
+
+    shutil.copyfile(source, dest)
+    return True
+
+
+def main() -> int:
+    ''' Entry point of the reference worker '''
+
+    if sys.argv[1:] not in (['--pdf'], ['--img']):
+        sys.stderr.write(f'usage: {sys.argv[0]} --pdf|--img\n')
+        return 2
+
+    serve(reference_pdf if sys.argv[1] == '--pdf' else reference_image)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
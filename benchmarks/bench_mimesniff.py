@@ -0,0 +1,102 @@
+'''
+Compare mime type detection through one file(1) process per file against the
+in-process sniffer with its batched fallback.
+
+    python3 benchmarks/bench_mimesniff.py --files 10000
+'''
+
+
+import os
+import sys
+import time
+import random
+import tempfile
+import argparse
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+import mimesniff
+
+
+HEADERS = (
+    b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n',
+    b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x10\x00\x00\x00\x10\x08\x02',
+    b'\xff\xd8\xff\xe0\x00\x10JFIF\x00',
+    b'<html><body>lecture notes</body></html>\n',
+    b'plain text content\n',
+)
+
+
+def parse_args() -> argparse.Namespace:
+    ''' Parse command line arguments '''
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=10000,
+                        help='Number of files in the generated corpus.')
+    parser.add_argument('--sample', type=int, default=None,
+                        help='Only time the per-file fork on this many files and '
+                        'extrapolate to the whole corpus.')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def generate_corpus(directory: str, count: int, seed: int) -> list:
+    ''' Write count files spread over a few nested directories '''
+
+    rand = random.Random(seed)
+    paths = []
+    for i in range(count):
+        subdir = os.path.join(directory, f'course-{i % 20}', f'week-{i % 7}')
+        os.makedirs(subdir, exist_ok=True)
+        path = os.path.join(subdir, f'file-{i}')
+
+        if i % 50 == 0:
+            with zipfile.ZipFile(path, mode='w') as writer:
+                writer.writestr('slides.pdf', HEADERS[0])
+        else:
+            with open(path, 'wb') as writer:
+                writer.write(rand.choice(HEADERS) + os.urandom(rand.randint(0, 512)))
+        paths.append(path)
+    return paths
+
+
+def time_per_file_fork(paths: list) -> float:
+    ''' One file(1) process for each path, as done by is_mimetype '''
+
+    start = time.perf_counter()
+    for path in paths:
+        mimesniff.file_mimetype(path)
+    return time.perf_counter() - start
+
+
+def time_detect(paths: list) -> float:
+    ''' Header sniffing with a single batched file(1) for unknown files '''
+
+    start = time.perf_counter()
+    mimesniff.detect(paths)
+    return time.perf_counter() - start
+
+
+def main() -> int:
+    ''' Entry point function '''
+
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        paths = generate_corpus(directory, args.files, args.seed)
+
+        sample = paths[:args.sample] if args.sample else paths
+        forked = time_per_file_fork(sample) * len(paths) / len(sample)
+        sniffed = time_detect(paths)
+
+    print(f'files: {len(paths)}')
+    print(f'per-file fork: {forked:.2f}s ({len(paths) / forked:.0f} files/s)'
+          + (' (extrapolated)' if args.sample else ''))
+    print(f'sniff + batch: {sniffed:.2f}s ({len(paths) / sniffed:.0f} files/s)')
+    print(f'speedup: {forked / sniffed:.1f}x')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+'''
+Measure the throughput of each placement primitive moving files into a
+store, which may live on another filesystem than the source.
+
+    python3 benchmarks/bench_placement.py --files 200 --size 2048 \
+        --store ~/QubesUntrustedIMGs/bench
+'''
+
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+import placement
+
+
+def parse_args() -> argparse.Namespace:
+    ''' Parse command line arguments '''
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=200,
+                        help='Number of files placed by each method.')
+    parser.add_argument('--size', type=int, default=1024,
+                        help='Size of each file in kilobytes.')
+    parser.add_argument('--source',
+                        help='Directory where files are generated (default: a '
+                        'temporary directory).')
+    parser.add_argument('--store',
+                        help='Directory files are placed into, put it on another '
+                        'filesystem to measure cross device moves (default: '
+                        'next to the source).')
+    parser.add_argument('--output',
+                        help='Where the results are written as JSON.')
+    return parser.parse_args()
+
+
+def generate(directory: str, files: int, size: int) -> list:
+    ''' Write files of random content, returning their paths '''
+
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for number in range(files):
+        path = os.path.join(directory, f'course-{number % 7}', f'file-{number}.pdf')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as writer:
+            writer.write(os.urandom(size))
+        paths.append(path)
+    return paths
+
+
+def measure(name: str, paths: list, place: callable, size: int) -> dict:
+    ''' Place every path timing the whole of it '''
+
+    placement.placed.clear()
+    start = time.perf_counter()
+    for path in paths:
+        place(path)
+    elapsed = time.perf_counter() - start
+
+    total = size * len(paths) / (1024 * 1024)
+    result = {'method': name,
+              'seconds': round(elapsed, 4),
+              'files_per_second': round(len(paths) / elapsed, 1),
+              'mb_per_second': round(total / elapsed, 1),
+              'used': dict(placement.placed)}
+    print(f'{name:16} {result["seconds"]:8.3f}s {result["files_per_second"]:10.1f} files/s '
+          f'{result["mb_per_second"]:8.1f} MB/s used: {result["used"]}')
+    return result
+
+
+def main() -> int:
+    ''' Entry point function '''
+
+    args = parse_args()
+    size = args.size * 1024
+    results = []
+
+    with tempfile.TemporaryDirectory(dir=args.source) as workdir:
+        store = args.store or os.path.join(workdir, 'store')
+        store = os.path.join(os.path.expanduser(store), f'bench-{os.getpid()}')
+        os.makedirs(store)
+        cross_device = os.stat(workdir).st_dev != os.stat(store).st_dev
+        print(f'files: {args.files} size: {args.size}KB cross device: {cross_device}')
+
+        try:
+            for method in placement.COPY_METHODS:
+                source = os.path.join(workdir, method)
+                paths = generate(source, args.files, size)
+
+                def copy(path, method=method, source=source):
+                    dest = placement.store_path(path, os.path.join(store, method), source)
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    placement.copy(path, dest, methods=(method,))
+
+                try:
+                    results.append(measure(method, paths, copy, size))
+                except OSError as error:
+                    print(f'{method:16} unsupported: {error}')
+
+            source = os.path.join(workdir, 'move')
+            paths = generate(source, args.files, size)
+            results.append(measure('move_to_store', paths,
+                                   lambda path: placement.move_to_store(
+                                       path, os.path.join(store, 'move'), source),
+                                   size))
+
+            source = os.path.join(workdir, 'shutil')
+            paths = generate(source, args.files, size)
+            flat = os.path.join(store, 'shutil')
+            os.makedirs(flat)
+            results.append(measure('shutil.move', paths,
+                                   lambda path: shutil.move(path, flat), size))
+        finally:
+            shutil.rmtree(store, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as writer:
+            json.dump({'files': args.files, 'size_kb': args.size,
+                       'cross_device': cross_device, 'results': results}, writer, indent=2)
+        print(f'results written to: {args.output}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+'''
+Simulate the makespan of a sync with conversions run in walk order against
+the longest estimated first, without starting any converter.
+
+    python3 benchmarks/bench_scheduling.py --jobs 500 --slots 4
+'''
+
+
+import os
+import sys
+import heapq
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+import estimate
+import scheduler
+
+
+def parse_args() -> argparse.Namespace:
+    ''' Parse command line arguments '''
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=500,
+                        help='Number of conversions in the simulated sync.')
+    parser.add_argument('--slots', type=int, default=4,
+                        help='Number of conversions running at once.')
+    parser.add_argument('--window', type=int, default=None,
+                        help='How many found jobs may wait to be picked, like '
+                        '--max-queued. Defaults to all of them.')
+    parser.add_argument('--late-pages', type=int, default=900,
+                        help='Pages of a scanned pdf found last in the walk, '
+                        '0 to leave it out.')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def generate_costs(count: int, seed: int) -> list:
+    ''' Mostly small documents and images with a few huge scanned pdfs,
+        placed anywhere in the walk order '''
+
+    rand = random.Random(seed)
+    costs = []
+    for _ in range(count):
+        if rand.random() < 0.6:
+            pages = max(1, int(rand.lognormvariate(2.5, 1.2)))
+            costs.append(estimate.STARTUP_COST + pages * estimate.PDF_PAGE_COST)
+        else:
+            pixels = rand.choice([640 * 480, 1920 * 1080, 4000 * 3000])
+            costs.append(estimate.STARTUP_COST + pixels * estimate.IMAGE_PIXEL_COST)
+    return costs
+
+
+def simulate(costs: list, slots: int, policy: str, window: int = None) -> float:
+    ''' Return when the last job finishes, picking the next job by the policy
+        key among the ones found so far '''
+
+    key = scheduler.POLICIES[policy]
+    window = window or len(costs)
+    found = iter(enumerate(costs))
+    pending, running, now = [], [], 0.0
+
+    def fill():
+        while len(pending) < window:
+            entry = next(found, None)
+            if entry is None:
+                return
+            sequence, cost = entry
+            job = scheduler.Job('sim', 1, None, cost=cost)
+            heapq.heappush(pending, (key(job), sequence, cost))
+
+    fill()
+    while pending or running:
+        while pending and len(running) < slots:
+            _, _, cost = heapq.heappop(pending)
+            heapq.heappush(running, now + cost)
+            fill()
+        now = heapq.heappop(running)
+    return now
+
+
+def main() -> int:
+    ''' Entry point function '''
+
+    args = parse_args()
+    costs = generate_costs(args.jobs, args.seed)
+    if args.late_pages:
+        costs.append(estimate.STARTUP_COST + args.late_pages * estimate.PDF_PAGE_COST)
+    bound = max(sum(costs) / args.slots, max(costs))
+
+    print(f'jobs: {len(costs)} slots: {args.slots} window: {args.window or "all"}')
+    print(f'lower bound: {bound:.0f}s')
+    results = {policy: simulate(costs, args.slots, policy, args.window)
+               for policy in scheduler.POLICIES}
+    for policy, makespan in results.items():
+        print(f'{policy}: {makespan:.0f}s ({makespan / bound:.3f}x bound)')
+    print(f'speedup: {results["fifo"] / results["lpt"]:.2f}x')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,187 @@
+'''
+Measure whole syncs of a synthetic tree with stub converters across worker
+settings, writing the results as JSON so runs can be compared over time.
+
+    python3 benchmarks/bench_throughput.py --files 500 --workers 1,4,8 \
+        --output results.json --baseline previous.json
+'''
+
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# pylint: disable=wrong-import-position
+import corpus
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUBS = os.path.join(ROOT, 'benchmarks', 'stubs')
+
+# how often the running sync is sampled for its thread count
+SAMPLE_INTERVAL = 0.01
+
+
+def parse_args() -> argparse.Namespace:
+    ''' Parse command line arguments '''
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=300,
+                        help='Number of files on the top of the generated tree.')
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', default='1,4,8',
+                        help='Comma separated values of --max-workers to run.')
+    parser.add_argument('--engines', default='threads',
+                        help='Comma separated engines to run.')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Runs of each setting, the fastest is kept.')
+    parser.add_argument('--latency', type=float, default=0.2,
+                        help='Seconds each stub converter call takes to start.')
+    parser.add_argument('--file-latency', type=float, default=0.02,
+                        help='Seconds each stub converter takes per file.')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='Share of files the stub converters reject.')
+    parser.add_argument('--sync-args', default='',
+                        help='More arguments given to every sync, e.g. "--batch-files 8".')
+    parser.add_argument('--output', default='bench_results.json',
+                        help='Where the results are written.')
+    parser.add_argument('--baseline',
+                        help='Results of a previous run to compare with.')
+    return parser.parse_args()
+
+
+def proc_status(pid: int) -> dict:
+    ''' Read the numeric fields of /proc/pid/status '''
+
+    status = {}
+    try:
+        with open(f'/proc/{pid}/status') as reader:
+            for line in reader:
+                key, _, value = line.partition(':')
+                value = value.split()
+                if value and value[0].isdigit():
+                    status[key] = int(value[0])
+    except OSError:
+        pass
+    return status
+
+
+def run_sync(directory: str, home: str, workers: int, engine: str, args) -> dict:
+    ''' Sync directory once, returning what was measured '''
+
+    command = [sys.executable, os.path.join(ROOT, 'preprocess.py'), directory,
+               '--pdf-bin-converter', os.path.join(STUBS, 'qvm-convert-pdf'),
+               '--img-bin-converter', os.path.join(STUBS, 'qvm-convert-img'),
+               '--no-cache',
+               '--max-workers', str(workers),
+               '--engine', engine,
+               # only --max-workers bounds the conversions
+               '--converter-memory', str(10 ** 9),
+               *args.sync_args.split()]
+    env = {**os.environ,
+           'HOME': home,
+           'STUB_LATENCY': str(args.latency),
+           'STUB_FILE_LATENCY': str(args.file_latency),
+           'STUB_FAILURE_RATE': str(args.failure_rate)}
+
+    start = time.perf_counter()
+    process = subprocess.Popen(command, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    peak_threads = 0
+    while True:
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            break
+        peak_threads = max(peak_threads, proc_status(process.pid).get('Threads', 0))
+        time.sleep(SAMPLE_INTERVAL)
+    wall = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    converted = sum(1 for _, _, files in os.walk(directory)
+                    for name in files if '.trusted.' in name)
+    return {
+        'wall_seconds': round(wall, 3),
+        'converted': converted,
+        'files_per_second': round(converted / wall, 2),
+        # ru_maxrss is given in kilobytes on linux
+        'peak_rss_mb': round(usage.ru_maxrss / 1024, 1),
+        'peak_threads': peak_threads,
+        'exit_code': process.returncode,
+    }
+
+
+def load_baseline(path: str) -> dict:
+    ''' Map each setting of a previous result file to its measures '''
+
+    with open(path) as reader:
+        previous = json.load(reader)
+    return {(run['engine'], run['workers']): run for run in previous['runs']}
+
+
+def main() -> int:
+    ''' Entry point function '''
+
+    args = parse_args()
+    baseline = load_baseline(args.baseline) if args.baseline else {}
+    runs = []
+
+    with tempfile.TemporaryDirectory() as workdir:
+        pristine = os.path.join(workdir, 'corpus')
+        counts = corpus.generate(pristine, files=args.files, depth=args.depth, seed=args.seed)
+
+        for engine in args.engines.split(','):
+            for workers in [int(value) for value in args.workers.split(',')]:
+                best = None
+                for attempt in range(args.repeat):
+                    # conversions change the tree, so each run gets a fresh copy
+                    run_dir = os.path.join(workdir, f'run-{engine}-{workers}-{attempt}')
+                    home = os.path.join(run_dir, 'home')
+                    os.makedirs(home)
+                    shutil.copytree(pristine, os.path.join(run_dir, 'tree'))
+
+                    measure = run_sync(os.path.join(run_dir, 'tree'), home, workers,
+                                       engine, args)
+                    shutil.rmtree(run_dir)
+                    if best is None or measure['wall_seconds'] < best['wall_seconds']:
+                        best = measure
+
+                run = {'engine': engine, 'workers': workers, **best}
+                runs.append(run)
+
+                line = (f'{engine:8} workers: {workers:3} wall: {run["wall_seconds"]:8.2f}s '
+                        f'files/s: {run["files_per_second"]:7.2f} '
+                        f'rss: {run["peak_rss_mb"]:6.1f}MB threads: {run["peak_threads"]}')
+                previous = baseline.get((engine, workers))
+                if previous:
+                    line += f' vs baseline: {previous["wall_seconds"] / run["wall_seconds"]:.2f}x'
+                print(line)
+
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'machine': {'python': platform.python_version(),
+                    'system': platform.platform(),
+                    'cpus': os.cpu_count()},
+        'corpus': {'files': args.files, 'depth': args.depth, 'seed': args.seed,
+                   'top_level': counts},
+        'stubs': {'latency': args.latency, 'file_latency': args.file_latency,
+                  'failure_rate': args.failure_rate},
+        'sync_args': args.sync_args,
+        'runs': runs,
+    }
+    with open(args.output, 'w') as writer:
+        json.dump(results, writer, indent=2)
+    print(f'results written to: {args.output}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
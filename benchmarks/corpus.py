@@ -0,0 +1,187 @@
+'''
+Generate synthetic u.sync-like trees: courses and weeks of pdfs, images,
+other files and zips, some of them nested, all with real headers.
+
+    python3 benchmarks/corpus.py /tmp/corpus --files 2000 --depth 3
+'''
+
+
+import io
+import os
+import sys
+import json
+import random
+import struct
+import zlib
+import zipfile
+import argparse
+
+
+# share of each kind of file in the tree
+DEFAULT_MIX = {
+    'pdf': 0.45,
+    'png': 0.15,
+    'jpeg': 0.15,
+    'other': 0.15,
+    'zip': 0.10,
+}
+
+
+def parse_args() -> argparse.Namespace:
+    ''' Parse command line arguments '''
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory', help='Where the tree is generated.')
+    parser.add_argument('--files', type=int, default=1000,
+                        help='Number of files on the top of the tree.')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='Directory levels below each course.')
+    parser.add_argument('--zip-members', type=int, default=8,
+                        help='Files inside each generated zip.')
+    parser.add_argument('--nested-zips', type=float, default=0.2,
+                        help='Share of zip members which are zips themselves.')
+    parser.add_argument('--mix', type=json.loads, default=DEFAULT_MIX,
+                        help='JSON object with the share of pdf, png, jpeg, other '
+                        'and zip files.')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def pdf_bytes(pages: int, padding: int = 0) -> bytes:
+    ''' Pdf with a flat page tree, its cross-reference table and padding
+        bytes standing for page content '''
+
+    kids = ' '.join(f'{3 + i} 0 R' for i in range(pages))
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>',
+               f'<< /Type /Pages /Kids [{kids}] /Count {pages} >>'.encode()]
+    objects += [b'<< /Type /Page /Parent 2 0 R >>'] * pages
+    objects.append(b'<< /Length %d >>\nstream\n' % padding + b'0' * padding + b'\nendstream')
+
+    content, offsets = bytearray(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'), []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(content))
+        content += f'{number} 0 obj\n'.encode() + body + b'\nendobj\n'
+
+    startxref = len(content)
+    content += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode()
+    for offset in offsets:
+        content += f'{offset:010d} 00000 n \n'.encode()
+    content += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n'.encode()
+    content += f'startxref\n{startxref}\n%%EOF\n'.encode()
+    return bytes(content)
+
+
+def png_bytes(width: int, height: int, data: bytes = b'') -> bytes:
+    ''' Png header of the given dimensions followed by some image data '''
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return (struct.pack('>I', len(data)) + kind + data
+                + struct.pack('>I', zlib.crc32(kind + data)))
+
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', ihdr)
+            + chunk(b'IDAT', data) + chunk(b'IEND', b''))
+
+
+def jpeg_bytes(width: int, height: int, data: bytes = b'') -> bytes:
+    ''' Jpeg with a JFIF header and a baseline frame of the given dimensions '''
+
+    app0 = b'\xff\xe0' + struct.pack('>H', 16) + b'JFIF\x00\x01\x01' + b'\x00' * 7
+    sof = b'\xff\xc0' + struct.pack('>HBHHB', 11, 8, height, width, 1) + b'\x01\x11\x00'
+    return b'\xff\xd8' + app0 + sof + data + b'\xff\xd9'
+
+
+def other_bytes(rand: random.Random, size: int) -> bytes:
+    ''' Some file no service converts '''
+
+    kind = rand.choice([b'<html><body>lecture notes</body></html>\n',
+                        b'plain text content\n',
+                        b'\x00\x01\x02binary'])
+    return kind + b'x' * size
+
+
+def random_file(rand: random.Random, mix: dict, zip_members: int, nested: float,
+                zip_depth: int = 0) -> tuple:
+    ''' Return the extension and content of a random file of the mix '''
+
+    kinds = [kind for kind in mix if kind != 'zip' or zip_depth < 2]
+    kind = rand.choices(kinds, weights=[mix[kind] for kind in kinds])[0]
+
+    if kind == 'pdf':
+        pages = max(1, int(rand.lognormvariate(2.0, 1.0)))
+        return '.pdf', pdf_bytes(pages, padding=pages * rand.randint(256, 4096))
+    if kind == 'png':
+        width, height = rand.choice([(640, 480), (1280, 720), (1920, 1080)])
+        return '.png', png_bytes(width, height, rand.randbytes(rand.randint(1024, 64 * 1024)))
+    if kind == 'jpeg':
+        width, height = rand.choice([(800, 600), (1920, 1080), (4000, 3000)])
+        return '.jpg', jpeg_bytes(width, height, rand.randbytes(rand.randint(1024, 64 * 1024)))
+    if kind == 'zip':
+        return '.zip', zip_bytes(rand, mix, zip_members, nested, zip_depth + 1)
+    return rand.choice(['.html', '.txt', '']), other_bytes(rand, rand.randint(0, 4096))
+
+
+def zip_bytes(rand: random.Random, mix: dict, members: int, nested: float,
+              zip_depth: int) -> bytes:
+    ''' Zip of random files, where some members may be zips as well '''
+
+    member_mix = {kind: share for kind, share in mix.items() if kind != 'zip'}
+    if zip_depth < 2 and nested:
+        member_mix['zip'] = nested * sum(member_mix.values())
+
+    # untrusted originals are kept in flat directories, so names are unique
+    archive = rand.getrandbits(32)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, mode='w', compression=zipfile.ZIP_DEFLATED) as writer:
+        for number in range(members):
+            extension, content = random_file(rand, member_mix, members, nested, zip_depth)
+            # a fixed date keeps the archive the same for a given seed
+            name = f'material/{archive}-{number}{extension}'
+            info = zipfile.ZipInfo(name, date_time=(2020, 1, 1, 0, 0, 0))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            writer.writestr(info, content)
+    return buffer.getvalue()
+
+
+def generate(directory: str,
+             files: int = 1000,
+             depth: int = 3,
+             zip_members: int = 8,
+             nested_zips: float = 0.2,
+             mix: dict = None,
+             seed: int = 0) -> dict:
+    ''' Write the tree on directory, returning how many files of each kind
+        were written on its top '''
+
+    rand = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    counts = {}
+    for number in range(files):
+        parts = [f'course-{number % 12}'] + [f'unit-{rand.randint(0, 3)}' for _ in range(depth)]
+        subdir = os.path.join(directory, *parts)
+        os.makedirs(subdir, exist_ok=True)
+
+        extension, content = random_file(rand, mix, zip_members, nested_zips)
+        with open(os.path.join(subdir, f'file-{number}{extension}'), 'wb') as writer:
+            writer.write(content)
+        counts[extension or 'none'] = counts.get(extension or 'none', 0) + 1
+    return counts
+
+
+def main() -> int:
+    ''' Entry point function '''
+
+    args = parse_args()
+    counts = generate(args.directory,
+                      files=args.files,
+                      depth=args.depth,
+                      zip_members=args.zip_members,
+                      nested_zips=args.nested_zips,
+                      mix=args.mix,
+                      seed=args.seed)
+    print(json.dumps(counts, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
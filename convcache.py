@@ -0,0 +1,169 @@
+'''
+Persistent cache of trusted conversion outputs addressed by the content of
+their untrusted input.
+'''
+
+
+import os
+import hashlib
+import logging
+import threading
+
+import placement
+
+
+from typing import (
+    Dict,
+    List,
+    Tuple,
+)
+
+
+CHUNK_SIZE = 1024 * 1024
+
+_caches_lock = threading.Lock()
+_caches: Dict[str, 'ConversionCache'] = {}
+
+
+def hash_file(path: str, namespace: str = '') -> str:
+    ''' Return the sha256 hex digest of namespace followed by file content '''
+
+    digest = hashlib.sha256(namespace.encode() + b'\0')
+    with open(path, 'rb') as reader:
+        for chunk in iter(lambda: reader.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ConversionCache:
+    ''' Store trusted outputs on disk with a size cap and LRU eviction.
+
+        Each entry is kept as objects/<key[:2]>/<key> alongside a <key>.sha256
+        file holding the digest of the output, which is checked on every hit.
+        The modification time of an entry is its last use. '''
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._objects = os.path.join(self.directory, 'objects')
+        os.makedirs(self._objects, exist_ok=True)
+        self._usage = sum(size for _, _, size in self._entries())
+
+    def key(self, path: str, namespace: str = '') -> str:
+        ''' Return the cache key of an untrusted input '''
+
+        return hash_file(path, namespace)
+
+    def _object_path(self, key: str) -> str:
+        return os.path.join(self._objects, key[:2], key)
+
+    def _entries(self) -> List[Tuple[float, str, int]]:
+        ''' Return (last use, key, size) of every stored entry '''
+
+        entries = []
+        for root, _, names in os.walk(self._objects):
+            for name in names:
+                # digests and temporary files all have a dot on their names
+                if '.' in name:
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, name, stat.st_size))
+        return entries
+
+    def _discard(self, key: str) -> None:
+        obj = self._object_path(key)
+        try:
+            size = os.path.getsize(obj)
+            os.unlink(obj)
+        except FileNotFoundError:
+            size = 0
+        try:
+            os.unlink(obj + '.sha256')
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self._usage -= size
+
+    def _count(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def fetch(self, key: str, dest: str) -> bool:
+        ''' Copy the trusted output stored under key to dest. Return whether the
+            entry was present and intact. '''
+
+        obj = self._object_path(key)
+        try:
+            with open(obj + '.sha256') as reader:
+                expected = reader.read().strip()
+            actual = hash_file(obj)
+        except FileNotFoundError:
+            self._count(hit=False)
+            return False
+
+        if actual != expected:
+            logging.warning('discarding corrupted cache entry: %s', key)
+            self._discard(key)
+            self._count(hit=False)
+            return False
+
+        placement.copy(obj, dest)
+        os.utime(obj)
+        self._count(hit=True)
+        logging.debug('cache hit: %s -> %s', key, dest)
+        return True
+
+    def store(self, key: str, source: str) -> None:
+        ''' Keep a copy of the trusted output at source under key '''
+
+        size = os.path.getsize(source)
+        if size > self.max_bytes:
+            logging.debug('output too large to be cached: %s', source)
+            return
+
+        obj = self._object_path(key)
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        placement.copy(source, obj)
+        with open(obj + '.sha256.tmp', 'w') as writer:
+            writer.write(hash_file(obj))
+        os.replace(obj + '.sha256.tmp', obj + '.sha256')
+
+        with self._lock:
+            self._usage += size
+            over_limit = self._usage > self.max_bytes
+
+        logging.debug('cached output: %s as: %s', source, key)
+        if over_limit:
+            self.evict()
+
+    def evict(self) -> None:
+        ''' Remove least recently used entries until usage fits the cap '''
+
+        with self._lock:
+            entries = sorted(self._entries())
+            self._usage = sum(size for _, _, size in entries)
+
+        for _, key, _ in entries:
+            if self._usage <= self.max_bytes:
+                break
+            logging.debug('evicting cache entry: %s', key)
+            self._discard(key)
+
+
+def open_cache(directory: str, max_bytes: int) -> ConversionCache:
+    ''' Return the cache living at directory, shared by every caller '''
+
+    directory = os.path.realpath(os.path.expanduser(directory))
+    with _caches_lock:
+        cache = _caches.get(directory)
+        if cache is None:
+            cache = _caches[directory] = ConversionCache(directory, max_bytes)
+        return cache
@@ -0,0 +1,172 @@
+'''
+Long lived service taking jobs from local clients over a UNIX socket, so
+every sync shares warm state and a single converter budget.
+'''
+
+
+import os
+import json
+import socket
+import logging
+import threading
+import itertools
+import socketserver
+
+
+from typing import (
+    Generator,
+)
+
+
+DEFAULT_SOCKET = '~/.cache/qubes-usync/daemon.sock'
+
+# options of a run a client may choose for its own job
+JOB_OPTIONS = ('incremental', 'resume', 'watch', 'watch_pid', 'done_file', 'deliver')
+
+# events ending the stream of a job
+FINAL_EVENTS = ('done', 'error')
+
+# seconds between two progress events of a job
+PROGRESS_INTERVAL = 5.0
+
+
+class DaemonError(Exception):
+    ''' Raised by clients when the daemon refused or failed a job '''
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    ''' Read a single job from a client and stream its events back as JSON
+        lines, until the job is done '''
+
+    def reply(self, event: str, **details) -> None:
+        ''' Send an event of the job to the client, which may be gone '''
+
+        line = json.dumps({'event': event, **details}) + '\n'
+        try:
+            self.wfile.write(line.encode())
+            self.wfile.flush()
+        except OSError:
+            logging.debug('client of job went away before: %s', event)
+
+    def handle(self) -> None:
+        try:
+            request = json.loads(self.rfile.readline())
+            path = os.path.realpath(request['path'])
+        except (ValueError, KeyError, TypeError) as error:
+            self.reply('error', message=f'invalid request: {error}')
+            return
+
+        if not os.path.exists(path):
+            self.reply('error', message=f'no such file or directory: {path}')
+            return
+
+        options = {key: request[key] for key in JOB_OPTIONS if key in request}
+        job_id = self.server.begin(path)
+        if job_id is None:
+            self.reply('error', message=f'a job is already running on: {path}')
+            return
+
+        logging.info('job %d accepted: %s', job_id, path)
+        self.reply('accepted', job=job_id, path=path)
+        try:
+            result = self.server.run_job(path, options,
+                                         lambda event, **details: self.reply(event, job=job_id,
+                                                                             **details))
+        except Exception as error:  # pylint: disable=broad-except
+            logging.exception('job %d failed', job_id)
+            self.reply('error', job=job_id, message=str(error))
+        else:
+            self.reply('done', job=job_id, **result)
+        finally:
+            self.server.end(path)
+            logging.info('job %d finished: %s', job_id, path)
+
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    ''' Serve jobs of clients each on its own thread. A job is a file or a
+        directory handed to run_job, along with the JOB_OPTIONS the client
+        gave, and a function streaming events back. run_job returns the
+        details sent with the final event. Two jobs never run on the same
+        path at once. '''
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, run_job: callable):
+        self.socket_path = os.path.expanduser(socket_path)
+        self.run_job = run_job
+        self._running = set()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.socket_path)), exist_ok=True)
+        if os.path.exists(self.socket_path):
+            if is_listening(self.socket_path):
+                raise DaemonError(f'a daemon already listens on: {self.socket_path}')
+            # left behind by a daemon which did not stop cleanly
+            os.unlink(self.socket_path)
+
+        # only the owner may submit jobs
+        umask = os.umask(0o177)
+        try:
+            super().__init__(self.socket_path, JobHandler)
+        finally:
+            os.umask(umask)
+
+    def begin(self, path: str) -> int:
+        ''' Mark a job running on path, returning its id, or None when some
+            job already runs on it '''
+
+        with self._lock:
+            if path in self._running:
+                return None
+            self._running.add(path)
+            return next(self._ids)
+
+    def end(self, path: str) -> None:
+        ''' Mark the job on path as finished '''
+
+        with self._lock:
+            self._running.discard(path)
+
+    def server_close(self) -> None:
+        super().server_close()
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+
+def is_listening(socket_path: str) -> bool:
+    ''' Tell whether a daemon accepts connections on socket_path '''
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(os.path.expanduser(socket_path))
+        except OSError:
+            return False
+    return True
+
+
+def submit(socket_path: str, path: str, **options) -> Generator:
+    ''' Send a job on path to the daemon listening on socket_path, yielding
+        each event of the job as it comes. Raise DaemonError when the job was
+        refused or failed. '''
+
+    request = {'path': os.path.abspath(path),
+               **{key: value for key, value in options.items() if key in JOB_OPTIONS}}
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(os.path.expanduser(socket_path))
+        with client.makefile('rwb') as stream:
+            stream.write(json.dumps(request).encode() + b'\n')
+            stream.flush()
+
+            for line in stream:
+                event = json.loads(line)
+                if event['event'] == 'error':
+                    raise DaemonError(event['message'])
+                yield event
+                if event['event'] in FINAL_EVENTS:
+                    return
+
+    raise DaemonError('daemon closed the connection before the job was done')
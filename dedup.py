@@ -0,0 +1,126 @@
+'''
+Detection of identical files found during a run, so each distinct content is
+converted only once.
+'''
+
+
+import os
+import logging
+import threading
+
+import convcache
+
+
+from typing import (
+    Dict,
+    List,
+    Tuple,
+    Union,
+)
+
+
+class Deduplicator:
+    ''' Group the files of each service by content while they are found.
+
+        Files are bucketed by size first and only hashed once another file of
+        the same size shows up, so unique sizes are never read. The first file
+        of some content is the leader and gets converted, later copies follow
+        it and wait for its outcome. Copies found after their leader is over
+        are not grouped, the conversion cache is what serves them. '''
+
+    def __init__(self):
+        self._sizes: Dict[tuple, List[str]] = {}
+        self._buckets: Dict[str, tuple] = {}
+        self._digests: Dict[str, str] = {}
+        self._leaders: Dict[tuple, str] = {}
+        self._followers: Dict[str, List[str]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _hash(path: str) -> Union[str, None]:
+        try:
+            return convcache.hash_file(path)
+        except OSError as error:
+            # a leader may be gone already, moved away by its converter
+            logging.debug('unable to hash %s: %s', path, error)
+            return None
+
+    def _lead(self, service: str, path: str, bucket: tuple, digest: Union[str, None]) -> None:
+        self._sizes.setdefault(bucket, []).append(path)
+        self._buckets[path] = bucket
+        self._followers[path] = []
+        if digest is not None:
+            self._digests[path] = digest
+            self._leaders[(service, digest)] = path
+
+    def _drop(self, path: str) -> Union[str, None]:
+        bucket = self._buckets.pop(path)
+        self._sizes[bucket].remove(path)
+        if not self._sizes[bucket]:
+            del self._sizes[bucket]
+        self._followers.pop(path)
+        return self._digests.pop(path, None)
+
+    def add(self, service: str, path: str) -> Union[str, None]:
+        ''' Register path and return the leader it is a copy of, if any. None
+            means path has to be converted. '''
+
+        try:
+            bucket = (service, os.stat(path).st_size)
+        except OSError:
+            return None
+
+        with self._lock:
+            unhashed = [candidate for candidate in self._sizes.get(bucket, [])
+                        if candidate not in self._digests]
+            if bucket not in self._sizes:
+                self._lead(service, path, bucket, None)
+                return None
+
+        digest = self._hash(path)
+        if digest is None:
+            return None
+
+        for candidate in unhashed:
+            candidate_digest = self._hash(candidate)
+            with self._lock:
+                if candidate not in self._buckets or candidate in self._digests:
+                    continue
+                if candidate_digest is None:
+                    self._drop(candidate)
+                elif (service, candidate_digest) not in self._leaders:
+                    self._digests[candidate] = candidate_digest
+                    self._leaders[(service, candidate_digest)] = candidate
+
+        with self._lock:
+            leader = self._leaders.get((service, digest))
+            if leader is not None:
+                self._followers[leader].append(path)
+                logging.debug('%s is a copy of %s', path, leader)
+                return leader
+
+            self._lead(service, path, bucket, digest)
+            return None
+
+    def finish(self, service: str, path: str, success: bool) -> Tuple[List[str], Union[str, None]]:
+        ''' Settle the conversion of path. Return the copies which get its
+            output and, when it failed, the copy to be converted instead. '''
+
+        with self._lock:
+            if path not in self._buckets:
+                return ([], None)
+
+            bucket, followers = self._buckets[path], self._followers[path]
+            digest = self._drop(path)
+            if digest is not None:
+                del self._leaders[(service, digest)]
+
+            if success or not followers:
+                return (followers if success else [], None)
+
+            # the next copy is converted, the others keep waiting for it
+            promoted = followers[0]
+            self._lead(service, promoted, bucket, digest)
+            self._followers[promoted] = followers[1:]
+            return ([], promoted)
+
@@ -0,0 +1,216 @@
+'''
+Delivery of TRUSTED outputs to another qube in batches while the run goes on,
+instead of a single transfer once everything is converted.
+'''
+
+
+import os
+import time
+import shlex
+import shutil
+import tarfile
+import logging
+import tempfile
+import threading
+import subprocess
+
+import placement
+
+
+from typing import (
+    List,
+    Tuple,
+)
+
+
+DEFAULT_COMMAND = 'qvm-copy'
+
+# a batch is shipped once it holds this many files or bytes, or once its
+# first file waited this many seconds
+MAX_FILES = 500
+MAX_BYTES = 256 * 1024 * 1024
+WINDOW = 30.0
+
+
+class Delivery:
+    ''' Ship files of directory with command, grouped in batches.
+
+        Each batch is staged under its path relative to directory, by hard
+        links where possible, so the transfer keeps the layout of the tree
+        and same named files do not collide. With pack, a batch is written
+        as a single tar archive instead, so the transfer carries one file.
+        Batches are shipped one at a time by a background thread, the
+        command getting the staged batch as its last argument. '''
+
+    def __init__(self,
+                 directory: str,
+                 command: str = DEFAULT_COMMAND,
+                 max_files: int = MAX_FILES,
+                 max_bytes: int = MAX_BYTES,
+                 window: float = WINDOW,
+                 pack: bool = False,
+                 staging_dir: str = None):
+        self.directory = os.path.abspath(directory)
+        self.command = shlex.split(command)
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.window = window
+        self.pack = pack
+        self.staging_dir = staging_dir
+        self.name = f'{os.path.basename(self.directory)}-{time.strftime("%H%M%S")}'
+
+        self.delivered = set()
+        self.failed: List[str] = []
+        self.batches = 0
+        self.bytes = 0
+
+        self._pending: List[Tuple[str, int]] = []
+        self._pending_bytes = 0
+        self._since = None
+        self._closing = False
+        self._condition = threading.Condition()
+        self._thread = None
+        self._own_staging = False
+
+    def start(self) -> 'Delivery':
+        ''' Start shipping batches in the background '''
+
+        if self.staging_dir is None:
+            # next to directory, so staged files can be hard links
+            self.staging_dir = tempfile.mkdtemp(prefix='.usync-delivery-',
+                                                dir=os.path.dirname(self.directory))
+            self._own_staging = True
+        else:
+            os.makedirs(self.staging_dir, exist_ok=True)
+
+        self._thread = threading.Thread(target=self._run, name='delivery', daemon=True)
+        self._thread.start()
+        return self
+
+    def add(self, path: str) -> None:
+        ''' Queue path to be shipped in the next batch, at most once '''
+
+        path = os.path.abspath(path)
+        try:
+            size = os.stat(path).st_size
+        except OSError as error:
+            logging.warning('unable to deliver %s: %s', path, error)
+            return
+
+        with self._condition:
+            if path in self.delivered:
+                return
+            self.delivered.add(path)
+            self._pending.append((path, size))
+            self._pending_bytes += size
+            if self._since is None:
+                self._since = time.monotonic()
+            self._condition.notify()
+
+    def add_rest(self) -> None:
+        ''' Queue every file of directory not shipped yet, as the last step
+            of a run, leaving out hidden ones '''
+
+        for root, dirs, names in os.walk(self.directory):
+            dirs[:] = [name for name in dirs if not name.startswith('.')]
+            for name in names:
+                if not name.startswith('.'):
+                    self.add(os.path.join(root, name))
+
+    def _full(self) -> bool:
+        return (len(self._pending) >= self.max_files
+                or self._pending_bytes >= self.max_bytes)
+
+    def _next_batch(self) -> List[Tuple[str, int]]:
+        ''' Wait for a batch to be due and take it, empty once closed '''
+
+        with self._condition:
+            while True:
+                if self._pending and (self._closing or self._full()):
+                    break
+                if self._pending:
+                    remaining = self.window - (time.monotonic() - self._since)
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                elif self._closing:
+                    return []
+                else:
+                    self._condition.wait()
+
+            batch = self._pending[:self.max_files]
+            self._pending = self._pending[self.max_files:]
+            self._pending_bytes -= sum(size for _, size in batch)
+            self._since = time.monotonic() if self._pending else None
+            return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            self._ship(batch)
+
+    def _stage(self, paths: List[str], number: int) -> str:
+        ''' Gather paths in a single file or directory ready to be shipped '''
+
+        name = f'{self.name}-{number:04d}'
+        if self.pack:
+            staged = os.path.join(self.staging_dir, f'{name}.tar')
+            with tarfile.open(staged, 'w') as archive:
+                for path in paths:
+                    archive.add(path, arcname=os.path.join(
+                        name, placement.store_path(path, '', self.directory)), recursive=False)
+            return staged
+
+        staged = os.path.join(self.staging_dir, name)
+        for path in paths:
+            dest = placement.store_path(path, staged, self.directory)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            placement.link(path, dest, mode='hardlink')
+        return staged
+
+    def _ship(self, batch: List[Tuple[str, int]]) -> None:
+        self.batches += 1
+        paths = [path for path, _ in batch]
+        size = sum(size for _, size in batch)
+
+        staged = None
+        try:
+            staged = self._stage(paths, self.batches)
+            logging.debug('delivering batch %d: %d files %d bytes',
+                          self.batches, len(paths), size)
+            subprocess.run(self.command + [staged], check=True,
+                           stdin=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError) as error:
+            logging.error('delivery of batch %d failed: %s', self.batches, error)
+            self.failed.extend(paths)
+            return
+        finally:
+            if staged is not None:
+                if os.path.isdir(staged):
+                    shutil.rmtree(staged, ignore_errors=True)
+                elif os.path.exists(staged):
+                    os.unlink(staged)
+
+        self.bytes += size
+        logging.info('delivered batch %d: %d files', self.batches, len(paths))
+
+    def close(self) -> bool:
+        ''' Ship what is left and wait for it. Return whether every batch
+            was delivered. '''
+
+        with self._condition:
+            self._closing = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+        if self._own_staging:
+            shutil.rmtree(self.staging_dir, ignore_errors=True)
+        return not self.failed
+
+
+def open_delivery(directory: str, **kwargs) -> Delivery:
+    ''' Return a started delivery of directory '''
+
+    return Delivery(directory, **kwargs).start()
@@ -0,0 +1,268 @@
+'''
+Up front estimation of how long a conversion takes, read from the headers of
+the file instead of its whole content, and rates measured by previous runs.
+'''
+
+
+import os
+import re
+import json
+import struct
+import logging
+
+
+from typing import (
+    Dict,
+    Tuple,
+    Union,
+)
+
+
+# seconds spent starting a DispVM, paid by every conversion
+STARTUP_COST = 5.0
+
+PDF_PAGE_COST = 1.0
+# used when the page count can not be read, about a scanned page
+PDF_BYTES_PER_PAGE = 100 * 1024
+
+IMAGE_PIXEL_COST = 1 / 10_000_000
+# used when the dimensions can not be read, about a compressed photo
+IMAGE_BYTES_PER_PIXEL = 0.25
+
+# share of the last run on the recorded seconds per file of a service
+RATE_WEIGHT = 0.3
+
+# how much of the end of a pdf is read looking for its trailer
+TRAILER_SIZE = 4096
+# how much of each end of a pdf is searched when the xref can not be followed
+SCAN_SIZE = 1024 * 1024
+OBJECT_SIZE = 1024
+
+STARTXREF = re.compile(rb'startxref\s+(\d+)')
+ROOT_REF = re.compile(rb'/Root\s+(\d+)\s+(\d+)\s+R')
+PAGES_REF = re.compile(rb'/Pages\s+(\d+)\s+(\d+)\s+R')
+COUNT = re.compile(rb'/Count\s+(\d+)')
+PAGES_NODE = re.compile(rb'/Type\s*/Pages\b[^>]*?/Count\s+(\d+)'
+                        rb'|/Count\s+(\d+)[^>]*?/Type\s*/Pages\b', re.S)
+XREF_SECTION = re.compile(rb'(\d+)\s+(\d+)\s*[\r\n]+')
+
+# start of frame markers, all but DHT, JPG and DAC share the SOF0 layout
+JPEG_SOF = {0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7,
+            0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf}
+
+
+def _read_at(reader, offset: int, size: int) -> bytes:
+    reader.seek(max(offset, 0))
+    return reader.read(size)
+
+
+def _xref_offsets(reader, offset: int) -> dict:
+    ''' Parse a classic cross-reference table into object offsets '''
+
+    data = _read_at(reader, offset, SCAN_SIZE)
+    if not data.startswith(b'xref'):
+        return {}
+
+    offsets, position = {}, 4
+    while True:
+        while data[position:position + 1] in (b'\r', b'\n', b' '):
+            position += 1
+        section = XREF_SECTION.match(data, position)
+        if section is None:
+            return offsets
+
+        first, count = int(section.group(1)), int(section.group(2))
+        position = section.end()
+        for number in range(first, first + count):
+            entry = data[position:position + 20]
+            if len(entry) < 18:
+                return offsets
+            if entry[17:18] == b'n':
+                offsets[number] = int(entry[:10])
+            position += 20
+
+
+def _object_ref(reader, offsets: dict, number: int, pattern: re.Pattern) -> Union[int, None]:
+    if number not in offsets:
+        return None
+
+    found = pattern.search(_read_at(reader, offsets[number], OBJECT_SIZE))
+    return int(found.group(1)) if found else None
+
+
+def _scan_pages(reader, size: int) -> Union[int, None]:
+    ''' Look for the biggest page tree node on both ends of the file '''
+
+    counts = []
+    for offset in sorted({0, max(size - SCAN_SIZE, 0)}):
+        for found in PAGES_NODE.finditer(_read_at(reader, offset, SCAN_SIZE)):
+            counts.append(int(found.group(1) or found.group(2)))
+    return max(counts, default=None)
+
+
+def pdf_pages(path: str) -> Union[int, None]:
+    ''' Return the page count of the pdf on path, following the trailer and
+        its cross-reference table to the page tree root. Documents using
+        cross-reference streams are searched for their page tree instead.
+        None means the count could not be found. '''
+
+    try:
+        with open(path, 'rb') as reader:
+            size = os.fstat(reader.fileno()).st_size
+            tail = _read_at(reader, size - TRAILER_SIZE, TRAILER_SIZE)
+
+            startxref = STARTXREF.findall(tail)
+            root = ROOT_REF.findall(tail)
+            if startxref and root:
+                offsets = _xref_offsets(reader, int(startxref[-1]))
+                pages = _object_ref(reader, offsets, int(root[-1][0]), PAGES_REF)
+                if pages is not None:
+                    count = _object_ref(reader, offsets, pages, COUNT)
+                    if count is not None:
+                        return count
+
+            return _scan_pages(reader, size)
+    except (OSError, ValueError) as error:
+        logging.debug('unable to count pages of %s: %s', path, error)
+        return None
+
+
+def _jpeg_size(reader) -> Union[Tuple[int, int], None]:
+    reader.seek(2)
+    while True:
+        marker = reader.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            return None
+
+        # fill bytes may come before any marker
+        while marker[1] == 0xff:
+            marker = marker[1:] + reader.read(1)
+            if len(marker) < 2:
+                return None
+
+        if 0xd0 <= marker[1] <= 0xd9 or marker[1] == 0x01:
+            continue
+
+        length = reader.read(2)
+        if len(length) < 2:
+            return None
+
+        if marker[1] in JPEG_SOF:
+            frame = reader.read(5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack('>HH', frame[1:5])
+            return width, height
+
+        reader.seek(struct.unpack('>H', length)[0] - 2, os.SEEK_CUR)
+
+
+def image_size(path: str) -> Union[Tuple[int, int], None]:
+    ''' Return width and height of a png, jpeg or gif image read from its
+        header. None means the format is unknown or the header is broken. '''
+
+    try:
+        with open(path, 'rb') as reader:
+            header = reader.read(24)
+            if header.startswith(b'\x89PNG\r\n\x1a\n') and header[12:16] == b'IHDR':
+                return struct.unpack('>II', header[16:24])
+
+            if header[:6] in (b'GIF87a', b'GIF89a') and len(header) >= 10:
+                return struct.unpack('<HH', header[6:10])
+
+            if header.startswith(b'\xff\xd8\xff'):
+                return _jpeg_size(reader)
+    except (OSError, struct.error) as error:
+        logging.debug('unable to read image size of %s: %s', path, error)
+    return None
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+def size_cost(path: str) -> float:
+    ''' Estimate conversion time only from the size of the file '''
+
+    return STARTUP_COST + _file_size(path) / PDF_BYTES_PER_PAGE * PDF_PAGE_COST
+
+
+def pdf_cost(path: str) -> float:
+    ''' Estimate pdf conversion time, which grows with the page count '''
+
+    pages = pdf_pages(path)
+    if pages is None:
+        return size_cost(path)
+    return STARTUP_COST + pages * PDF_PAGE_COST
+
+
+def image_pixels(path: str) -> float:
+    ''' Return the pixel count of an image, guessed from its size when the
+        header can not be read '''
+
+    size = image_size(path)
+    return size[0] * size[1] if size else _file_size(path) / IMAGE_BYTES_PER_PIXEL
+
+
+def image_cost(path: str, max_pixels: int = None) -> float:
+    ''' Estimate image conversion time, which grows with the pixel count up
+        to max_pixels, when images are downscaled to it '''
+
+    pixels = image_pixels(path)
+    if max_pixels:
+        pixels = min(pixels, max_pixels)
+    return STARTUP_COST + pixels * IMAGE_PIXEL_COST
+
+
+def member_cost(mimetype: Union[str, None], size: int) -> float:
+    ''' Estimate conversion time of a file only known by its type and size,
+        like a member of an archive not extracted yet '''
+
+    if mimetype is not None and mimetype.startswith('image/'):
+        return STARTUP_COST + size / IMAGE_BYTES_PER_PIXEL * IMAGE_PIXEL_COST
+    return STARTUP_COST + size / PDF_BYTES_PER_PAGE * PDF_PAGE_COST
+
+
+def load_rates(path: str) -> Dict[str, dict]:
+    ''' Return the conversion rates recorded by previous runs, the measured
+        seconds per file of each service '''
+
+    try:
+        with open(os.path.expanduser(path)) as reader:
+            return json.load(reader)
+    except (OSError, ValueError) as error:
+        logging.debug('no conversion rates loaded from %s: %s', path, error)
+        return {}
+
+
+def record_rates(path: str, stats: Dict[str, dict]) -> Dict[str, dict]:
+    ''' Blend the seconds per file measured by a run into the recorded rates,
+        giving RATE_WEIGHT to the last run '''
+
+    rates = load_rates(path)
+    for service, service_stats in stats.items():
+        # copies given the output of another conversion took no converter time
+        files = service_stats.get('done', 0) - service_stats.get('deduplicated', 0)
+        seconds = service_stats.get('seconds', 0)
+        if not files or not seconds:
+            continue
+
+        measured = seconds / files
+        previous = rates.get(service)
+        if previous:
+            measured = RATE_WEIGHT * measured + (1 - RATE_WEIGHT) * previous['seconds_per_file']
+        rates[service] = {
+            'seconds_per_file': round(measured, 3),
+            'files': files + (previous or {}).get('files', 0),
+        }
+
+    path = os.path.expanduser(path)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w') as writer:
+        json.dump(rates, writer, indent=2)
+    os.replace(temp_path, path)
+    return rates
@@ -0,0 +1,259 @@
+'''
+Archive extraction engine with parallel members, nested archives and limits
+against hostile or broken archives.
+'''
+
+
+import os
+import logging
+import zipfile
+import threading
+from concurrent import futures
+
+import tracing
+import mimesniff
+
+
+from typing import (
+    List,
+    Union,
+    Generator,
+)
+
+
+DEFAULT_LIMITS = {
+    'max_depth': 3,
+    'max_bytes': 2 * 1024 ** 3,
+    'max_members': 10000,
+    'max_ratio': 100,
+    'workers': 4,
+    'buffer_size': 1024 * 1024,
+}
+
+# members below this size are never held against the compression ratio
+RATIO_THRESHOLD = 1024 * 1024
+
+
+class ExtractionError(Exception):
+    ''' Raised when an archive goes beyond some extraction limit '''
+
+
+def member_path(directory: str, member: str) -> Union[str, None]:
+    ''' Return where an archive member is extracted to, sanitizing its name
+        the same way ZipFile.extract does. None means nothing to extract. '''
+
+    arcname = member.replace('/', os.path.sep)
+    if os.path.altsep:
+        arcname = arcname.replace(os.path.altsep, os.path.sep)
+
+    # drop drive letters, absolute paths and any reference to parent dirs
+    arcname = os.path.splitdrive(arcname)[1]
+    invalid = ('', os.path.curdir, os.path.pardir)
+    parts = [part for part in arcname.split(os.path.sep) if part not in invalid]
+    if not parts:
+        return None
+    return os.path.join(directory, *parts)
+
+
+def member_paths(path: str, max_depth: int = DEFAULT_LIMITS['max_depth']) -> List[str]:
+    ''' Return where every member of the archive on path is extracted to,
+        along with the members of nested archives up to max_depth, without
+        writing anything. Nested archives are read from their parent, as
+        they may be gone or half written on disk. '''
+
+    def list_members(source, directory: str, depth: int) -> List[str]:
+        paths = []
+        with zipfile.ZipFile(source) as zip_reader:
+            for info in zip_reader.infolist():
+                target = None if info.is_dir() else member_path(directory, info.filename)
+                if target is None:
+                    continue
+                paths.append(target)
+
+                if depth >= max_depth:
+                    continue
+                with zip_reader.open(info) as member:
+                    if member.read(4) != b'PK\x03\x04':
+                        continue
+                try:
+                    with zip_reader.open(info) as member:
+                        paths.extend(list_members(member, os.path.dirname(target), depth + 1))
+                except zipfile.BadZipFile as error:
+                    logging.debug('unable to list nested zip %s: %s', target, error)
+        return paths
+
+    return list_members(path, os.path.dirname(path), 1)
+
+
+class Extraction:
+    ''' State of the extraction of one archive and all its nested archives.
+
+        Limits are shared by the whole tree of archives, so a small archive
+        holding many big ones is stopped as soon as the total is reached. '''
+
+    def __init__(self,
+                 claim: callable = None,
+                 flush_nested: bool = True,
+                 skip: callable = None,
+                 **limits):
+        self.claim = claim
+        self.skip = skip
+        self.flush_nested = flush_nested
+        self.limits = {**DEFAULT_LIMITS, **{key: value for key, value in limits.items()
+                                            if value is not None}}
+        self.total_bytes = self.total_members = 0
+        self._lock = threading.Lock()
+        self._aborted = threading.Event()
+
+    def _account_members(self, count: int) -> None:
+        with self._lock:
+            self.total_members += count
+            if self.total_members > self.limits['max_members']:
+                raise ExtractionError(f'too many members: {self.total_members}')
+
+    def _account_bytes(self, count: int) -> None:
+        with self._lock:
+            self.total_bytes += count
+            if self.total_bytes > self.limits['max_bytes']:
+                raise ExtractionError(f'too many bytes: {self.total_bytes}')
+
+    def _copy_member(self, reader: zipfile.ZipExtFile, writer, info: zipfile.ZipInfo) -> None:
+        buffer = bytearray(self.limits['buffer_size'])
+        view, written = memoryview(buffer), 0
+        while True:
+            if self._aborted.is_set():
+                raise ExtractionError('extraction aborted')
+
+            size = reader.readinto(buffer)
+            if not size:
+                return
+
+            writer.write(view[:size])
+            written += size
+            self._account_bytes(size)
+
+            if (written > RATIO_THRESHOLD
+                    and written / max(info.compress_size, 1) > self.limits['max_ratio']):
+                raise ExtractionError(f'compression ratio too high: {info.filename}')
+
+    def _extract_member(self, zip_reader: zipfile.ZipFile, info: zipfile.ZipInfo,
+                        target: str) -> str:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            with tracing.span('member', 'extract', path=target), \
+                    zip_reader.open(info) as reader, open(target, 'wb') as writer:
+                self._copy_member(reader, writer, info)
+        except BaseException:
+            if os.path.exists(target):
+                os.unlink(target)
+            raise
+
+        logging.debug('extracted member: %s', target)
+        return target
+
+    def _submit_archive(self,
+                        executor: futures.Executor,
+                        path: str,
+                        depth: int) -> list:
+        ''' Schedule every member of archive, returning (future, depth) pairs '''
+
+        directory = os.path.dirname(path)
+        zip_reader = zipfile.ZipFile(path)
+        try:
+            infos = [info for info in zip_reader.infolist() if not info.is_dir()]
+            self._account_members(len(infos))
+
+            # fail fast on what the central directory already tells
+            declared = sum(info.file_size for info in infos)
+            if self.total_bytes + declared > self.limits['max_bytes']:
+                raise ExtractionError(f'declared size too big: {declared} bytes')
+        except BaseException:
+            zip_reader.close()
+            raise
+
+        submitted = []
+        for info in infos:
+            target = member_path(directory, info.filename)
+            if target is None:
+                continue
+
+            if self.skip is not None and self.skip(target):
+                logging.debug('skipping member: %s', target)
+                continue
+
+            if self.claim is not None:
+                self.claim(target)
+            future = executor.submit(self._extract_member, zip_reader, info, target)
+            submitted.append((future, depth))
+
+        # the reader is closed once all its members are done
+        remaining = [len(submitted)]
+        remaining_lock = threading.Lock()
+
+        def release(_):
+            with remaining_lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    zip_reader.close()
+
+        if submitted:
+            for future, _ in submitted:
+                future.add_done_callback(release)
+        else:
+            zip_reader.close()
+        return submitted
+
+    def _is_nested_archive(self, path: str, depth: int) -> bool:
+        return (depth < self.limits['max_depth']
+                and mimesniff.sniff(path) == 'application/zip')
+
+    def run(self, path: str) -> Generator:
+        ''' Yield extracted files while they are written, descending into
+            nested archives up to the maximum depth '''
+
+        logging.debug('extracting zip file: %s', path)
+        with futures.ThreadPoolExecutor(max_workers=self.limits['workers'],
+                                        thread_name_prefix='unzip') as executor:
+            pending = dict(self._submit_archive(executor, path, 1))
+            try:
+                while pending:
+                    done, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                    for future in done:
+                        depth = pending.pop(future)
+                        member = future.result()
+
+                        if not self._is_nested_archive(member, depth):
+                            yield member
+                            continue
+
+                        logging.debug('extracting nested zip file: %s', member)
+                        try:
+                            pending.update(self._submit_archive(executor, member, depth + 1))
+                        except zipfile.BadZipFile as error:
+                            logging.warning('keeping unreadable nested zip %s: %s',
+                                            member, error)
+                            yield member
+                            continue
+
+                        if self.flush_nested:
+                            os.unlink(member)
+                        else:
+                            yield member
+            except BaseException:
+                self._aborted.set()
+                for future in pending:
+                    future.cancel()
+                raise
+
+
+def extract_archive(path: str,
+                    claim: callable = None,
+                    flush_nested: bool = True,
+                    skip: callable = None,
+                    **limits) -> Generator:
+    ''' Extract archive on path next to it, yielding each extracted file once
+        it is completely written. Members for which skip is true are left
+        out. Raise ExtractionError when some limit is crossed. '''
+
+    yield from Extraction(claim=claim, flush_nested=flush_nested, skip=skip,
+                          **limits).run(path)
@@ -0,0 +1,104 @@
+'''
+On-disk index of files seen by previous runs, used to skip unchanged files.
+'''
+
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+
+from typing import (
+    Dict,
+    List,
+    Tuple,
+    Union,
+    Iterable,
+)
+
+
+# states which mean there is nothing left to do for an unchanged file
+SETTLED_STATES = ('ignored', 'done', 'output')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    service TEXT,
+    state TEXT NOT NULL,
+    updated REAL NOT NULL
+)
+'''
+
+
+class FileIndex:
+    ''' Remember the classification and processing state of every file keyed by
+        path, inode, size and modification time.
+
+        States are: ignored (no service wants it), pending (scheduled), done,
+        failed and output (a trusted file produced by some service). '''
+
+    def __init__(self, db_path: str):
+        self.db_path = os.path.expanduser(db_path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute(SCHEMA)
+        self._conn.commit()
+
+    def close(self) -> None:
+        ''' Release the database '''
+
+        with self._lock:
+            self._conn.close()
+
+    def snapshot(self, directory: str) -> Dict[str, Tuple[int, int, int, str]]:
+        ''' Return (inode, size, mtime, state) of every known file under directory '''
+
+        prefix = os.path.join(os.path.abspath(directory), '')
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT path, inode, size, mtime_ns, state FROM files '
+                'WHERE substr(path, 1, ?) = ?', (len(prefix), prefix)).fetchall()
+        return {path: tuple(row) for path, *row in rows}
+
+    @staticmethod
+    def is_unchanged(known: Union[None, tuple], stat: os.stat_result) -> bool:
+        ''' Whether a file matching stat was settled by a previous run '''
+
+        if known is None:
+            return False
+        inode, size, mtime_ns, state = known
+        return (state in SETTLED_STATES
+                and (inode, size, mtime_ns) == (stat.st_ino, stat.st_size, stat.st_mtime_ns))
+
+    def record_many(self, records: Iterable[Tuple[str, Union[str, None], str]]) -> None:
+        ''' Store (path, service, state) records, forgetting vanished paths '''
+
+        updates, removals, now = [], [], time.time()
+        for path, service, state in records:
+            path = os.path.abspath(path)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                removals.append((path,))
+                continue
+            updates.append((path, stat.st_ino, stat.st_size, stat.st_mtime_ns,
+                            service, state, now))
+
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                   updates)
+            self._conn.executemany('DELETE FROM files WHERE path = ?', removals)
+        logging.debug('index updated: %d removed: %d', len(updates), len(removals))
+
+    def forget(self, paths: List[str]) -> None:
+        ''' Remove paths from the index '''
+
+        with self._lock, self._conn:
+            self._conn.executemany('DELETE FROM files WHERE path = ?',
+                                   [(os.path.abspath(path),) for path in paths])
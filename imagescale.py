@@ -0,0 +1,75 @@
+'''
+Downscaling of images above a pixel count before they are converted, as
+the conversion cost grows with the pixels.
+
+The UNTRUSTED image is never decoded in this qube: it is streamed to the
+downscale command, by default ImageMagick in a disposable qube, and what
+comes back is just as UNTRUSTED and converted as usual. Only the header
+is read here, to tell the image size.
+'''
+
+
+import os
+import shlex
+import shutil
+import logging
+import tempfile
+import subprocess
+
+import estimate
+
+
+from typing import (
+    List,
+)
+
+
+# reads the image on stdin and writes it back on stdout, in the same format;
+# {pixels}@ caps the area and > never enlarges, see ImageMagick geometry
+DOWNSCALE_COMMAND = "qvm-run-vm --dispvm 'convert - -resize {pixels}@> -'"
+
+
+class ScaleError(Exception):
+    ''' Raised when an image could not be downscaled '''
+
+
+def is_oversized(path: str, max_pixels: int) -> bool:
+    ''' Tell whether the image on path has more than max_pixels pixels, as
+        read from its header. Unreadable headers are left alone. '''
+
+    size = estimate.image_size(path)
+    return size is not None and size[0] * size[1] > max_pixels
+
+
+def expand(command: str, **values) -> List[str]:
+    ''' Return the arguments of command filled with values '''
+
+    return [word.format(**values) for word in shlex.split(command)]
+
+
+def downscale(path: str, max_pixels: int, command: str = DOWNSCALE_COMMAND,
+              timeout: float = None) -> str:
+    ''' Write a copy of the image on path with at most max_pixels pixels to
+        a temporary directory, keeping its name, by piping the image through
+        command. Return the copy, which is removed with discard. '''
+
+    workdir = tempfile.mkdtemp(prefix='usync-scale-')
+    scaled = os.path.join(workdir, os.path.basename(path))
+    try:
+        arguments = expand(command, pixels=max_pixels)
+        logging.debug('executing command: %s', arguments)
+        with open(path, 'rb') as reader, open(scaled, 'wb') as writer:
+            subprocess.run(arguments, check=True, stdin=reader, stdout=writer,
+                           timeout=timeout)
+        if not os.path.getsize(scaled):
+            raise ScaleError('nothing was written')
+    except (KeyError, OSError, subprocess.SubprocessError, ScaleError) as error:
+        shutil.rmtree(workdir, ignore_errors=True)
+        raise ScaleError(f'{command} failed: {error!r}') from error
+    return scaled
+
+
+def discard(scaled: str) -> None:
+    ''' Remove a copy written by downscale '''
+
+    shutil.rmtree(os.path.dirname(scaled), ignore_errors=True)
@@ -0,0 +1,149 @@
+'''
+Append-only journal of the state of every file of a run, written through to
+disk so an interrupted run can be resumed.
+'''
+
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+
+from typing import (
+    Dict,
+    List,
+)
+
+
+STATES = ('extracting', 'extracted', 'converting', 'converted', 'moved', 'failed')
+
+# states after which nothing is left to do for a file
+FINAL_STATES = ('extracted', 'moved')
+
+# journals of runs not touched for this long are removed
+MAX_AGE = 30 * 24 * 3600
+
+
+def journal_path(directory: str, journals_dir: str) -> str:
+    ''' Return the journal of runs on directory '''
+
+    digest = hashlib.sha256(os.path.realpath(directory).encode()).hexdigest()[:16]
+    return os.path.join(os.path.expanduser(journals_dir), f'{digest}.jsonl')
+
+
+def prune(journals_dir: str, max_age: float = MAX_AGE) -> None:
+    ''' Remove journals of runs older than max_age seconds '''
+
+    journals_dir = os.path.expanduser(journals_dir)
+    try:
+        names = os.listdir(journals_dir)
+    except FileNotFoundError:
+        return
+
+    limit = time.time() - max_age
+    for name in names:
+        path = os.path.join(journals_dir, name)
+        try:
+            if os.stat(path).st_mtime < limit:
+                logging.debug('removing old journal: %s', path)
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+class Journal:
+    ''' Record state transitions of files as JSON lines, each one flushed and
+        fsync'd before the work it describes goes on.
+
+        When resuming, the entries of the previous run are replayed first:
+        files in a final state are settled, files with any other state were
+        in flight when the run stopped and have to be done again. Otherwise
+        the journal starts empty. '''
+
+    def __init__(self, path: str, resume: bool = False, sync: bool = True):
+        self.path = os.path.expanduser(path)
+        self.sync = sync
+        self.previous: Dict[str, dict] = self.replay(self.path) if resume else {}
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._writer = open(self.path, 'a' if resume else 'w')
+        self._sync_directory()
+
+    def _sync_directory(self) -> None:
+        if not self.sync:
+            return
+        fd = os.open(os.path.dirname(self.path) or '.', os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def replay(path: str) -> Dict[str, dict]:
+        ''' Return the last state of every file in the journal on path, along
+            with the details recorded about it. A line torn by a crash ends
+            the replay. '''
+
+        files: Dict[str, dict] = {}
+        try:
+            with open(path) as reader:
+                for number, line in enumerate(reader, start=1):
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        logging.warning('journal %s is torn on line %d', path, number)
+                        break
+
+                    current = files.setdefault(entry.pop('path'), {})
+                    current.update(entry)
+                    if entry['state'] in FINAL_STATES:
+                        current['settled'] = True
+        except FileNotFoundError:
+            pass
+        return files
+
+    def record(self, path: str, state: str, **details) -> None:
+        ''' Append a state transition of path and wait for it to be on disk '''
+
+        if state not in STATES:
+            raise ValueError(f'unknown journal state: {state}')
+
+        line = json.dumps({'path': os.path.abspath(path), 'state': state,
+                           'time': round(time.time(), 3), **details})
+        with self._lock:
+            self._writer.write(line + '\n')
+            self._writer.flush()
+            if self.sync:
+                os.fsync(self._writer.fileno())
+
+    def is_settled(self, path: str) -> bool:
+        ''' Tell whether the previous run was done with path '''
+
+        return self.previous.get(os.path.abspath(path), {}).get('settled', False)
+
+    def settled(self) -> List[str]:
+        ''' Return the files the previous run was done with, and their outputs '''
+
+        paths = []
+        for path, entry in self.previous.items():
+            if entry.get('settled'):
+                paths.append(path)
+                if entry.get('output'):
+                    paths.append(entry['output'])
+        return paths
+
+    def in_flight(self) -> Dict[str, dict]:
+        ''' Return the files the previous run stopped in the middle of '''
+
+        return {path: entry for path, entry in self.previous.items()
+                if not entry.get('settled') and entry['state'] != 'failed'}
+
+    def close(self) -> None:
+        ''' Close the journal file '''
+
+        with self._lock:
+            self._writer.close()
@@ -0,0 +1,180 @@
+'''
+In-process mime type detection based on file signatures.
+
+Only the types routed by preprocess are recognized here, everything else is
+resolved by a single batched call to file(1).
+'''
+
+
+import shlex
+import struct
+import logging
+import subprocess
+
+
+from typing import (
+    Dict,
+    List,
+    Union,
+    Iterable,
+)
+
+
+FILE_BINARY = '/usr/bin/file'
+
+# enough to hold the signatures below and the first zip member name
+HEADER_SIZE = 512
+
+ZIP_LOCAL_HEADER = struct.Struct('<4s22xHH')
+
+# first zip members which file(1) uses to tell apart documents, packages and
+# other zip based formats from plain archives
+ZIP_CONTAINER_MEMBERS = (
+    b'mimetype',
+    b'[Content_Types].xml',
+    b'_rels/',
+    b'docProps/',
+    b'word/',
+    b'xl/',
+    b'ppt/',
+    b'META-INF/',
+    b'AndroidManifest.xml',
+    b'classes.dex',
+)
+
+
+def sniff_pdf(header: bytes) -> Union[str, None]:
+    ''' Identify pdf documents '''
+
+    if header.startswith(b'%PDF-'):
+        return 'application/pdf'
+    return None
+
+
+def sniff_png(header: bytes) -> Union[str, None]:
+    ''' Identify png images, file(1) requires the IHDR chunk to be present '''
+
+    if header.startswith(b'\x89PNG\r\n\x1a\n') and header[12:16] == b'IHDR':
+        return 'image/png'
+    return None
+
+
+def sniff_jpeg(header: bytes) -> Union[str, None]:
+    ''' Identify jpeg images '''
+
+    if len(header) > 3 and header.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    return None
+
+
+def sniff_gif(header: bytes) -> Union[str, None]:
+    ''' Identify gif images '''
+
+    if header[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    return None
+
+
+def sniff_zip(header: bytes) -> Union[str, None]:
+    ''' Identify plain zip archives.
+
+        Zip based formats, like office documents and java archives, are left
+        unidentified so file(1) gets the final word on them. '''
+
+    if header.startswith(b'PK\x05\x06') and len(header) >= 22:
+        # empty archive, only the end of central directory record
+        return 'application/zip'
+
+    if not header.startswith(b'PK\x03\x04') or len(header) < ZIP_LOCAL_HEADER.size:
+        return None
+
+    _, name_size, _ = ZIP_LOCAL_HEADER.unpack_from(header)
+    name = header[ZIP_LOCAL_HEADER.size:ZIP_LOCAL_HEADER.size + name_size]
+    if not name or len(name) < name_size:
+        return None
+
+    if any(name.startswith(member) for member in ZIP_CONTAINER_MEMBERS):
+        return None
+    return 'application/zip'
+
+
+SNIFFERS = (
+    sniff_pdf,
+    sniff_png,
+    sniff_jpeg,
+    sniff_gif,
+    sniff_zip,
+)
+
+
+def sniff_header(header: bytes) -> Union[str, None]:
+    ''' Return the mime type matching header, when known '''
+
+    if not header:
+        return 'inode/x-empty'
+
+    for sniffer in SNIFFERS:
+        mimetype = sniffer(header)
+        if mimetype is not None:
+            return mimetype
+    return None
+
+
+def sniff(path: str) -> Union[str, None]:
+    ''' Return the mime type of path reading only its header. Unknown files
+        results in None. '''
+
+    try:
+        with open(path, 'rb') as reader:
+            header = reader.read(HEADER_SIZE)
+    except OSError as error:
+        logging.debug('unable to read header of: %s error: %s', path, error)
+        return None
+    return sniff_header(header)
+
+
+def file_mimetype(path: str) -> str:
+    ''' Return the mime type of a single file using file(1) '''
+
+    command = f'{FILE_BINARY} --brief --mime-type {shlex.quote(path)}'
+    logging.debug('executing command: %s', command)
+    return subprocess.check_output(shlex.split(command)).decode().strip()
+
+
+def file_mimetypes(paths: List[str]) -> Dict[str, str]:
+    ''' Return the mime type of many files using a single file(1) process '''
+
+    if not paths:
+        return {}
+
+    # names are sent one per line, so the odd ones are asked one by one
+    batch = [path for path in paths if '\n' not in path]
+    result = {path: file_mimetype(path) for path in paths if '\n' in path}
+
+    if batch:
+        command = [FILE_BINARY, '--brief', '--mime-type', '--files-from', '-']
+        logging.debug('executing command: %s with %d files', command, len(batch))
+        output = subprocess.run(command,
+                                input='\n'.join(batch).encode(),
+                                stdout=subprocess.PIPE,
+                                check=True).stdout.decode()
+        result.update(zip(batch, output.splitlines()))
+    return result
+
+
+def detect(paths: Iterable[str]) -> Dict[str, str]:
+    ''' Return the mime type of every path, sniffing headers in process and
+        falling back to file(1) only for unidentified files '''
+
+    result, unknowns = {}, []
+    for path in paths:
+        mimetype = sniff(path)
+        if mimetype is None:
+            unknowns.append(path)
+        else:
+            result[path] = mimetype
+
+    if unknowns:
+        logging.debug('unidentified files by signature: %d', len(unknowns))
+        result.update(file_mimetypes(unknowns))
+    return result
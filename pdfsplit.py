@@ -0,0 +1,126 @@
+'''
+Splitting of large pdfs in page range chunks converted in parallel, and
+merging of their TRUSTED outputs back into a single document.
+
+The UNTRUSTED pdf is never parsed in this qube: it is streamed to the split
+command, by default qpdf in a disposable qube, and the chunks that come back
+are just as UNTRUSTED and converted as usual. Only the TRUSTED outputs of
+the converter are merged here.
+'''
+
+
+import os
+import shlex
+import logging
+import tempfile
+import subprocess
+
+import estimate
+
+
+from typing import (
+    List,
+    Tuple,
+)
+
+
+# least pages of a pdf worth splitting, and pages of each chunk
+SPLIT_PAGES = 200
+CHUNK_PAGES = 50
+
+# commands are split like a shell does, then each word is formatted; the
+# word {inputs} stands for every input, in order. The split command reads
+# the pdf on stdin and writes the chunk on stdout, qpdf needs a real file.
+SPLIT_COMMAND = ("qvm-run-vm --dispvm "
+                 "'cat > input.pdf && qpdf --empty --pages input.pdf {first}-{last} -- -'")
+MERGE_COMMAND = 'qpdf --empty --pages {inputs} -- {output}'
+
+# tells chunks apart from the files they came from
+CHUNK_MARKER = '.pages-'
+
+
+class SplitError(Exception):
+    ''' Raised when a pdf could not be split or merged '''
+
+
+def is_large(path: str, min_pages: int) -> bool:
+    ''' Tell whether the pdf on path has at least min_pages pages '''
+
+    pages = estimate.pdf_pages(path)
+    return pages is not None and pages >= min_pages
+
+
+def page_ranges(pages: int, chunk_pages: int = CHUNK_PAGES) -> List[Tuple[int, int]]:
+    ''' Return the first and last page, counted from one, of every chunk '''
+
+    return [(first, min(first + chunk_pages - 1, pages))
+            for first in range(1, pages + 1, chunk_pages)]
+
+
+def chunk_path(path: str, directory: str, first: int, last: int) -> str:
+    ''' Return where the chunk with pages first to last of path is written '''
+
+    root, extension = os.path.splitext(os.path.basename(path))
+    return os.path.join(directory, f'{root}{CHUNK_MARKER}{first:04d}-{last:04d}{extension}')
+
+
+def expand(command: str, **values) -> List[str]:
+    ''' Return the arguments of command filled with values '''
+
+    arguments = []
+    for word in shlex.split(command):
+        if word == '{inputs}':
+            arguments.extend(values['inputs'])
+        else:
+            arguments.append(word.format(**values))
+    return arguments
+
+
+def _run(arguments: List[str], timeout: float = None, stdin=subprocess.DEVNULL,
+         stdout=None) -> None:
+    logging.debug('executing command: %s', arguments)
+    try:
+        subprocess.run(arguments, check=True, stdin=stdin, stdout=stdout, timeout=timeout)
+    except (OSError, subprocess.SubprocessError) as error:
+        raise SplitError(f'{arguments[0]} failed: {error}') from error
+
+
+def split(path: str,
+          directory: str,
+          ranges: List[Tuple[int, int]],
+          command: str = SPLIT_COMMAND,
+          timeout: float = None) -> List[str]:
+    ''' Write a chunk of path to directory for each page range, piping path
+        through command, and return them in page order. Each chunk may take
+        up to timeout seconds. '''
+
+    chunks = []
+    for first, last in ranges:
+        chunk = chunk_path(path, directory, first, last)
+        try:
+            arguments = expand(command, first=first, last=last)
+        except KeyError as error:
+            raise SplitError(f'unknown placeholder in {command}: {error}') from error
+        with open(path, 'rb') as reader, open(chunk, 'wb') as writer:
+            _run(arguments, timeout, stdin=reader, stdout=writer)
+        if not os.path.getsize(chunk):
+            raise SplitError(f'pages {first}-{last} of {path} were not written')
+        chunks.append(chunk)
+    return chunks
+
+
+def merge(paths: List[str], output: str, command: str = MERGE_COMMAND,
+          timeout: float = None) -> None:
+    ''' Join paths, in order, into output without ever exposing a partial
+        document '''
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(output) or '.', prefix='.',
+                               suffix=os.path.splitext(output)[1])
+    os.close(fd)
+    try:
+        _run(expand(command, inputs=paths, output=tmp), timeout)
+        os.replace(tmp, output)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
@@ -0,0 +1,572 @@
+'''
+Streaming execution of services over a single walk of the tree.
+'''
+
+
+import os
+import time
+import queue
+import logging
+import threading
+
+import dedup
+import tracing
+import scheduler
+
+
+from typing import (
+    Dict,
+    List,
+    Tuple,
+)
+
+
+# same default as concurrent.futures.ThreadPoolExecutor
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+# jobs waiting to be ordered by cost, when the queue size is not given
+ORDERED_QUEUE_SIZE = 1024
+
+STOP = None
+
+
+class TransientError(Exception):
+    ''' Raised by workers when a job may succeed if run again '''
+
+
+class JobTimeout(TransientError):
+    ''' Raised by workers when a job took too long and was stopped '''
+
+
+def build_scheduler(service_options: dict,
+                    max_workers: int = None,
+                    max_queued: int = None,
+                    budget: int = None,
+                    policy: str = 'fifo',
+                    scheduler_class: type = scheduler.SlotScheduler,
+                    ranked: bool = False) -> scheduler.SlotScheduler:
+    ''' Return the scheduler of the converter services, sized from their
+        options unless max_workers or budget are given. Jobs are expected
+        to be ranked when ranked is set. '''
+
+    converters = {service: options for service, options in service_options.items()
+                  if options['background'] and options['weight']}
+
+    limits = {service: options['executor_kwargs'].get('max_workers')
+              for service, options in converters.items()}
+    threads = sum(limit or DEFAULT_WORKERS for limit in limits.values())
+    if max_workers:
+        threads = min(threads, max_workers)
+
+    if budget is None:
+        budget = sum(options['weight'] for options in converters.values()) or 1
+    else:
+        lightest = min((options['weight'] for options in converters.values()), default=1)
+        threads = min(threads, max(budget // lightest, 1))
+
+    # ordering only helps when enough of the tree is known up front
+    if max_queued is None and (policy != 'fifo' or ranked):
+        max_queued = ORDERED_QUEUE_SIZE
+
+    return scheduler_class(budget,
+                           max_jobs=max_workers,
+                           max_queued=max_queued,
+                           service_limits=limits,
+                           threads=max(threads, 1),
+                           key=scheduler.POLICIES[policy])
+
+
+class Pipeline:
+    ''' Feed files classified by the scan index straight to service workers.
+
+        Converter services, the ones with a weight, share a single scheduler
+        which keeps their jobs within a global budget. Other background
+        services get their own bounded queue consumed by a fixed number of
+        threads. Either way a full queue makes the walk wait for workers.
+        Foreground services run right away on the walking thread. Workers may
+        dispatch more files themselves, like archive members, so the run is
+        over only when the walk is done and no file is left pending.
+
+        Workers may also wait for parts of their file run by another service,
+        like the chunks of a split pdf. Parts get their own options and are
+        scheduled on their own, so no batch can hold them back.
+
+        Services with a batch worker may group small files into a single
+        job. A batch is scheduled once it is full, or once nothing else is
+        left to run.
+
+        Converter jobs failing with a TransientError are scheduled again
+        after an exponential backoff, up to max_retries times.
+
+        When deduplicate is set, copies of a file being converted by a service
+        with a share worker wait for that conversion and get its output
+        instead of being converted again.
+
+        When a journal is given, the start of every conversion and every final
+        failure are recorded on it.
+
+        When slots are given, a scheduler shared with other pipelines, converter
+        jobs run on them so all of these pipelines keep to a single budget. The
+        shared scheduler is started and closed by its owner.
+
+        When priorities are given, converter jobs are ranked by them ahead of
+        the policy, a batch by its best ranked file. The time to the first
+        converted file, and to the first one a rule put ahead, are kept. '''
+
+    scheduler_class = scheduler.SlotScheduler
+
+    def __init__(self,
+                 index,
+                 service_options: dict,
+                 max_workers: int = None,
+                 max_queued: int = None,
+                 budget: int = None,
+                 policy: str = 'fifo',
+                 max_retries: int = 0,
+                 backoff: float = 5.0,
+                 deduplicate: bool = False,
+                 journal=None,
+                 slots: scheduler.SlotScheduler = None,
+                 priorities=None):
+        self.index = index
+        self.index.sink = self.dispatch
+        self.service_options = service_options
+        self.max_queued = max_queued
+        self.stats = {service: {'found': 0, 'done': 0, 'failed': [],
+                                'retries': 0, 'timeouts': 0, 'seconds': 0.0,
+                                'deduplicated': 0}
+                      for service in service_options}
+        self.walking = False
+        self.policy = policy
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.dedup = dedup.Deduplicator() if deduplicate else None
+        self.journal = journal
+        self.priorities = priorities
+        self._ranks: Dict[str, tuple] = {}
+        self.started = None
+        self.first_converted = self.first_useful = None
+        self._attempts: Dict[tuple, int] = {}
+        self._shared_scheduler = slots is not None
+        self.scheduler = slots or self._build_scheduler(max_workers, budget)
+        self._queues: Dict[str, queue.Queue] = {}
+        self._batches: Dict[str, dict] = {}
+        self._held = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+    def _build_scheduler(self, max_workers: int, budget: int) -> scheduler.SlotScheduler:
+        return build_scheduler(self.service_options,
+                               max_workers=max_workers,
+                               max_queued=self.max_queued,
+                               budget=budget,
+                               policy=self.policy,
+                               scheduler_class=self.scheduler_class,
+                               ranked=self.priorities is not None)
+
+    def dispatch(self, service: str, path: str, options: dict = None) -> None:
+        ''' Hand a classified file to its service, or a part of a file to the
+            service run with the given options '''
+
+        if options is not None:
+            self._dispatch_part(service, path, options)
+            return
+
+        options = self.service_options[service]
+
+        # trusted outputs show up in the tree while it is still being walked
+        output = options.get('output')
+        if output is not None:
+            self.index.claim(output(path))
+
+        with self._lock:
+            self.stats[service]['found'] += 1
+            self._pending += 1
+
+        if not options['background']:
+            self.process(service, path)
+        elif options['weight']:
+            # copies waiting for another conversion count as converted too
+            self._rank(service, [path])
+            if self._follows(service, path):
+                return
+
+            # reading headers is wasted when jobs run in walk order
+            cost = options['cost'](path) if self.policy != 'fifo' else 0
+            if self._batch_files(options) > 1:
+                self._add_to_batch(service, path, cost)
+                return
+
+            logging.debug('scheduling %s file: %s cost: %.1f', service, path, cost)
+            self._submit(self._job(service, [path], cost))
+        else:
+            logging.debug('queueing %s file: %s', service, path)
+            self._queues[service].put(path)
+
+    def _dispatch_part(self, service: str, path: str, options: dict) -> None:
+        ''' Schedule a part of a file, which a worker waits for. Parts are
+            never batched nor deduplicated, so they can not be held back,
+            and are left out of the stats. '''
+
+        output = options.get('output')
+        if output is not None:
+            self.index.claim(output(path))
+
+        with self._lock:
+            self._pending += 1
+
+        if not options['weight']:
+            self.process_part(service, path, options)
+            return
+
+        cost = options['cost'](path) if self.policy != 'fifo' else 0
+        logging.debug('scheduling %s part: %s cost: %.1f', service, path, cost)
+        self._submit(self._part_job(service, path, options, cost))
+
+    def _follows(self, service: str, path: str) -> bool:
+        ''' Tell whether path is a copy waiting for another conversion '''
+
+        if self.dedup is None or self.service_options[service].get('share_worker') is None:
+            return False
+
+        with tracing.span('hash', 'dedup', path=path):
+            leader = self.dedup.add(service, path)
+        if leader is None:
+            return False
+
+        logging.debug('%s file: %s waits for its copy: %s', service, path, leader)
+        return True
+
+    def _share(self, service: str, source: str, paths: List[str]) -> None:
+        ''' Give paths the output converted from source, their copy '''
+
+        options = self.service_options[service]
+        for path in paths:
+            # its output is journaled like a conversion, resuming skips it
+            self._started(service, [path])
+            result, error = False, None
+            try:
+                with tracing.span('share', 'dedup', path=path):
+                    result = options['share_worker'](source, path, options)
+            except Exception as exception:  # pylint: disable=broad-except
+                error = exception
+
+            if result:
+                with self._lock:
+                    self.stats[service]['deduplicated'] += 1
+            self._record(service, [path], [result], error)
+
+    def _settle(self, service: str, paths: List[str], results: List[bool]) -> None:
+        ''' Hand the outcome of paths to the copies waiting for them '''
+
+        for path, success in zip(paths, results):
+            followers, promoted = self.dedup.finish(service, path, success)
+            if followers:
+                self._share(service, path, followers)
+            if promoted is not None:
+                logging.debug('%s failed, converting its copy: %s', path, promoted)
+                options = self.service_options[service]
+                cost = options['cost'](promoted) if self.policy != 'fifo' else 0
+                # a worker must not wait for room on the queue it feeds
+                threading.Thread(target=self._submit,
+                                 args=(self._job(service, [promoted], cost),),
+                                 daemon=True).start()
+
+    @staticmethod
+    def _batch_files(options: dict) -> int:
+        if options['batch_worker'] is None:
+            return 1
+        return options['executor_kwargs'].get('batch_files') or 1
+
+    def _add_to_batch(self, service: str, path: str, cost: float) -> None:
+        options = self.service_options[service]
+        max_bytes = options['executor_kwargs'].get('batch_bytes')
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            size = 0
+
+        if max_bytes and size > max_bytes:
+            logging.debug('scheduling %s file alone: %s', service, path)
+            self._submit(self._job(service, [path], cost))
+            return
+
+        full = []
+        with self._lock:
+            batch = self._batches.setdefault(service, {'paths': [], 'bytes': 0, 'cost': 0})
+            if max_bytes and batch['paths'] and batch['bytes'] + size > max_bytes:
+                full.append(self._pop_batch(service))
+                batch = self._batches.setdefault(service, {'paths': [], 'bytes': 0, 'cost': 0})
+
+            batch['paths'].append(path)
+            batch['bytes'] += size
+            batch['cost'] += cost
+            self._held += 1
+            if len(batch['paths']) >= self._batch_files(options):
+                full.append(self._pop_batch(service))
+
+        for batch in full:
+            self._submit_batch(service, batch)
+
+    def _pop_batch(self, service: str) -> dict:
+        batch = self._batches.pop(service)
+        self._held -= len(batch['paths'])
+        return batch
+
+    def _submit_batch(self, service: str, batch: dict) -> None:
+        logging.debug('scheduling batch of %d %s files', len(batch['paths']), service)
+        self._submit(self._job(service, batch['paths'], batch['cost'], batch=True))
+
+    def _rank(self, service: str, paths: List[str]) -> tuple:
+        if self.priorities is None:
+            return scheduler.NO_RANK
+
+        # ranked once, as converted files are moved away
+        ranks = []
+        for path in paths:
+            rank = self._ranks.get(path)
+            if rank is None:
+                rank = self._ranks[path] = self.priorities.rank(service, path)
+            ranks.append(rank)
+        return min(ranks)
+
+    def _job(self, service: str, paths: List[str], cost: float,
+             batch: bool = False) -> scheduler.Job:
+        weight = self.service_options[service]['weight']
+        rank = self._rank(service, paths)
+        if batch:
+            return scheduler.Job(service, weight, self.process_batch, service, paths,
+                                 cost=cost, rank=rank)
+        return scheduler.Job(service, weight, self.process, service, paths[0],
+                             cost=cost, rank=rank)
+
+    def _part_job(self, service: str, path: str, options: dict,
+                  cost: float) -> scheduler.Job:
+        return scheduler.Job(service, options['weight'], self.process_part, service, path,
+                             options, cost=cost, rank=self._rank(service, [path]))
+
+    def _submit(self, job: scheduler.Job) -> None:
+        self.scheduler.submit(job)
+
+    def process(self, service: str, path: str) -> bool:
+        ''' Run the service worker on path keeping track of its outcome '''
+
+        options = self.service_options[service]
+        return self._track(service, [path], False,
+                           lambda: [options['worker'](path, options)])[0]
+
+    def process_batch(self, service: str, paths: List[str]) -> List[bool]:
+        ''' Run the service batch worker on paths keeping track of the
+            outcome of each one '''
+
+        options = self.service_options[service]
+        return self._track(service, paths, True,
+                           lambda: options['batch_worker'](paths, options))
+
+    def process_part(self, service: str, path: str, options: dict) -> bool:
+        ''' Run the worker of options on a part of a file. Only the worker
+            waiting for the part is told how it went. '''
+
+        output = options.get('output')
+        run_journal = options.get('journal')
+        if run_journal is not None:
+            run_journal.record(path, 'converting', service=service,
+                               output=os.path.abspath(output(path)) if output else None)
+
+        result = False
+        try:
+            with tracing.span(service, 'run', paths=[path]):
+                result = bool(options['worker'](path, options))
+        except Exception as error:  # pylint: disable=broad-except
+            logging.error('%s exited with: %s', path, error)
+
+        try:
+            self.index.finish(service, [path], [] if result else [path])
+        finally:
+            with self._lock:
+                self._ranks.pop(path, None)
+                self._pending -= 1
+                self._idle.notify_all()
+        return result
+
+    def _started(self, service: str, paths: List[str]) -> None:
+        options = self.service_options[service]
+        if self.journal is None or not options['weight']:
+            return
+
+        output = options.get('output')
+        for path in paths:
+            self.journal.record(path, 'converting', service=service,
+                                output=os.path.abspath(output(path)) if output else None)
+
+    def _track(self, service: str, paths: List[str], batch: bool,
+               call: callable) -> List[bool]:
+        self._started(service, paths)
+        results, error = [False] * len(paths), None
+        start = time.perf_counter()
+        try:
+            with tracing.span(service, 'run', paths=paths):
+                results = list(call())
+        except Exception as exception:  # pylint: disable=broad-except
+            error = exception
+
+        self._conclude(service, paths, batch, results, error,
+                       elapsed=time.perf_counter() - start)
+        return results
+
+    def _conclude(self, service: str, paths: List[str], batch: bool,
+                  results: List[bool], error: Exception = None,
+                  elapsed: float = 0.0) -> None:
+        with self._lock:
+            self.stats[service]['seconds'] += elapsed
+            if isinstance(error, JobTimeout):
+                self.stats[service]['timeouts'] += 1
+
+        if isinstance(error, TransientError) and self._retry(service, paths, batch, error):
+            return
+        self._record(service, paths, results, error)
+        if self.dedup is not None:
+            self._settle(service, paths, results)
+
+    def _retry(self, service: str, paths: List[str], batch: bool, error: Exception) -> bool:
+        ''' Schedule a failed job again later, unless it is out of attempts '''
+
+        options = self.service_options[service]
+        if not options['background'] or not options['weight']:
+            return False
+
+        key = (service, tuple(paths))
+        with self._lock:
+            attempt = self._attempts.get(key, 0) + 1
+            if attempt > self.max_retries:
+                return False
+            self._attempts[key] = attempt
+            self.stats[service]['retries'] += 1
+
+        delay = self.backoff * 2 ** (attempt - 1)
+        logging.warning('%s failed with: %s, retrying in %.1fs (%d of %d)',
+                        paths[0] if len(paths) == 1 else f'batch of {len(paths)} files',
+                        error, delay, attempt, self.max_retries)
+
+        cost = sum(options['cost'](path) for path in paths) if self.policy != 'fifo' else 0
+        timer = threading.Timer(delay, self._submit,
+                                args=(self._job(service, paths, cost, batch=batch),))
+        timer.daemon = True
+        timer.start()
+        return True
+
+    def _record(self, service: str, paths: List[str], results: List[bool],
+                error: Exception = None) -> None:
+        name = paths[0] if len(paths) == 1 else f'batch of {len(paths)} files'
+        if error:
+            logging.error('%s exited with: %s', name, error)
+        else:
+            logging.debug('%s resulted in: %s', name, results)
+
+        failed = [path for path, success in zip(paths, results) if not success]
+        ranks = [self._ranks.pop(path, scheduler.NO_RANK) for path in paths]
+        if len(failed) < len(paths) and self.service_options[service]['weight']:
+            self._note_converted([rank for rank, success in zip(ranks, results) if success])
+        if self.journal is not None:
+            for path in failed:
+                self.journal.record(path, 'failed', service=service)
+        try:
+            self.index.finish(service, paths, failed)
+        finally:
+            with self._lock:
+                stats = self.stats[service]
+                stats['done'] += len(paths)
+                stats['failed'].extend(failed)
+                status = f'{stats["done"]}/{stats["found"]}{"+" if self.walking else ""}'
+                self._pending -= len(paths)
+                self._idle.notify_all()
+
+        for path, success in zip(paths, results):
+            logging.info('fineshed: %s success: %s status: %s', path, success, status)
+
+    def _note_converted(self, ranks: List[tuple]) -> None:
+        ''' Keep the time to the first converted file and to the first useful
+            one, which a rule put ahead of the others '''
+
+        if self.started is None or self.first_useful is not None:
+            return
+
+        elapsed = time.perf_counter() - self.started
+        useful = self.priorities is not None and any(
+            self.priorities.is_useful(rank) for rank in ranks)
+        with self._lock:
+            if self.first_converted is None:
+                self.first_converted = elapsed
+            if useful and self.first_useful is None:
+                self.first_useful = elapsed
+
+    def _consume(self, service: str) -> None:
+        work_queue = self._queues[service]
+        while True:
+            path = work_queue.get()
+            if path is STOP:
+                return
+            self.process(service, path)
+
+    def _start_workers(self) -> List[Tuple[str, threading.Thread]]:
+        workers = []
+        for service, options in self.service_options.items():
+            if not options['background'] or options['weight']:
+                continue
+
+            count = options['executor_kwargs'].get('max_workers') or DEFAULT_WORKERS
+            self._queues[service] = queue.Queue(maxsize=self.max_queued or count * 2)
+            for number in range(count):
+                thread = threading.Thread(target=self._consume,
+                                          args=(service,),
+                                          name=f'{service}-{number}',
+                                          daemon=True)
+                thread.start()
+                workers.append((service, thread))
+        return workers
+
+    def _drain(self) -> None:
+        ''' Wait for pending files, scheduling open batches whenever they are
+            the only thing left, as no more files would join them '''
+
+        while True:
+            with self._idle:
+                self._idle.wait_for(lambda: self._pending == self._held)
+                if self._pending == 0:
+                    return
+                batches = [(service, self._pop_batch(service))
+                           for service in list(self._batches)]
+
+            for service, batch in batches:
+                self._submit_batch(service, batch)
+
+    def run(self, directory: str) -> Dict[str, Tuple[int, List[str]]]:
+        ''' Walk directory processing files while they are found. Return the
+            number of files and the failed ones for each service. '''
+
+        workers = self._start_workers()
+        if not self._shared_scheduler:
+            self.scheduler.start()
+        self.started = time.perf_counter()
+        self.walking = True
+        try:
+            self.index.walk(directory)
+            logging.debug('walk done, waiting for pending files')
+            self._drain()
+        finally:
+            self.walking = False
+            for service, _ in workers:
+                self._queues[service].put(STOP)
+            if not self._shared_scheduler:
+                self.scheduler.close()
+            for _, thread in workers:
+                thread.join()
+
+        return self.summary()
+
+    def summary(self) -> Dict[str, Tuple[int, List[str]]]:
+        ''' Return the number of files and the failed ones for each service '''
+
+        return {service: (stats['found'], stats['failed'])
+                for service, stats in self.stats.items()}
@@ -0,0 +1,202 @@
+'''
+Placement of files using the cheapest primitive the filesystems allow:
+rename, reflink, in-kernel copy and, as a last resort, a buffered copy.
+'''
+
+
+import os
+import errno
+import fcntl
+import shutil
+import logging
+import tempfile
+import threading
+import collections
+
+
+from typing import (
+    Tuple,
+    Union,
+)
+
+
+# ioctl sharing the extents of a file with another, from linux/fs.h
+FICLONE = 0x40049409
+
+# primitives able to copy data, from the cheapest
+COPY_METHODS = ('reflink', 'copy_file_range', 'sendfile', 'buffered')
+
+LINK_MODES = ('reflink', 'hardlink', 'copy')
+
+BUFFER_SIZE = 1024 * 1024
+
+# errors telling a primitive is not available for some pair of files
+UNSUPPORTED = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL,
+               errno.ENOSYS, errno.ENOTTY, errno.EPERM, errno.EBADF}
+
+_lock = threading.Lock()
+placed = collections.Counter()
+
+
+def _count(method: str) -> str:
+    with _lock:
+        placed[method] += 1
+    return method
+
+
+def _reflink(reader, writer, _) -> None:
+    fcntl.ioctl(writer.fileno(), FICLONE, reader.fileno())
+
+
+def _copy_file_range(reader, writer, size: int) -> None:
+    copied = 0
+    while copied < size:
+        count = os.copy_file_range(reader.fileno(), writer.fileno(), size - copied)
+        if count == 0:
+            break
+        copied += count
+
+
+def _sendfile(reader, writer, size: int) -> None:
+    copied = 0
+    while copied < size:
+        count = os.sendfile(writer.fileno(), reader.fileno(), copied, size - copied)
+        if count == 0:
+            break
+        copied += count
+
+
+def _buffered(reader, writer, _) -> None:
+    shutil.copyfileobj(reader, writer, BUFFER_SIZE)
+
+
+PRIMITIVES = {
+    'reflink': _reflink,
+    'copy_file_range': _copy_file_range,
+    'sendfile': _sendfile,
+    'buffered': _buffered,
+}
+
+
+def copy_data(source: str, dest: str, methods: Tuple[str, ...] = COPY_METHODS) -> str:
+    ''' Write the content of source on dest, trying each method in order
+        until one is supported. Return the method used. '''
+
+    with open(source, 'rb') as reader, open(dest, 'wb') as writer:
+        size = os.fstat(reader.fileno()).st_size
+        for method in methods:
+            try:
+                PRIMITIVES[method](reader, writer, size)
+                return _count(method)
+            except OSError as error:
+                if error.errno not in UNSUPPORTED or method == methods[-1]:
+                    raise
+                logging.debug('%s unavailable for %s: %s', method, source, error)
+
+            # start over from a clean file
+            reader.seek(0)
+            writer.seek(0)
+            writer.truncate()
+
+    raise ValueError(f'no copy method given for: {source}')
+
+
+def _temporary(dest: str) -> str:
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dest) or '.', prefix='.')
+    os.close(fd)
+    return tmp
+
+
+def copy(source: str, dest: str, methods: Tuple[str, ...] = COPY_METHODS) -> str:
+    ''' Copy source into dest without ever exposing a partial file. Return
+        the method used. '''
+
+    tmp = _temporary(dest)
+    try:
+        method = copy_data(source, tmp, methods)
+        # mkstemp creates the file private to its owner
+        shutil.copymode(source, tmp)
+        os.replace(tmp, dest)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return method
+
+
+def link(source: str, dest: str, mode: str = 'reflink') -> str:
+    ''' Give dest the content of source by a hardlink, a reflink or a copy,
+        taking the next cheapest one the filesystem supports. Return the
+        method used. '''
+
+    if mode not in LINK_MODES:
+        raise ValueError(f'unknown link mode: {mode}')
+
+    if mode == 'hardlink':
+        tmp = _temporary(dest)
+        os.unlink(tmp)
+        try:
+            os.link(source, tmp)
+            os.replace(tmp, dest)
+            return _count('hardlink')
+        except OSError as error:
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+            if error.errno not in UNSUPPORTED | {errno.EMLINK}:
+                raise
+            logging.debug('unable to hardlink %s: %s', source, error)
+
+    # a plain copy never shares extents, which makes it safe to edit
+    methods = COPY_METHODS if mode != 'copy' else COPY_METHODS[1:]
+    return copy(source, dest, methods)
+
+
+def move(source: str, dest: str) -> str:
+    ''' Move source to dest, renaming when both are on the same filesystem
+        and copying then removing source otherwise. Return the method used. '''
+
+    try:
+        os.rename(source, dest)
+        return _count('rename')
+    except OSError as error:
+        if error.errno != errno.EXDEV:
+            raise
+
+    method = copy(source, dest)
+    shutil.copystat(source, dest)
+    os.unlink(source)
+    return method
+
+
+def free_path(path: str) -> str:
+    ''' Return path, or the first numbered variant of it not taken yet '''
+
+    root, extension = os.path.splitext(path)
+    candidate, number = path, 0
+    while os.path.lexists(candidate):
+        number += 1
+        candidate = f'{root}.{number}{extension}'
+    return candidate
+
+
+def store_path(path: str, store: str, root: Union[str, None] = None) -> str:
+    ''' Return where path is kept in store, under its path relative to root.
+        Paths outside root are kept under their name. '''
+
+    relative = os.path.basename(path)
+    if root is not None:
+        candidate = os.path.relpath(os.path.abspath(path), os.path.abspath(root))
+        if not candidate.startswith(os.pardir):
+            relative = candidate
+    return os.path.join(os.path.expanduser(store), relative)
+
+
+def move_to_store(path: str, store: str, root: Union[str, None] = None) -> str:
+    ''' Move path into store laid out by its path relative to root, never
+        replacing a file kept there before. Return the new path. '''
+
+    dest = store_path(path, store, root)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    dest = free_path(dest)
+    method = move(path, dest)
+    logging.debug('placed %s on %s by %s', path, dest, method)
+    return dest
@@ -0,0 +1,172 @@
+'''
+Dry run of a sync: what each service would process and what it would cost,
+found by scanning and classifying the tree without converting anything.
+'''
+
+
+import os
+import logging
+import zipfile
+import mimetypes
+
+import estimate
+import pipeline
+
+
+from typing import (
+    Dict,
+    List,
+    Union,
+)
+
+
+def zip_contents(path: str) -> dict:
+    ''' Read the central directory of the zip on path, without extracting
+        anything. Nested archives are counted but not opened. '''
+
+    summary = {'path': path, 'members': 0, 'bytes': 0, 'compressed_bytes': 0,
+               'nested_zips': 0, 'files': []}
+    try:
+        with zipfile.ZipFile(path) as archive:
+            infos = archive.infolist()
+    except (OSError, zipfile.BadZipFile) as error:
+        logging.warning('unable to read zip %s: %s', path, error)
+        summary['error'] = str(error)
+        return summary
+
+    for info in infos:
+        if info.is_dir():
+            continue
+
+        mimetype = mimetypes.guess_type(info.filename)[0]
+        summary['members'] += 1
+        summary['bytes'] += info.file_size
+        summary['compressed_bytes'] += info.compress_size
+        if mimetype == 'application/zip':
+            summary['nested_zips'] += 1
+        summary['files'].append((info.filename, mimetype, info.file_size))
+    return summary
+
+
+def member_service(service_options: dict, mimetype: Union[str, None]) -> Union[str, None]:
+    ''' Return the converter service a zip member would be handed to, guessed
+        from its name as it can not be sniffed before extraction '''
+
+    for service, options in service_options.items():
+        if options['weight'] and mimetype in options['mimes']:
+            return service
+    return None
+
+
+def count_launches(options: dict, sizes: List[int]) -> int:
+    ''' Number of converter calls, each starting a DispVM, needed for files of
+        the given sizes. Batching services group files as the pipeline does. '''
+
+    batch_files = 1
+    if options['batch_worker'] is not None:
+        batch_files = options['executor_kwargs'].get('batch_files') or 1
+    if batch_files <= 1:
+        return len(sizes)
+
+    max_bytes = options['executor_kwargs'].get('batch_bytes')
+    launches = held = held_bytes = 0
+    for size in sizes:
+        if max_bytes and size > max_bytes:
+            launches += 1
+            continue
+
+        if max_bytes and held and held_bytes + size > max_bytes:
+            launches += 1
+            held = held_bytes = 0
+
+        held += 1
+        held_bytes += size
+        if held >= batch_files:
+            launches += 1
+            held = held_bytes = 0
+    return launches + (1 if held else 0)
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+def build_plan(index,
+               directory: str,
+               rates: Dict[str, dict] = None,
+               max_workers: int = None,
+               budget: int = None) -> dict:
+    ''' Scan directory with index, a ScanIndex without sink, and return the
+        plan of every service. Converter time comes from rates recorded by
+        previous runs when known, and from estimated costs otherwise. '''
+
+    rates = rates or {}
+    index.scan(directory)
+    service_options = index.service_options
+
+    plan = {'directory': directory, 'services': {}, 'zips': []}
+    sizes: Dict[str, List[int]] = {service: [] for service in service_options}
+    costs: Dict[str, float] = {service: 0.0 for service in service_options}
+
+    for service, options in service_options.items():
+        paths = index.items(service)
+        for path in paths:
+            sizes[service].append(_file_size(path))
+            if options['weight']:
+                costs[service] += options['cost'](path)
+
+        if service == 'zip':
+            plan['zips'] = [zip_contents(path) for path in paths]
+
+        plan['services'][service] = {'files': len(paths), 'paths': paths}
+
+    # members are known only by name and size until extracted
+    for summary in plan['zips']:
+        for name, mimetype, size in summary.pop('files'):
+            service = member_service(service_options, mimetype)
+            if service is not None:
+                sizes[service].append(size)
+                costs[service] += estimate.member_cost(mimetype, size)
+                plan['services'][service].setdefault('zip_members', 0)
+                plan['services'][service]['zip_members'] += 1
+
+    wall = 0.0
+    for service, options in service_options.items():
+        service_plan = plan['services'][service]
+        service_plan['bytes'] = sum(sizes[service])
+        if not options['weight']:
+            continue
+
+        rate = rates.get(service, {}).get('seconds_per_file')
+        service_plan['estimated_cost'] = round(costs[service], 1)
+        service_plan['launches'] = count_launches(options, sizes[service])
+        if rate is not None:
+            service_plan['converter_seconds'] = round(rate * len(sizes[service]), 1)
+            service_plan['rate'] = 'recorded'
+        else:
+            service_plan['converter_seconds'] = service_plan['estimated_cost']
+            service_plan['rate'] = 'estimated'
+
+        # each service is assumed to have the converters for itself
+        slots = options['executor_kwargs'].get('max_workers') or pipeline.DEFAULT_WORKERS
+        if max_workers:
+            slots = min(slots, max_workers)
+        if budget:
+            slots = min(slots, max(budget // options['weight'], 1))
+        wall += service_plan['converter_seconds'] / slots
+
+    converters = [plan['services'][service] for service, options in service_options.items()
+                  if options['weight']]
+    plan['totals'] = {
+        'files': sum(len(paths) for paths in sizes.values()),
+        'ignored': index.ignored,
+        'up_to_date': index.up_to_date,
+        'zip_bytes': sum(summary['bytes'] for summary in plan['zips']),
+        'launches': sum(service['launches'] for service in converters),
+        'converter_seconds': round(sum(service['converter_seconds'] for service in converters), 1),
+        'wall_seconds': round(wall, 1),
+    }
+    return plan
@@ -4,24 +4,59 @@ Execute common tasks to files as extraction and secure conversion.
 
 
 import os
+import sys
+import json
 import shlex
 import shutil
+import atexit
+import signal
+import asyncio
 import zipfile
 import logging
 import datetime
+import tempfile
 import argparse
+import threading
 import subprocess
-from concurrent import futures
+
+import extract
+import pipeline
+import tracing
+import aioengine
+import convcache
+import estimate
+import placement
+import journal
+import watcher
+import delivery
+import daemon
+import backends
+import pdfsplit
+import imagescale
+import priorities
+import fileindex
+import mimesniff
+import planner
+import scheduler
 
 
 from typing import (
     Union,
     List,
     Tuple,
+    Iterable,
     Generator,
 )
 
 
+# persistent converter workers of a service, unless told otherwise
+DEFAULT_PROCESSES = 2
+
+# bounds of the timeout derived from the estimated conversion time
+MIN_TIMEOUT = 120
+TIMEOUT_FACTOR = 10
+
+
 def parse_args() -> argparse.Namespace:
     ''' Parse command line arguments '''
 
@@ -29,7 +64,42 @@ def parse_args() -> argparse.Namespace:
 
     proc_opt = parser.add_argument_group('Parallel Tasks')
     proc_opt.add_argument('--max-workers',
-                          help='Define the maximum number of parallel tasks.',
+                          help='Define the maximum number of parallel conversions '
+                          'across all services.',
+                          type=int)
+
+    proc_opt.add_argument('--engine',
+                          help='Run conversions on a pool of threads or on a '
+                          'single asyncio event loop (default: threads).',
+                          choices=('threads', 'asyncio'),
+                          default='threads')
+
+    proc_opt.add_argument('--schedule',
+                          help='Order of the queued conversions, the found order '
+                          'or the longest estimated first (default: lpt).',
+                          choices=('fifo', 'lpt'),
+                          default='lpt')
+
+    proc_opt.add_argument('--priority-rules',
+                          metavar='FILE',
+                          help='JSON file of rules putting files ahead of the '
+                          'others by path glob, age, size and type. Ranks go '
+                          'before the schedule order.')
+
+    proc_opt.add_argument('--converter-memory',
+                          help='Megabytes of host memory shared by all parallel '
+                          'conversions (default: 4000).',
+                          type=int,
+                          default=4000)
+
+    proc_opt.add_argument('--pdf-job-memory',
+                          help='Megabytes taken from the converter memory by '
+                          'each pdf conversion (default: 800).',
+                          type=int)
+
+    proc_opt.add_argument('--img-job-memory',
+                          help='Megabytes taken from the converter memory by '
+                          'each image conversion (default: 400).',
                           type=int)
 
     proc_opt.add_argument('--max-pdf-workers',
@@ -40,6 +110,70 @@ def parse_args() -> argparse.Namespace:
                           help='Define the maximum number of parallel image tasks.',
                           type=int)
 
+    proc_opt.add_argument('--max-zip-workers',
+                          help='Define the maximum number of parallel zip '
+                          'extractions.',
+                          type=int)
+
+    proc_opt.add_argument('--max-queued',
+                          help='Define the maximum number of files waiting for '
+                          'each service, the scan pauses when it is reached.',
+                          type=int)
+
+    proc_opt.add_argument('--backend-processes',
+                          help='Number of long lived converters of each service '
+                          'with a persistent backend (default: its maximum '
+                          'workers, or 2).',
+                          type=int)
+
+    retry_opt = parser.add_argument_group('Timeouts and Retries')
+    retry_opt.add_argument('--pdf-timeout',
+                           help='Seconds a pdf conversion may take before it is '
+                           'killed (default: grows with the page count).',
+                           type=float)
+
+    retry_opt.add_argument('--img-timeout',
+                           help='Seconds an image conversion may take before it '
+                           'is killed (default: grows with the pixel count).',
+                           type=float)
+
+    retry_opt.add_argument('--retries',
+                           help='Times a timed out or killed conversion is tried '
+                           'again (default: 2).',
+                           type=int,
+                           default=2)
+
+    retry_opt.add_argument('--retry-backoff',
+                           help='Seconds to wait before the first retry, doubled '
+                           'on each one (default: 5).',
+                           type=float,
+                           default=5.0)
+
+    dedup_opt = parser.add_argument_group('Deduplication')
+    dedup_opt.add_argument('--no-dedup',
+                           action='store_true',
+                           help='Convert every copy of identical files, instead '
+                           'of converting one and sharing its output.')
+
+    dedup_opt.add_argument('--dedup-link',
+                           choices=placement.LINK_MODES,
+                           default='reflink',
+                           help='How copies get the shared output, a hardlink '
+                           'makes changes to one of them show on all '
+                           '(default: reflink, copying when unsupported).')
+
+    batch_opt = parser.add_argument_group('Batched Conversions')
+    batch_opt.add_argument('--batch-files',
+                           help='Convert up to this many small pdfs with a single '
+                           'converter, starting one DispVM for all of them '
+                           '(default: 1, no batching).',
+                           type=int)
+
+    batch_opt.add_argument('--batch-size',
+                           help='Maximum megabytes of pdfs converted together, '
+                           'bigger files are converted alone (default: 20).',
+                           type=int)
+
     zip_opt = parser.add_argument_group('Zip Files')
     zip_opt.add_argument('-u',
                          '--keep-original-zip',
@@ -51,6 +185,31 @@ def parse_args() -> argparse.Namespace:
                          action='store_true',
                          help='Do not unzip any file.')
 
+    zip_opt.add_argument('--zip-max-depth',
+                         type=int,
+                         help='Maximum depth of nested zip files that are also '
+                         'extracted (default: 3).')
+
+    zip_opt.add_argument('--zip-max-size',
+                         type=int,
+                         help='Maximum uncompressed megabytes extracted from a '
+                         'single zip, nested ones included (default: 2048).')
+
+    zip_opt.add_argument('--zip-max-members',
+                         type=int,
+                         help='Maximum number of files extracted from a single '
+                         'zip, nested ones included (default: 10000).')
+
+    zip_opt.add_argument('--zip-max-ratio',
+                         type=int,
+                         help='Maximum compression ratio of a zip member '
+                         '(default: 100).')
+
+    zip_opt.add_argument('--zip-member-workers',
+                         type=int,
+                         help='Number of members of a zip extracted in '
+                         'parallel (default: 4).')
+
     pdf_opt = parser.add_argument_group('Pdf files')
 
     pdf_opt.add_argument('--skip-pdf',
@@ -61,6 +220,44 @@ def parse_args() -> argparse.Namespace:
                          type=str,
                          help='Path to custom pdf converter binary')
 
+    pdf_opt.add_argument('--pdf-split',
+                         action='store_true',
+                         help='Convert large pdfs as chunks of pages in parallel, '
+                         'merging the converted chunks back in a single pdf.')
+
+    pdf_opt.add_argument('--pdf-split-pages',
+                         type=int,
+                         help='Least pages of a pdf to be split (default: '
+                         f'{pdfsplit.SPLIT_PAGES}).')
+
+    pdf_opt.add_argument('--pdf-chunk-pages',
+                         type=int,
+                         help=f'Pages of each chunk (default: {pdfsplit.CHUNK_PAGES}).')
+
+    pdf_opt.add_argument('--pdf-split-command',
+                         type=str,
+                         help='Command reading a pdf on its standard input and '
+                         'writing its pages {first} to {last} on its standard '
+                         'output. It must not parse the pdf in this qube '
+                         f'(default: {pdfsplit.SPLIT_COMMAND}).')
+
+    pdf_opt.add_argument('--pdf-merge-command',
+                         type=str,
+                         help='Command joining the TRUSTED chunks {inputs} in order '
+                         f'on {{output}} (default: {pdfsplit.MERGE_COMMAND}).')
+
+    pdf_opt.add_argument('--pdf-split-dir',
+                         type=str,
+                         help='Where chunks are written while they are converted '
+                         '(default: ~/.cache/qubes-usync/split).')
+
+    pdf_opt.add_argument('--pdf-backend',
+                         choices=backends.BACKENDS,
+                         default='spawn',
+                         help='Start the converter for every job, or keep it '
+                         'running and send it jobs over its standard input '
+                         '(default: spawn).')
+
     img_opt = parser.add_argument_group('Image files')
 
     img_opt.add_argument('--skip-img',
@@ -71,15 +268,204 @@ def parse_args() -> argparse.Namespace:
                          type=str,
                          help='Path to custom img converter binary')
 
+    img_opt.add_argument('--max-image-pixels',
+                         type=int,
+                         metavar='PIXELS',
+                         help='Downscale images with more pixels than this before '
+                         'converting them, as 12000000 for 12 megapixels. Only '
+                         'the image header is read in this qube.')
+
+    img_opt.add_argument('--img-downscale-command',
+                         type=str,
+                         help='Command reading an image on its standard input and '
+                         'writing it with at most {pixels} pixels on its standard '
+                         'output. It must not decode the image in this qube '
+                         f'(default: {imagescale.DOWNSCALE_COMMAND}).')
+
+    img_opt.add_argument('--img-backend',
+                         choices=backends.BACKENDS,
+                         default='spawn',
+                         help='Start the converter for every job, or keep it '
+                         'running and send it jobs over its standard input '
+                         '(default: spawn).')
+
+    cache_opt = parser.add_argument_group('Conversion Cache')
+
+    cache_opt.add_argument('--no-cache',
+                           action='store_true',
+                           help='Always call converters, even for already '
+                           'converted files.')
+
+    cache_opt.add_argument('--cache-dir',
+                           type=str,
+                           help='Directory where trusted outputs are kept between '
+                           'runs.')
+
+    cache_opt.add_argument('--cache-size',
+                           type=int,
+                           help='Maximum size of the cache in megabytes.')
+
+    inc_opt = parser.add_argument_group('Incremental Runs')
+
+    inc_opt.add_argument('--incremental',
+                         action='store_true',
+                         help='Only process files that are new or changed since '
+                         'the last run on the same directory.')
+
+    inc_opt.add_argument('--index-file',
+                         type=str,
+                         default='~/.cache/qubes-usync/index.sqlite',
+                         help='Database used to remember files between '
+                         'incremental runs.')
+
+    watch_opt = parser.add_argument_group('Watching')
+
+    watch_opt.add_argument('--watch',
+                           action='store_true',
+                           help='Process files while another program is still '
+                           'writing them to the directory, each one once it is '
+                           'fully written.')
+
+    watch_opt.add_argument('--watch-pid',
+                           type=int,
+                           metavar='PID',
+                           help='The writing program is done once this process '
+                           'exits.')
+
+    watch_opt.add_argument('--done-file',
+                           type=str,
+                           metavar='FILE',
+                           help='The writing program is done once FILE exists.')
+
+    watch_opt.add_argument('--watch-idle',
+                           type=float,
+                           default=60.0,
+                           help='Without a pid or a done file, the writing program '
+                           'is done after this many seconds without new files '
+                           '(default: 60).')
+
+    watch_opt.add_argument('--watch-settle',
+                           type=float,
+                           default=watcher.SETTLE,
+                           help='Seconds a file must stay the same to be taken as '
+                           'fully written, when it was not seen being closed '
+                           '(default: %(default)s).')
+
+    watch_opt.add_argument('--watch-polling',
+                           action='store_true',
+                           help='Look for new files by walking the directory again '
+                           'and again instead of using inotify.')
+
+    deliver_opt = parser.add_argument_group('Delivery')
+
+    deliver_opt.add_argument('--deliver',
+                             action='store_true',
+                             help='Ship converted files in batches as they are done, '
+                             'then the rest of the directory once the run is over.')
+
+    deliver_opt.add_argument('--deliver-command',
+                             type=str,
+                             default=delivery.DEFAULT_COMMAND,
+                             help='Command shipping each batch, given the batch as '
+                             'its last argument (default: %(default)s).')
+
+    deliver_opt.add_argument('--deliver-files',
+                             type=int,
+                             default=delivery.MAX_FILES,
+                             help='Most files shipped in a batch (default: %(default)s).')
+
+    deliver_opt.add_argument('--deliver-size',
+                             type=int,
+                             default=delivery.MAX_BYTES // (1024 * 1024),
+                             help='A batch is shipped once it holds this many '
+                             'megabytes (default: %(default)s).')
+
+    deliver_opt.add_argument('--deliver-window',
+                             type=float,
+                             default=delivery.WINDOW,
+                             help='A batch is shipped once its first file waited '
+                             'this many seconds (default: %(default)s).')
+
+    deliver_opt.add_argument('--deliver-pack',
+                             action='store_true',
+                             help='Pack each batch in a single tar archive, cutting '
+                             'the cost of shipping many small files.')
+
+    resume_opt = parser.add_argument_group('Resuming')
+
+    resume_opt.add_argument('--resume',
+                            action='store_true',
+                            help='Continue an interrupted run on the same directory, '
+                            'skipping the files its journal tells are done and '
+                            'redoing the ones it left in flight.')
+
+    resume_opt.add_argument('--journal-dir',
+                            type=str,
+                            default='~/.cache/qubes-usync/journals',
+                            help='Where the journal of each run is kept.')
+
+    resume_opt.add_argument('--no-journal',
+                            action='store_true',
+                            help='Do not keep a journal, runs can not be resumed.')
+
+    plan_opt = parser.add_argument_group('Planning')
+
+    plan_opt.add_argument('--plan',
+                          action='store_true',
+                          help='Only scan the directory and print as JSON what '
+                          'each service would process and its estimated cost, '
+                          'without converting anything.')
+
+    plan_opt.add_argument('--rates-file',
+                          type=str,
+                          default='~/.cache/qubes-usync/rates.json',
+                          help='Where the conversion rates measured on each run '
+                          'are kept to estimate the next ones.')
+
+    daemon_opt = parser.add_argument_group('Daemon')
+
+    daemon_opt.add_argument('--daemon',
+                            action='store_true',
+                            help='Keep running and process the files or directories '
+                            'submitted on the socket, all of them sharing the '
+                            'converters and the caches.')
+
+    daemon_opt.add_argument('--submit',
+                            action='store_true',
+                            help='Have the daemon listening on the socket process '
+                            'directory, following the job until it is done.')
+
+    daemon_opt.add_argument('--socket',
+                            type=str,
+                            default=daemon.DEFAULT_SOCKET,
+                            help='UNIX socket of the daemon (default: %(default)s).')
+
+    trace_opt = parser.add_argument_group('Tracing')
+    trace_opt.add_argument('--trace',
+                           type=str,
+                           metavar='FILE',
+                           help='Record how long each stage took for every file '
+                           'and write the events to FILE.')
+
+    trace_opt.add_argument('--trace-format',
+                           choices=tracing.FORMATS,
+                           default='chrome',
+                           help='Write the Chrome trace event format, which '
+                           'chrome://tracing and Perfetto open, or one JSON '
+                           'event per line (default: chrome).')
+
     parser.add_argument('-v',
                         '--verbose',
                         help='Configure logging facility to display debug messages.',
                         action='store_true')
 
-    parser.add_argument('directory', help='Source directory where u.sync books '
-                        'had been stored.')
+    parser.add_argument('directory', nargs='?', help='Source directory where u.sync '
+                        'books had been stored, or a single file.')
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.directory is None and not args.daemon:
+        parser.error('the following arguments are required: directory')
+    return args
 
 
 def expose_files(directory: str, predicate: callable) -> Generator:
@@ -95,17 +481,330 @@ def expose_files(directory: str, predicate: callable) -> Generator:
                 yield from expose_files(entry.path, predicate)
 
 
-def unzip(path: str, flush: bool = True) -> None:
-    ''' Perform extraction operation on target path removing file when needed '''
+def call_predicate(predicate: dict, path: str) -> bool:
+    ''' Evaluate a predicate template against some path '''
+
+    if predicate['func'] is None:
+        return False
+    return predicate['func'](path, *predicate['args'], **predicate['kwargs']) is True
+
+
+class Outcomes:
+    ''' Outcome of files handed to services, filled as each one is done '''
+
+    def __init__(self, paths: Iterable[str]):
+        self.results = {}
+        self._waiting = set(paths)
+        self._done = threading.Event()
+        if not self._waiting:
+            self._done.set()
+
+    def set(self, path: str, success: bool) -> None:
+        ''' Record the outcome of path '''
+
+        self.results[path] = success
+        self._waiting.discard(path)
+        if not self._waiting:
+            self._done.set()
+
+    def wait(self) -> dict:
+        ''' Wait for every file and return whether each one succeeded '''
+
+        self._done.wait()
+        return self.results
+
+
+class ScanIndex:
+    ''' Shared classification of files for all services.
+
+        The tree is walked only once and every file is probed at most once. By
+        default the resulting paths are kept as one slice per service, when a
+        sink is set they are handed to it as soon as they are classified
+        instead. When a file index is given, files settled by a previous run
+        are skipped, and a read only index leaves the file index untouched.
+        When a watcher is given, files are only taken once it tells they are
+        fully written, and the walk goes on until their producer is done. '''
+
+    # unidentified files waiting for a single file(1) call
+    UNKNOWN_BATCH_SIZE = 256
+
+    def __init__(self,
+                 service_options: dict,
+                 file_index: Union[None, fileindex.FileIndex] = None,
+                 sink: callable = None,
+                 read_only: bool = False,
+                 watcher=None):
+        # services with higher priority are tried first
+        self.service_options = dict(sorted(service_options.items(),
+                                           key=lambda item: item[1].get('priority') or 0,
+                                           reverse=True))
+        self.file_index = file_index
+        self.read_only = read_only
+        self.watcher = watcher
+        self.sink = sink
+        self.entries = {service: [] for service in service_options}
+        self.ignored = self.up_to_date = 0
+        self._claimed = set()
+        self._outcomes = {}
+        self._records = []
+        self._lock = threading.Lock()
+        self._uses_mimes = any(options['mimes'] for options in service_options.values())
+
+    def classify(self,
+                 path: str,
+                 mimetype: Union[str, None],
+                 exclude: tuple = ()) -> Union[str, None]:
+        ''' Return the service responsible for path, when any '''
+
+        for service, options in self.service_options.items():
+            if service in exclude:
+                continue
+
+            if options['mimes']:
+                # a predicate may narrow the files of the mime types
+                predicate = options['predicate']
+                if mimetype in options['mimes'] and (predicate['func'] is None
+                                                     or call_predicate(predicate, path)):
+                    return service
+            elif call_predicate(options['predicate'], path):
+                return service
+        return None
+
+    def claim(self, path: str) -> None:
+        ''' Make the walk ignore path, as it was created by this run '''
+
+        with self._lock:
+            self._claimed.add(os.path.abspath(path))
+
+    def _register(self, classified: dict) -> None:
+        with self._lock:
+            for path, service in classified.items():
+                if service is None:
+                    self.ignored += 1
+                elif self.sink is None:
+                    self.entries[service].append(path)
+
+        if self.file_index is not None and not self.read_only:
+            with self._lock:
+                self._records.extend(
+                    (path, service, 'ignored' if service is None else 'pending')
+                    for path, service in classified.items())
+                should_flush = len(self._records) >= self.UNKNOWN_BATCH_SIZE
+            if should_flush:
+                self.flush_records()
+
+        if self.sink is not None:
+            for path, service in classified.items():
+                if service is not None:
+                    self.sink(service, path)
+
+    def flush_records(self) -> None:
+        ''' Write pending classifications to the file index '''
+
+        with self._lock:
+            records, self._records = self._records, []
+        if records:
+            self.file_index.record_many(records)
+
+    def _classify_many(self, paths: List[str], mimetypes: dict, exclude: tuple) -> dict:
+        classified = {}
+        for path in paths:
+            service = self.classify(path, mimetypes.get(path), exclude=exclude)
+            logging.debug('classified file: %s as: %s', path, service)
+            classified[path] = service
+        return classified
+
+    def add_many(self, paths: List[str], exclude: tuple = ()) -> dict:
+        ''' Classify paths created by this run and register them '''
+
+        for path in paths:
+            self.claim(path)
+
+        mimetypes = mimesniff.detect(paths) if self._uses_mimes else {}
+        classified = self._classify_many(paths, mimetypes, exclude)
+        self._register(classified)
+        if self.file_index is not None:
+            self.flush_records()
+        return classified
+
+    def add(self, path: str, exclude: tuple = ()) -> Union[str, None]:
+        ''' Classify a single path and register it '''
+
+        return self.add_many([path], exclude=exclude)[path]
+
+    def _is_claimed(self, path: str) -> bool:
+        with self._lock:
+            return os.path.abspath(path) in self._claimed
+
+    def _feed(self, paths: Iterable[str], exclude: tuple = ()) -> None:
+        ''' Classify and register paths as they come. Files identified by their
+            header are registered right away, the others are resolved in
+            batches. '''
+
+        unknowns = []
+
+        def flush_unknowns():
+            with tracing.span('file', 'classify', files=len(unknowns)):
+                mimetypes = mimesniff.file_mimetypes(unknowns)
+            self._register(self._classify_many(unknowns, mimetypes, exclude))
+            unknowns.clear()
+
+        for path in paths:
+            with tracing.span('sniff', 'classify', path=path):
+                mimetype = mimesniff.sniff(path) if self._uses_mimes else None
+            if mimetype is None and self._uses_mimes:
+                unknowns.append(path)
+                if len(unknowns) >= self.UNKNOWN_BATCH_SIZE:
+                    flush_unknowns()
+            else:
+                self._register(self._classify_many([path], {path: mimetype}, exclude))
+
+        if unknowns:
+            flush_unknowns()
+
+    def stream(self, paths: Iterable[str], exclude: tuple = ()) -> None:
+        ''' Classify and register files created by this run while they are
+            produced. Callers must claim paths before creating them. '''
+
+        self._feed(paths, exclude=exclude)
+        if self.file_index is not None:
+            self.flush_records()
+
+    def walk(self, directory: str) -> None:
+        ''' Walk directory once classifying and registering every file found.
+            A single file given instead is classified on its own. '''
+
+        if os.path.isfile(directory):
+            self._feed([directory])
+            if self.file_index is not None:
+                self.flush_records()
+            return
+
+        known, unchanged = {}, set()
+        if self.file_index is not None:
+            known = self.file_index.snapshot(directory)
+
+        def changed_files():
+            for entry in expose_files(directory, lambda _: True):
+                if self._is_claimed(entry.path):
+                    continue
+
+                abs_path = os.path.abspath(entry.path)
+                if fileindex.FileIndex.is_unchanged(known.pop(abs_path, None), entry.stat()):
+                    self.up_to_date += 1
+                    unchanged.add(abs_path)
+                else:
+                    yield entry.path
+
+        if self.watcher is None:
+            with tracing.span('walk', 'scan', directory=directory):
+                self._feed(changed_files())
+        else:
+            self._watch(changed_files(), unchanged)
+
+        if self.file_index is not None:
+            self.flush_records()
+            if known and not self.read_only:
+                logging.debug('forgetting vanished files: %d', len(known))
+                self.file_index.forget(list(known))
+            logging.info('files up to date: %d', self.up_to_date)
+
+    def _watch(self, paths: Iterable[str], seen: set) -> None:
+        ''' Hand paths to the watcher and feed every file it tells is ready,
+            except the seen ones '''
+
+        with tracing.span('walk', 'scan', directory=self.watcher.directory):
+            for path in paths:
+                self.watcher.add(path)
+
+        # files show up again when changed, and the last sweep finds them all
+        def ready_files():
+            for path in self.watcher.files():
+                abs_path = os.path.abspath(path)
+                if abs_path in seen or self._is_claimed(path) or not os.path.isfile(path):
+                    continue
+                seen.add(abs_path)
+                yield path
+
+        with tracing.span('watch', 'scan', directory=self.watcher.directory):
+            self._feed(ready_files())
+
+    def scan(self, directory: str) -> 'ScanIndex':
+        ''' Walk directory once keeping the slice of files of each service '''
+
+        self.walk(directory)
+        logging.debug('scan done: %s ignored: %d',
+                      {service: len(items) for service, items in self.entries.items()},
+                      self.ignored)
+        return self
+
+    def add_parts(self, service: str, paths: List[str], options: dict) -> Outcomes:
+        ''' Hand parts of a file created by this run straight to service, to
+            be run with options, and return their outcomes to wait for. Parts
+            are not classified and stay out of the file index. '''
+
+        outcomes = self.outcomes(paths)
+        for path in paths:
+            self.claim(path)
+            self.sink(service, path, options)
+        return outcomes
+
+    def outcomes(self, paths: List[str]) -> Outcomes:
+        ''' Start collecting the outcome of paths, before they are handed to
+            services, so a worker can wait for files it dispatched '''
+
+        outcomes = Outcomes(paths)
+        with self._lock:
+            for path in paths:
+                self._outcomes[path] = outcomes
+        return outcomes
+
+    def finish(self, service: str, items: List[str], failed_items: List[str]) -> None:
+        ''' Record the processing outcome of files from service '''
+
+        with self._lock:
+            waiting = {path: self._outcomes.pop(path) for path in items
+                       if path in self._outcomes}
+        for path, outcomes in waiting.items():
+            outcomes.set(path, path not in failed_items)
+
+        # what a worker waits for is only known to that worker
+        items = [path for path in items if path not in waiting]
+        if self.file_index is None or not items:
+            return
+
+        # pending classifications must not overwrite the outcome
+        self.flush_records()
+        output = self.service_options[service].get('output')
+        failed_items, records = set(failed_items), []
+        for path in items:
+            if path in failed_items:
+                records.append((path, service, 'failed'))
+            else:
+                records.append((path, service, 'done'))
+                if output is not None:
+                    records.append((output(path), service, 'output'))
+        self.file_index.record_many(records)
 
-    logging.debug('extracting zip file: %s', path)
-    with zipfile.ZipFile(path) as zip_reader:
-        zip_reader.extractall(os.path.dirname(path))
+    def items(self, service: str) -> List[str]:
+        ''' Return the slice of files classified for service '''
+
+        with self._lock:
+            return list(self.entries.get(service, []))
+
+
+def unzip(path: str, flush: bool = True) -> List[str]:
+    ''' Perform extraction operation on target path removing file when needed.
+        Return the path of extracted files. '''
+
+    members = list(extract.extract_archive(path))
 
     if flush:
         logging.debug('zip file will be removed: %s', os.path.basename(path))
         os.unlink(path)
 
+    return members
+
 
 def is_mimetype(path: str, *mimes) -> bool:
     ''' Check wheter a given file is of given mime type '''
@@ -117,14 +816,48 @@ def is_mimetype(path: str, *mimes) -> bool:
     return any(mime in output for mime in mimes)
 
 
-def check_cmd(command: str) -> bool:
-    ''' Base function for running binaries '''
+# process groups of running commands, killed if the program exits first
+RUNNING_GROUPS = set()
+
+
+def kill_process_group(pid: int) -> None:
+    ''' Kill a command started in its own session and all it started '''
 
     try:
-        logging.debug('executing command: %s', command)
-        return subprocess.check_call(shlex.split(command)) == 0
-    except subprocess.CalledProcessError:
-        return False
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+@atexit.register
+def kill_running_commands() -> None:
+    ''' Reap commands left behind by worker threads '''
+
+    for pid in list(RUNNING_GROUPS):
+        logging.debug('killing leftover command: %d', pid)
+        kill_process_group(pid)
+
+
+def check_cmd(command: str, timeout: float = None) -> bool:
+    ''' Base function for running binaries. The command and every process
+        it started are killed once it runs for longer than timeout seconds. '''
+
+    logging.debug('executing command: %s', command)
+    with subprocess.Popen(shlex.split(command), start_new_session=True) as process:
+        RUNNING_GROUPS.add(process.pid)
+        try:
+            with tracing.span('converter', 'convert', command=command):
+                returncode = process.wait(timeout)
+        except subprocess.TimeoutExpired as error:
+            kill_process_group(process.pid)
+            process.wait()
+            raise pipeline.JobTimeout(f'timed out after {timeout:.0f}s') from error
+        finally:
+            RUNNING_GROUPS.discard(process.pid)
+
+    if returncode < 0:
+        raise pipeline.TransientError(f'killed by signal {-returncode}')
+    return returncode == 0
 
 
 def find_missing_packages(service_options: dict) -> List[str]:
@@ -160,55 +893,54 @@ def log_list(header: str, content: list) -> None:
     logging.warning('\n'.join([header] + placeholder), *content)
 
 
-def execute_converter(binary: str, *arguments: list) -> bool:
+def execute_converter(binary: str, *arguments: list, timeout: float = None) -> bool:
     ''' Check the converter exit code of service binary '''
 
     command = f'{binary} {" ".join(shlex.quote(arg) for arg in arguments)}'
     logging.debug('starting conversion: %s', arguments[0])
-    return check_cmd(command)
+    return check_cmd(command, timeout=timeout)
 
 
-def handle_futures(future_to_service: dict) -> None:
-    ''' Helper function for waiting future results '''
+def run_converter(options: dict, *arguments, timeout: float = None) -> bool:
+    ''' Convert with the binary of a service, spawned for this job only or
+        through the persistent workers of its backend '''
 
-    for future in futures.as_completed(future_to_service):
-        stopped_service = future_to_service[future]
-        result, error = None, None
-        try:
-            result = future.result()
-        except Exception as exception:  # pylint: disable=broad-except
-            error = exception
-        yield (stopped_service, result, error)
-
-
-def wait_futures(worker: callable,
-                 services: list,
-                 *args,
-                 **executor_kwargs) -> List[str]:
-    '''Manage parallel tasks with nice logging '''
-
-    index, faileds, services_count = 0, [], len(services)
-    with futures.ThreadPoolExecutor(**executor_kwargs) as executor:
-        future_to_service = {executor.submit(worker, service, *args): service
-                             for service in services}
-        for service, success, error in handle_futures(future_to_service):
-            if error:
-                logging.error('%s exited with: %s', service, error)
-            else:
-                logging.debug('%s resulted in: %s', service, success)
+    backend = options.get('backend')
+    if backend is None:
+        return execute_converter(options['bin'], *arguments, timeout=timeout)
+
+    logging.debug('handing conversion to worker: %s', arguments[0])
+    with tracing.span('converter', 'convert', command=options['bin']):
+        return backend.convert(list(arguments), timeout=timeout)
 
-            if not success:
-                faileds.append(service)
 
-            index += 1
-            logging.info('fineshed: %s success: %s status: %s',
-                         service,
-                         success,
-                         f'{index}/{services_count}')
-    return faileds
+async def run_converter_async(options: dict, *arguments, timeout: float = None) -> bool:
+    ''' Same as run_converter, awaiting the converter on the event loop '''
 
+    backend = options.get('backend')
+    if backend is None:
+        return await aioengine.execute_converter(options['bin'], *arguments, timeout=timeout)
+    return await asyncio.to_thread(backend.convert, list(arguments), timeout=timeout)
 
-def display_status(name: str, total: int, items_failed: list) -> None:
+
+def job_timeout(options: dict, *paths) -> float:
+    ''' Return how many seconds the conversion of paths may take. Unless the
+        service has a fixed timeout, it grows with the estimated cost. '''
+
+    timeout = options['kwargs'].get('timeout')
+    if timeout:
+        return timeout * len(paths)
+
+    cost = sum(options['cost'](path) for path in paths)
+    return max(MIN_TIMEOUT, cost * TIMEOUT_FACTOR)
+
+
+def display_status(name: str,
+                   total: int,
+                   items_failed: list,
+                   timeouts: int = 0,
+                   retries: int = 0,
+                   deduplicated: int = 0) -> None:
     ''' Helper function to display a nice overview about execution facts '''
 
     failure = len(items_failed)
@@ -221,95 +953,272 @@ def display_status(name: str, total: int, items_failed: list) -> None:
                  succeeded,
                  failure,
                  proportion_of_success)
+    if timeouts or retries:
+        logging.info('%s conversions timed out: %d retried: %d', name, timeouts, retries)
+    if deduplicated:
+        logging.info('%s conversions saved by deduplication: %d', name, deduplicated)
 
 
-def service_runner(worker: callable,
-                   options: dict,
-                   name: str,
-                   directory: str,
-                   **executor_kwargs) -> Union[None, Tuple[int, List[str]]]:
-    ''' Scan targeted files in directory and try to convert them in parallel '''
-
-    # unpack predicate options
-    pred_func = options['predicate']['func']
-    pred_args = options['predicate']['args']
-    pred_kwargs = options['predicate']['kwargs']
-
-    predicate = lambda f: pred_func(f, *pred_args, **pred_kwargs)
-    items = [entry.path for entry in expose_files(directory, predicate)]
-    if items:
-        items_count = len(items)
-        logging.debug('%s files found: %d', name, items_count)
-        failed_items = wait_futures(worker, items, options, **executor_kwargs)
-        return (items_count, failed_items)
-    return None
+def trusted_path(path: str) -> str:
+    ''' Return where the converter places the TRUSTED version of path '''
 
+    root, extension = os.path.splitext(path)
+    return f'{root}.trusted{extension}'
 
-def chained_foreground_run(services: list,
-                           next_run: callable,
-                           *run_args,
-                           **run_kwargs) -> None:
-    ''' Execute services in a chain in the incoming order. After all services are
-        done calls next_run callable. '''
 
-    def callback(_):
-        if not services:
-            logging.debug('no more services on foreground, calling next run...')
-            next_run(*run_args, **run_kwargs)
-        else:
-            logging.debug('calling next service: %s', services[0])
-            chained_foreground_run(services, next_run, *run_args, **run_kwargs)
+def record_state(options: dict, path: str, state: str) -> None:
+    ''' Append a state transition of path to the journal of the run, if any '''
+
+    run_journal = options.get('journal')
+    if run_journal is not None:
+        run_journal.record(path, state)
 
-    if not services:
-        callback(None)
-        return
 
-    logging.debug('running on foreground: %s', services)
-    args, kwargs = services.pop(0)
+def mark_converted(options: dict, path: str) -> None:
+    ''' Record that path has its TRUSTED output, handing the output to the
+        delivery of the run, if any '''
 
-    with futures.ThreadPoolExecutor(max_workers=1) as executor:
-        future = executor.submit(service_runner, *args, **kwargs)
-        future.add_done_callback(callback)
-        display_service_futures({future: args[2]})
+    record_state(options, path, 'converted')
+    run_delivery = options.get('delivery')
+    if run_delivery is not None:
+        run_delivery.add(trusted_path(path))
 
 
-def background_run(services: list, max_workers: int = None) -> None:
-    ''' Execute services in parallel '''
+def open_converter_backend(options: dict) -> None:
+    ''' Attach the persistent workers of the service binary to service
+        options, when the service does not spawn it for every job '''
 
-    if not services:
-        logging.info('any available service to run in background, aborting...')
+    backend_kwargs = options['kwargs']
+    if backend_kwargs.get('backend', 'spawn') == 'spawn':
         return
 
-    # by default, allocate 2 thread for each service
-    if max_workers is None:
-        max_workers = len(services)
+    processes = (backend_kwargs.get('processes')
+                 or options['executor_kwargs'].get('max_workers')
+                 or DEFAULT_PROCESSES)
+    options['backend'] = backends.open_backend(options['bin'], processes)
 
-    logging.debug('starting background run for services: %s', services)
 
-    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_service = {executor.submit(service_runner, *args, **kwargs): args[2]
-                             for args, kwargs in services}
-        display_service_futures(future_to_service)
+def open_conversion_cache(options: dict) -> None:
+    ''' Attach the shared conversion cache to service options '''
 
+    cache_kwargs = options['kwargs']
+    if cache_kwargs.get('no_cache'):
+        return
 
-def display_service_futures(future_to_service: dict):
-    ''' Helper function to display fineshed services '''
+    options['cache'] = convcache.open_cache(cache_kwargs['cache_dir'],
+                                            cache_kwargs['cache_size'] * 1024 * 1024)
 
-    for service, result, error in handle_futures(future_to_service):
-        if error:
-            logging.error('%s service exited with: %s', service, error)
-        elif result:
-            display_status(service, *result)
-        else:
-            logging.info('no %s files found', service)
 
-        logging.info('service fineshed: %s', service)
+def cached_conversion(path: str, dest: str, options: dict, convert: callable,
+                      namespace: str = None) -> Tuple[bool, bool]:
+    ''' Place the cached TRUSTED output of path on dest or call convert, caching
+        its output. Return whether it succeeded and whether it was a cache hit.
+        Outputs are cached apart for each converter, or for each namespace. '''
+
+    cache = options.get('cache')
+    if cache is None:
+        return (convert(), False)
+
+    with tracing.span('fetch', 'cache', path=path):
+        key = cache.key(path, namespace=namespace or os.path.basename(options['bin']))
+        hit = cache.fetch(key, dest)
+    if hit:
+        logging.debug('reusing cached conversion of: %s', path)
+        return (True, True)
+
+    result = convert()
+    if result and os.path.isfile(dest):
+        with tracing.span('store', 'cache', path=dest):
+            cache.store(key, dest)
+    return (result, False)
+
+
+def move_untrusted(path: str, untrusted_dir: str, root: str = None) -> None:
+    ''' Keep the UNTRUSTED original away from converted files, under its path
+        relative to root so same named files do not collide '''
+
+    logging.debug('moving untrusted file to default directory: %s', path)
+    with tracing.span('move', 'move', path=path):
+        placement.move_to_store(path, untrusted_dir, root)
+
+
+def keep_untrusted(path: str, options: dict) -> None:
+    ''' Move the UNTRUSTED original of a converted file to its service store '''
+
+    move_untrusted(path, options['kwargs']['untrusted_dir'], options.get('root'))
+    record_state(options, path, 'moved')
+
+
+def share_conversion(source: str, path: str, options: dict) -> bool:
+    ''' Give path the TRUSTED output converted from source, an identical file '''
+
+    used = placement.link(trusted_path(source), trusted_path(path),
+                          mode=options['kwargs']['dedup_link'])
+    logging.debug('shared conversion of: %s with: %s by %s', source, path, used)
+    mark_converted(options, path)
+
+    keep_untrusted(path, options)
+    return True
 
 
 def run_pdfs(path: str, options: dict) -> bool:
     ''' Safely convert UNTRUSTED pdf to TRUSTED '''
 
-    return execute_converter(options['bin'], path)
+    convert = lambda: run_converter(options, path, timeout=job_timeout(options, path))
+    result, from_cache = cached_conversion(path, trusted_path(path), options, convert)
+    if result:
+        mark_converted(options, path)
+
+        # the converter itself moves away the original pdf, but not on cache hits
+        if from_cache:
+            keep_untrusted(path, options)
+        else:
+            record_state(options, path, 'moved')
+    return result
+
+
+def run_pdf_batch(paths: List[str], options: dict) -> List[bool]:
+    ''' Safely convert several UNTRUSTED pdfs with a single converter, so a
+        single DispVM is started for all of them. Return the result of each
+        path, in order, told by its TRUSTED output and its moved original. '''
+
+    cache = options.get('cache')
+    keys, results, to_convert = {}, {}, []
+    for path in paths:
+        if cache is not None:
+            # the converter moves the original away, so hash it before
+            keys[path] = cache.key(path, namespace=os.path.basename(options['bin']))
+            if cache.fetch(keys[path], trusted_path(path)):
+                logging.debug('reusing cached conversion of: %s', path)
+                mark_converted(options, path)
+                keep_untrusted(path, options)
+                results[path] = True
+                continue
+        to_convert.append(path)
+
+    if to_convert:
+        # files converted before a timeout are kept, so batches are not retried
+        try:
+            converted = run_converter(options, *to_convert,
+                                      timeout=job_timeout(options, *to_convert))
+        except pipeline.TransientError as error:
+            logging.warning('batch conversion stopped: %s', error)
+            converted = False
+
+        if not converted:
+            logging.warning('batch conversion of %d files failed, checking '
+                            'each output', len(to_convert))
+
+        for path in to_convert:
+            dest = trusted_path(path)
+            # after a failure, an output is whole only once the converter
+            # moved its original away, others may have been cut short
+            results[path] = os.path.isfile(dest) and (converted or not os.path.exists(path))
+            if not results[path] and os.path.isfile(dest):
+                logging.warning('discarding partial output: %s', dest)
+                os.unlink(dest)
+            if results[path]:
+                mark_converted(options, path)
+                record_state(options, path, 'moved')
+                if cache is not None:
+                    cache.store(keys[path], dest)
+
+    return [results[path] for path in paths]
+
+
+async def cached_conversion_async(path: str, dest: str, options: dict,
+                                  convert: callable, namespace: str = None) -> Tuple[bool, bool]:
+    ''' Same as cached_conversion, awaiting the convert coroutine function and
+        moving the cache copies off the event loop '''
+
+    cache = options.get('cache')
+    if cache is None:
+        return (await convert(), False)
+
+    key = await asyncio.to_thread(cache.key, path,
+                                  namespace=namespace or os.path.basename(options['bin']))
+    if await asyncio.to_thread(cache.fetch, key, dest):
+        logging.debug('reusing cached conversion of: %s', path)
+        return (True, True)
+
+    result = await convert()
+    if result and os.path.isfile(dest):
+        await asyncio.to_thread(cache.store, key, dest)
+    return (result, False)
+
+
+async def run_pdfs_async(path: str, options: dict) -> bool:
+    ''' Safely convert UNTRUSTED pdf to TRUSTED on the event loop '''
+
+    convert = lambda: run_converter_async(options, path, timeout=job_timeout(options, path))
+    result, from_cache = await cached_conversion_async(path, trusted_path(path),
+                                                       options, convert)
+    if result:
+        await asyncio.to_thread(mark_converted, options, path)
+        if from_cache:
+            await asyncio.to_thread(keep_untrusted, path, options)
+        else:
+            await asyncio.to_thread(record_state, options, path, 'moved')
+    return result
+
+
+def discard_chunks(chunks: List[str], untrusted_dir: str) -> None:
+    ''' Remove the UNTRUSTED chunks the converter moved away, the whole
+        original is kept instead '''
+
+    for chunk in chunks:
+        moved = os.path.join(os.path.expanduser(untrusted_dir), os.path.basename(chunk))
+        if pdfsplit.CHUNK_MARKER in moved and os.path.isfile(moved):
+            os.unlink(moved)
+
+
+def run_pdf_split(path: str, options: dict) -> bool:
+    ''' Split a large UNTRUSTED pdf in page range chunks, which the pdf
+        service converts in parallel, and merge their TRUSTED outputs in page
+        order. The whole pdf is handed to the pdf service when any of that
+        fails. '''
+
+    index = options['index']
+    pdf_options = index.service_options['pdf']
+    split_kwargs = options['kwargs']
+    ranges = pdfsplit.page_ranges(estimate.pdf_pages(path) or 0, split_kwargs['chunk_pages'])
+
+    split_dir = os.path.expanduser(split_kwargs['split_dir'])
+    os.makedirs(split_dir, exist_ok=True)
+    workdir = tempfile.mkdtemp(prefix='split-', dir=split_dir)
+
+    # a hostile pdf must not wedge the split or the merge
+    timeout = job_timeout(pdf_options, path)
+    chunks = []
+    try:
+        with tracing.span('split', 'split', path=path, chunks=len(ranges)):
+            chunks = pdfsplit.split(path, workdir, ranges, split_kwargs['split_command'],
+                                    timeout=timeout)
+
+        # chunks are steps of the conversion of path, nothing to journal or
+        # deliver, and their outputs would only evict real ones from the cache
+        chunk_options = {**pdf_options, 'journal': None, 'delivery': None, 'cache': None}
+        results = index.add_parts('pdf', chunks, chunk_options).wait()
+
+        if all(results.values()):
+            with tracing.span('merge', 'split', path=path):
+                pdfsplit.merge([trusted_path(chunk) for chunk in chunks], trusted_path(path),
+                               split_kwargs['merge_command'], timeout=timeout)
+            logging.debug('merged %d chunks of: %s', len(chunks), path)
+            mark_converted(options, path)
+            keep_untrusted(path, options)
+            return True
+
+        logging.warning('some chunks of %s failed, converting it whole',
+                        os.path.basename(path))
+    except pdfsplit.SplitError as error:
+        logging.warning('unable to split %s, converting it whole: %s',
+                        os.path.basename(path), error)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        discard_chunks(chunks, split_kwargs['untrusted_dir'])
+
+    return index.add_parts('pdf', [path], pdf_options).wait()[path]
 
 
 def ensure_untrusted_images_dir(options: dict) -> None:
@@ -323,72 +1232,433 @@ def ensure_untrusted_images_dir(options: dict) -> None:
         os.mkdir(untrusted_imgs_dir)
 
 
+def downscale_namespace(path: str, options: dict) -> Union[str, None]:
+    ''' Return the cache namespace of the conversion of an image above the
+        pixel cap of the service, which is downscaled first, else None '''
+
+    max_pixels = options['kwargs'].get('max_pixels')
+    if not max_pixels or not imagescale.is_oversized(path, max_pixels):
+        return None
+    return f'{os.path.basename(options["bin"])}@{max_pixels}'
+
+
+def downscaled_image(path: str, options: dict) -> str:
+    ''' Return a copy of the UNTRUSTED image downscaled to the pixel cap of
+        the service, or the image itself when that fails '''
+
+    kwargs = options['kwargs']
+    try:
+        with tracing.span('downscale', 'convert', path=path):
+            return imagescale.downscale(path, kwargs['max_pixels'], kwargs['downscale_command'],
+                                        timeout=job_timeout(options, path))
+    except imagescale.ScaleError as error:
+        logging.warning('unable to downscale %s, converting it whole: %s',
+                        os.path.basename(path), error)
+        return path
+
+
 def run_images(path: str, options: dict) -> bool:
-    ''' Safely convert UNTRUSTED image to TRUSTED '''
+    ''' Safely convert UNTRUSTED image to TRUSTED, downscaled first when it
+        is above the pixel cap '''
 
-    dest_path = os.path.dirname(path)
-    dest_name = os.path.basename(path)
-    dest_ext = os.path.splitext(dest_name)[1]
-    dest = os.path.join(dest_path,
-                        dest_name.replace(dest_ext, f'.trusted{dest_ext}'))
+    dest = trusted_path(path)
+    namespace = downscale_namespace(path, options)
 
-    result = execute_converter(options['bin'], path, dest)
+    def convert():
+        source = downscaled_image(path, options) if namespace else path
+        try:
+            return run_converter(options, source, dest, timeout=job_timeout(options, path))
+        finally:
+            if source != path:
+                imagescale.discard(source)
+
+    result, _ = cached_conversion(path, dest, options, convert, namespace=namespace)
     if result:
-        logging.debug('moving old image to default directory: %s', path)
-        shutil.move(path, options['kwargs']['untrusted_dir'])
+        mark_converted(options, path)
+        keep_untrusted(path, options)
+    return result
+
+
+async def run_images_async(path: str, options: dict) -> bool:
+    ''' Safely convert UNTRUSTED image to TRUSTED on the event loop '''
+
+    dest = trusted_path(path)
+    namespace = await asyncio.to_thread(downscale_namespace, path, options)
+
+    async def convert():
+        source = path
+        if namespace:
+            source = await asyncio.to_thread(downscaled_image, path, options)
+        try:
+            return await run_converter_async(options, source, dest,
+                                             timeout=job_timeout(options, path))
+        finally:
+            if source != path:
+                await asyncio.to_thread(imagescale.discard, source)
+
+    result, _ = await cached_conversion_async(path, dest, options, convert, namespace=namespace)
+    if result:
+        await asyncio.to_thread(mark_converted, options, path)
+        await asyncio.to_thread(keep_untrusted, path, options)
     return result
 
 
 def run_zips(path: str, options: dict) -> bool:
     ''' Unzip the archive on path '''
 
-    unzip(path, flush=options['kwargs']['flush'])
+    index = options.get('index')
+    if index is None:
+        unzip(path, flush=options['kwargs']['flush'])
+        return True
+
+    # members go through classification as soon as they are written, nested
+    # archives are handled by the extraction itself up to its maximum depth
+    run_journal = options.get('journal')
+    record_state(options, path, 'extracting')
+    members = extract.extract_archive(path,
+                                      claim=index.claim,
+                                      flush_nested=options['kwargs']['flush'],
+                                      skip=run_journal.is_settled if run_journal else None,
+                                      **options['kwargs']['limits'])
+    try:
+        index.stream(members, exclude=('zip',))
+    except extract.ExtractionError as error:
+        logging.error('extraction of %s stopped: %s', path, error)
+        return False
+
+    if options['kwargs']['flush']:
+        logging.debug('zip file will be removed: %s', os.path.basename(path))
+        with tracing.span('unlink', 'move', path=path):
+            os.unlink(path)
+    record_state(options, path, 'extracted')
     return True
 
 
-def _map_service(name: str,
-                 directory: str,
-                 options: dict,
-                 foregrounds: list,
-                 backgrounds: list) -> None:
-    ''' Helper function to map a service option to correct list '''
+def display_results(results: dict, stats: dict = None) -> None:
+    ''' Helper function to display an overview of every service '''
 
-    args = [options['worker'], options, name, directory]
-    kwargs = options['executor_kwargs']
-    service_list = backgrounds if options['background'] else foregrounds
-    service_list.append((args, kwargs))
+    for service, (total, failed) in results.items():
+        if total:
+            service_stats = (stats or {}).get(service, {})
+            display_status(service, total, failed,
+                           timeouts=service_stats.get('timeouts', 0),
+                           retries=service_stats.get('retries', 0),
+                           deduplicated=service_stats.get('deduplicated', 0))
+        else:
+            logging.info('no %s files found', service)
+        logging.info('service fineshed: %s', service)
+
+
+def claim_members(path: str, index: ScanIndex, run_journal: journal.Journal) -> None:
+    ''' Make the walk ignore the members of an archive whose extraction was
+        interrupted, some may be cut short. Extracting it again writes them
+        over and hands them to their services. '''
+
+    # without the zip service nothing would extract them again
+    zip_options = index.service_options.get('zip')
+    if zip_options is None or not os.path.isfile(path):
+        return
+
+    max_depth = (zip_options['kwargs']['limits'].get('max_depth')
+                 or extract.DEFAULT_LIMITS['max_depth'])
+    try:
+        members = extract.member_paths(path, max_depth)
+    except (OSError, zipfile.BadZipFile) as error:
+        logging.warning('unable to list members of interrupted extraction %s: %s',
+                        path, error)
+        return
+
+    for member in members:
+        if not run_journal.is_settled(member):
+            index.claim(member)
+    logging.debug('members of interrupted extraction %s left to it: %d', path, len(members))
+
+
+def open_journal(cli_args: argparse.Namespace, index: ScanIndex) -> Union[None, journal.Journal]:
+    ''' Open the journal of runs on directory. When resuming, make the index
+        skip what the previous run did and discard what it left half done. '''
+
+    if cli_args.no_journal:
+        if cli_args.resume:
+            logging.warning('nothing to resume from without a journal')
+        return None
 
+    journal.prune(cli_args.journal_dir)
+    run_journal = journal.Journal(journal.journal_path(cli_args.directory, cli_args.journal_dir),
+                                  resume=cli_args.resume)
+    if not cli_args.resume:
+        return run_journal
 
-def run_services(cli_args: argparse.Namespace, service_options: dict) -> None:
-    ''' Call all services in using a specific execution flow '''
+    for path in run_journal.settled():
+        index.claim(path)
 
-    directory = cli_args.directory
+    in_flight = run_journal.in_flight()
+    for path, entry in in_flight.items():
+        if entry['state'] == 'extracting':
+            claim_members(path, index, run_journal)
+            continue
 
-    background_services, foreground_services = [], []
+        output = entry.get('output')
+        if not output or not os.path.exists(output):
+            continue
 
+        if os.path.exists(path):
+            # the output of an interrupted conversion may be partial
+            logging.debug('discarding output of interrupted conversion: %s', output)
+            os.unlink(output)
+        else:
+            # the converter was done and moved the original away
+            index.claim(output)
+
+    logging.info('resuming run, files done: %d in flight: %d',
+                 sum(1 for entry in run_journal.previous.values() if entry.get('settled')),
+                 len(in_flight))
+    return run_journal
+
+
+def run_services(cli_args: argparse.Namespace,
+                 service_options: dict,
+                 file_index: fileindex.FileIndex = None,
+                 slots: scheduler.SlotScheduler = None,
+                 on_start: callable = None) -> int:
+    ''' Call all services while files are found on directory. Return an
+        exit code, failing when some files could not be delivered.
+
+        A daemon hands its open file index and the slots of its converters,
+        shared by every job, and gets the runner of the job through on_start. '''
+
+    active_options = {}
     for service, options in service_options.items():
         if options['should_skip']:
             logging.info('skipping service: %s', service)
         else:
-            options_copy = options.copy()
-            _map_service(service,
-                         directory,
-                         options_copy,
-                         foreground_services,
-                         background_services)
+            active_options[service] = options.copy()
+
+    # a single file is handled as part of the directory holding it
+    root = cli_args.directory
+    if not os.path.isdir(root):
+        root = os.path.dirname(os.path.abspath(root))
+
+    file_priorities = None
+    if cli_args.priority_rules:
+        try:
+            file_priorities = priorities.load(cli_args.priority_rules, root)
+        except (OSError, priorities.RuleError) as error:
+            logging.error('unable to load priority rules: %s', error)
+            return 1
+
+    own_file_index = file_index is None
+    if not cli_args.incremental:
+        file_index = None
+    elif own_file_index:
+        file_index = fileindex.FileIndex(cli_args.index_file)
+
+    tree_watcher = None
+    if cli_args.watch:
+        tree_watcher = watcher.open_watcher(cli_args.directory,
+                                            polling=cli_args.watch_polling,
+                                            pid=cli_args.watch_pid,
+                                            done_file=cli_args.done_file,
+                                            idle=cli_args.watch_idle,
+                                            settle=cli_args.watch_settle)
+
+    index = ScanIndex(active_options, file_index=file_index, watcher=tree_watcher)
+    run_journal = open_journal(cli_args, index)
+
+    run_delivery = None
+    if cli_args.deliver:
+        run_delivery = delivery.open_delivery(root,
+                                              command=cli_args.deliver_command,
+                                              max_files=cli_args.deliver_files,
+                                              max_bytes=cli_args.deliver_size * 1024 * 1024,
+                                              window=cli_args.deliver_window,
+                                              pack=cli_args.deliver_pack)
+
+    for service, options_copy in active_options.items():
+        options_copy['index'] = index
+        options_copy['root'] = root
+        options_copy['journal'] = run_journal
+        options_copy['delivery'] = run_delivery
+        for hook in options_copy['hooks']:
+            hook_name = getattr(hook, '__name__', str(hook))
+            logging.debug('%s executing hook: %s', service, hook_name)
+            hook(options_copy)
+
+    engine = pipeline.Pipeline
+    if cli_args.engine == 'asyncio' and slots is None:
+        engine = aioengine.AsyncPipeline
+    runner = engine(index,
+                    active_options,
+                    max_workers=cli_args.max_workers,
+                    max_queued=cli_args.max_queued,
+                    budget=cli_args.converter_memory,
+                    policy=cli_args.schedule,
+                    max_retries=cli_args.retries,
+                    backoff=cli_args.retry_backoff,
+                    deduplicate=not cli_args.no_dedup,
+                    journal=run_journal,
+                    slots=slots,
+                    priorities=file_priorities)
+    if on_start is not None:
+        on_start(runner)
+    try:
+        results = runner.run(cli_args.directory)
+        if run_delivery is not None:
+            # whatever was not converted is shipped as it is, as before
+            run_delivery.add_rest()
+    finally:
+        if run_journal is not None:
+            run_journal.close()
+        delivered = run_delivery.close() if run_delivery is not None else True
+    display_results(results, runner.stats)
+    if runner.first_converted is not None:
+        logging.info('first file converted after: %.1fs', runner.first_converted)
+    if file_priorities is not None:
+        if runner.first_useful is not None:
+            logging.info('first useful file converted after: %.1fs', runner.first_useful)
+        else:
+            logging.info('no useful file converted')
+    logging.info('converter memory peak: %d of %d',
+                 runner.scheduler.peak_used,
+                 runner.scheduler.budget)
+
+    caches = {id(opt['cache']): opt['cache'] for opt in active_options.values()
+              if opt.get('cache') is not None}
+    for cache in caches.values():
+        logging.info('conversion cache hits: %d misses: %d', cache.hits, cache.misses)
+
+    if file_index is not None and own_file_index:
+        file_index.close()
+
+    converters = {service: stats for service, stats in runner.stats.items()
+                  if active_options[service]['weight'] and stats['done']}
+    if converters:
+        try:
+            estimate.record_rates(cli_args.rates_file, converters)
+        except OSError as error:
+            logging.warning('unable to record conversion rates: %s', error)
+
+    if run_delivery is not None:
+        logging.info('delivered batches: %d bytes: %d', run_delivery.batches, run_delivery.bytes)
+        if not delivered:
+            log_list('some files could not be delivered:', run_delivery.failed)
+            return 1
+    return 0
 
-            for hook in options['hooks']:
-                hook_name = getattr(hook, '__name__', str(hook))
-                logging.debug('%s executing hook: %s', service, hook_name)
-                hook(options_copy)
 
-    sort_func = lambda args: args[0][1].get('priority') or 0
-    foreground_services.sort(key=sort_func, reverse=True)
-    chained_foreground_run(foreground_services,
-                           background_run,
-                           background_services,
-                           max_workers=cli_args.max_workers)
+def run_plan(cli_args: argparse.Namespace, service_options: dict) -> dict:
+    ''' Print the plan of a run on directory without changing anything '''
 
+    active_options = {service: options for service, options in service_options.items()
+                      if not options['should_skip']}
+
+    file_index = None
+    if cli_args.incremental:
+        file_index = fileindex.FileIndex(cli_args.index_file)
+
+    index = ScanIndex(active_options, file_index=file_index, read_only=True)
+    plan = planner.build_plan(index,
+                              cli_args.directory,
+                              rates=estimate.load_rates(cli_args.rates_file),
+                              max_workers=cli_args.max_workers,
+                              budget=cli_args.converter_memory)
+    if file_index is not None:
+        file_index.close()
+
+    json.dump(plan, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+    totals = plan['totals']
+    logging.info('planned files: %d converter launches: %d converter time: %.0fs '
+                 'wall time: %.0fs', totals['files'], totals['launches'],
+                 totals['converter_seconds'], totals['wall_seconds'])
+    return plan
+
+
+def job_progress(stats: dict) -> dict:
+    ''' Return how far each service of a job is '''
+
+    return {service: {'found': service_stats['found'],
+                      'done': service_stats['done'],
+                      'failed': len(service_stats['failed'])}
+            for service, service_stats in stats.items()}
+
+
+def run_daemon(cli_args: argparse.Namespace, service_options: dict) -> int:
+    ''' Process jobs submitted on the socket until interrupted. The file
+        index, the conversion caches and the converter slots stay open
+        between jobs, and every job shares the same converter budget. '''
+
+    if cli_args.engine == 'asyncio':
+        logging.warning('the daemon runs conversions on threads only')
+
+    active_options = {service: options for service, options in service_options.items()
+                      if not options['should_skip']}
+    file_index = fileindex.FileIndex(cli_args.index_file)
+    slots = pipeline.build_scheduler(active_options,
+                                     max_workers=cli_args.max_workers,
+                                     max_queued=cli_args.max_queued,
+                                     budget=cli_args.converter_memory,
+                                     policy=cli_args.schedule,
+                                     ranked=bool(cli_args.priority_rules))
+    slots.start()
+
+    def run_job(path: str, options: dict, reply: callable) -> dict:
+        job_args = argparse.Namespace(**{**vars(cli_args), **options, 'directory': path})
+        runners, finished = [], threading.Event()
+
+        def report():
+            while not finished.wait(daemon.PROGRESS_INTERVAL):
+                if runners:
+                    reply('progress', services=job_progress(runners[0].stats))
+
+        reporter = threading.Thread(target=report, name='progress', daemon=True)
+        reporter.start()
+        try:
+            exit_code = run_services(job_args, service_options,
+                                     file_index=file_index,
+                                     slots=slots,
+                                     on_start=runners.append)
+        finally:
+            finished.set()
+        return {'exit_code': exit_code, 'stats': runners[0].stats if runners else {}}
+
+    server = daemon.JobServer(cli_args.socket, run_job)
+    # stop the same way on SIGTERM as on ^C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    logging.info('daemon listening on: %s', server.socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info('daemon stopping')
+    finally:
+        server.server_close()
+        slots.close()
+        file_index.close()
+    return 0
+
+
+def run_submit(cli_args: argparse.Namespace) -> int:
+    ''' Have the daemon process directory and follow its job. Return the
+        exit code of the job. '''
+
+    options = {key: getattr(cli_args, key) for key in daemon.JOB_OPTIONS}
+    try:
+        for event in daemon.submit(cli_args.socket, cli_args.directory, **options):
+            if event['event'] == 'accepted':
+                logging.info('job %d accepted: %s', event['job'], event['path'])
+            elif event['event'] == 'progress':
+                for service, progress in event['services'].items():
+                    logging.info('%s found: %d done: %d failed: %d', service,
+                                 progress['found'], progress['done'], progress['failed'])
+            elif event['event'] == 'done':
+                stats = event['stats']
+                display_results({service: (service_stats['found'], service_stats['failed'])
+                                 for service, service_stats in stats.items()}, stats)
+                return event['exit_code']
+    except (OSError, daemon.DaemonError) as error:
+        logging.error('job on %s failed: %s', cli_args.directory, error)
+    return 1
 
 
 def setup_logging(verbose: bool) -> None:
@@ -413,13 +1683,20 @@ def get_option_template(**kwargs) -> dict:
         'should_skip': kwargs.get('should_skip', False),
         'no_check': kwargs.get('no_check', False),
         'package': kwargs.get('package'),
-        'priority': kwargs.get('priority', 0), # only used when not background
-        'background': kwargs.get('background', True),
+        'priority': kwargs.get('priority', 0), # tried first when classifying
+        'background': kwargs.get('background', True), # or run while scanning
+        'weight': kwargs.get('weight', 1), # share of the converter budget per job
+        'cost': kwargs.get('cost', estimate.size_cost), # expected seconds of some job
 
         # task config
         'worker': kwargs.get('worker'),
+        'batch_worker': kwargs.get('batch_worker'), # converts several files at once
+        'share_worker': kwargs.get('share_worker'), # gives a copy the output of another
+        'aio_worker': kwargs.get('aio_worker'), # coroutine used by the asyncio engine
         'bin': kwargs.get('binary'),
         'predicate': kwargs.get('predicate', get_predicate_template(None)),
+        'mimes': kwargs.get('mimes', ()), # classify by mime type instead of predicate
+        'output': kwargs.get('output'), # path of the file produced from some input
         'kwargs': kwargs.get('kwargs', {}),
         'executor_kwargs': kwargs.get('executor_kwargs', {}),
 
@@ -438,20 +1715,81 @@ def get_predicate_template(func: callable, *args, **kwargs) -> dict:
     }
 
 
+def cache_kwargs(**kwargs) -> dict:
+    ''' Return the conversion cache settings shared by converter services '''
+
+    return {
+        'no_cache': kwargs.get('no_cache', False),
+        'cache_dir': kwargs.get('cache_dir') or '~/.cache/qubes-usync',
+        'cache_size': kwargs.get('cache_size') or 1024,
+    }
+
+
 def pdf_options(**kwargs) -> dict:
     ''' Return default pdf service options '''
 
-    predicate = get_predicate_template(is_mimetype, 'application/pdf')
-
     opt_kwargs = dict(worker=run_pdfs,
-                      predicate=predicate,
-                      package='qubes-pdf-converter',)
+                      batch_worker=run_pdf_batch,
+                      share_worker=share_conversion,
+                      aio_worker=run_pdfs_async,
+                      mimes=('application/pdf',),
+                      output=trusted_path,
+                      cost=estimate.pdf_cost,
+                      package='qubes-pdf-converter',
+                      hooks=[open_conversion_cache, open_converter_backend],)
 
     opt_kwargs['should_skip'] = kwargs.get('skip_pdf')
     opt_kwargs['binary'] = kwargs.get('pdf_bin_converter') or '/usr/bin/qvm-convert-pdf'
+    opt_kwargs['weight'] = kwargs.get('pdf_job_memory') or 800
+
+    opt_kwargs['kwargs'] = {
+        'untrusted_dir': kwargs.get('untrusted_pdf_dir') or '~/QubesUntrustedPDFs',
+        'timeout': kwargs.get('pdf_timeout'),
+        'dedup_link': kwargs.get('dedup_link') or 'reflink',
+        'backend': kwargs.get('pdf_backend') or 'spawn',
+        'processes': kwargs.get('backend_processes'),
+        **cache_kwargs(**kwargs),
+    }
 
     opt_kwargs['executor_kwargs'] = {
         'max_workers': kwargs.get('max_pdf_workers'),
+        'batch_files': kwargs.get('batch_files') or 1,
+        'batch_bytes': (kwargs.get('batch_size') or 20) * 1024 * 1024,
+    }
+
+    return get_option_template(**opt_kwargs)
+
+
+def pdf_split_options(**kwargs) -> dict:
+    ''' Return default options of the service splitting large pdfs '''
+
+    merge_command = kwargs.get('pdf_merge_command') or pdfsplit.MERGE_COMMAND
+    opt_kwargs = dict(worker=run_pdf_split,
+                      mimes=('application/pdf',),
+                      output=trusted_path,
+                      weight=0,
+                      priority=10,)
+
+    # splitting is only worth it for pdfs the pdf service would convert
+    opt_kwargs['should_skip'] = kwargs.get('skip_pdf') or not kwargs.get('pdf_split')
+    opt_kwargs['no_check'] = opt_kwargs['should_skip']
+    # the split runs in a disposable qube, only the merge needs a tool here
+    opt_kwargs['binary'] = shutil.which(shlex.split(merge_command)[0]) or merge_command
+    opt_kwargs['package'] = 'qpdf'
+
+    min_pages = kwargs.get('pdf_split_pages') or pdfsplit.SPLIT_PAGES
+    opt_kwargs['predicate'] = get_predicate_template(pdfsplit.is_large, min_pages)
+
+    opt_kwargs['kwargs'] = {
+        'untrusted_dir': kwargs.get('untrusted_pdf_dir') or '~/QubesUntrustedPDFs',
+        'chunk_pages': kwargs.get('pdf_chunk_pages') or pdfsplit.CHUNK_PAGES,
+        'split_command': kwargs.get('pdf_split_command') or pdfsplit.SPLIT_COMMAND,
+        'merge_command': merge_command,
+        'split_dir': kwargs.get('pdf_split_dir') or '~/.cache/qubes-usync/split',
+    }
+
+    opt_kwargs['executor_kwargs'] = {
+        'max_workers': kwargs.get('max_pdf_workers') or 2,
     }
 
     return get_option_template(**opt_kwargs)
@@ -460,19 +1798,33 @@ def pdf_options(**kwargs) -> dict:
 def image_options(**kwargs) -> dict:
     ''' Return default image service options '''
 
-    predicate = get_predicate_template(is_mimetype, 'image/png', 'image/jpeg')
-
     opt_kwargs = dict(worker=run_images,
-                      predicate=predicate,
+                      aio_worker=run_images_async,
+                      share_worker=share_conversion,
+                      mimes=('image/png', 'image/jpeg',),
+                      output=trusted_path,
                       package='qubes-img-converter',
-                      hooks=[ensure_untrusted_images_dir],)
+                      hooks=[ensure_untrusted_images_dir, open_conversion_cache,
+                             open_converter_backend],)
 
     opt_kwargs['should_skip'] = kwargs.get('skip_img')
     opt_kwargs['binary'] = kwargs.get('img_bin_converter') or '/usr/bin/qvm-convert-img'
+    opt_kwargs['weight'] = kwargs.get('img_job_memory') or 400
+
+    # downscaled images cost no more than the cap
+    max_pixels = kwargs.get('max_image_pixels')
+    opt_kwargs['cost'] = lambda path: estimate.image_cost(path, max_pixels)
 
 
     opt_kwargs['kwargs'] = {
-        'untrusted_dir': kwargs.get('untrusted_dir') or '~/QubesUntrustedIMGs'
+        'untrusted_dir': kwargs.get('untrusted_dir') or '~/QubesUntrustedIMGs',
+        'timeout': kwargs.get('img_timeout'),
+        'dedup_link': kwargs.get('dedup_link') or 'reflink',
+        'backend': kwargs.get('img_backend') or 'spawn',
+        'max_pixels': max_pixels,
+        'downscale_command': kwargs.get('img_downscale_command') or imagescale.DOWNSCALE_COMMAND,
+        'processes': kwargs.get('backend_processes'),
+        **cache_kwargs(**kwargs),
     }
 
     opt_kwargs['executor_kwargs'] = {
@@ -485,17 +1837,26 @@ def image_options(**kwargs) -> dict:
 def zip_options(**kwargs) -> dict:
     ''' Return default zip service options '''
 
-    predicate = get_predicate_template(zipfile.is_zipfile)
-
     opt_kwargs = dict(worker=run_zips,
-                      predicate=predicate,
+                      mimes=('application/zip',),
                       no_check=True,
-                      background=False,
+                      weight=0,
                       priority=100,)
 
     opt_kwargs['should_skip'] = kwargs.get('skip_zip')
     opt_kwargs['kwargs'] = {
         'flush': not kwargs.get('keep_original_zip'),
+        'limits': {
+            'max_depth': kwargs.get('zip_max_depth'),
+            'max_bytes': (kwargs.get('zip_max_size') or 0) * 1024 * 1024 or None,
+            'max_members': kwargs.get('zip_max_members'),
+            'max_ratio': kwargs.get('zip_max_ratio'),
+            'workers': kwargs.get('zip_member_workers'),
+        },
+    }
+
+    opt_kwargs['executor_kwargs'] = {
+        'max_workers': kwargs.get('max_zip_workers') or 1,
     }
 
     return get_option_template(**opt_kwargs)
@@ -506,6 +1867,7 @@ def gen_service_options(**kwargs) -> dict:
 
     return {
         'pdf': pdf_options(**kwargs),
+        'pdfsplit': pdf_split_options(**kwargs),
         'image': image_options(**kwargs),
         'zip': zip_options(**kwargs),
     }
@@ -538,16 +1900,30 @@ def main() -> int:
 
     logging.debug('service options: \n%s', service_options)
 
+    if cli_args.plan:
+        run_plan(cli_args, service_options)
+        return 0
+
+    if cli_args.submit:
+        return run_submit(cli_args)
+
     pre_check_result = precheck(service_options)
     if pre_check_result is not None:
         return pre_check_result
 
-    run_services(cli_args, service_options)
+    if cli_args.trace:
+        tracing.start(os.path.expanduser(cli_args.trace), cli_args.trace_format)
+    try:
+        if cli_args.daemon:
+            exit_code = run_daemon(cli_args, service_options)
+        else:
+            exit_code = run_services(cli_args, service_options)
+    finally:
+        tracing.stop()
 
     logging.info('execution time: %s', datetime.datetime.now() - start_time)
-    return 0
+    return exit_code
 
 
 if __name__ == '__main__':
-    import sys
     sys.exit(main())
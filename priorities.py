@@ -0,0 +1,150 @@
+'''
+Per file priorities set by rules in a JSON file, so the files needed first
+are converted first:
+
+    {
+        "newest_first": true,
+        "rules": [
+            {"glob": "courses/*", "priority": -20},
+            {"max_age": 2, "service": "pdf", "priority": -10},
+            {"min_size": 52428800, "priority": 5},
+            {"extension": [".gif", ".bmp"], "priority": 10}
+        ]
+    }
+
+A file gets the sum of the priorities of every rule it matches, and a rule
+matches when all of its fields do. Globs are matched against the path
+relative to the synced directory, with * crossing directories; ages are in
+days and sizes in bytes. Lower priorities are converted first, and among
+equal ones the newest file first when newest_first is set.
+'''
+
+
+import os
+import json
+import time
+import fnmatch
+import logging
+
+
+from typing import (
+    List,
+    Union,
+)
+
+
+# priority of the files matched by no rule
+DEFAULT_PRIORITY = 0
+
+FIELDS = ('glob', 'service', 'extension', 'min_age', 'max_age', 'min_size', 'max_size',
+          'priority')
+
+
+class RuleError(ValueError):
+    ''' Raised when a rules file can not be used '''
+
+
+def _as_list(value: Union[str, List[str]]) -> List[str]:
+    return [value] if isinstance(value, str) else list(value)
+
+
+class Rule:
+    ''' A priority given to the files matching every one of its fields '''
+
+    def __init__(self, priority: int, glob=None, service=None, extension=None,
+                 min_age: float = None, max_age: float = None,
+                 min_size: int = None, max_size: int = None):
+        self.priority = priority
+        self.globs = _as_list(glob) if glob is not None else None
+        self.services = _as_list(service) if service is not None else None
+        self.extensions = ([extension.lower() for extension in _as_list(extension)]
+                           if extension is not None else None)
+        self.min_age = min_age
+        self.max_age = max_age
+        self.min_size = min_size
+        self.max_size = max_size
+
+    @classmethod
+    def from_dict(cls, fields: dict) -> 'Rule':
+        ''' Build a rule from an entry of the rules file '''
+
+        if not isinstance(fields, dict):
+            raise RuleError(f'rule is not an object: {fields!r}')
+        unknown = set(fields) - set(FIELDS)
+        if unknown:
+            raise RuleError(f'unknown rule fields: {", ".join(sorted(unknown))}')
+        if not isinstance(fields.get('priority'), int):
+            raise RuleError(f'rule without an integer priority: {fields!r}')
+        return cls(**fields)
+
+    def matches(self, service: str, relative: str, stat: Union[os.stat_result, None],
+                now: float) -> bool:
+        ''' Tell whether the file of service on relative path, with stat,
+            matches the rule '''
+
+        if self.services is not None and service not in self.services:
+            return False
+        if self.globs is not None and not any(fnmatch.fnmatchcase(relative, glob)
+                                              for glob in self.globs):
+            return False
+        if self.extensions is not None and \
+                os.path.splitext(relative)[1].lower() not in self.extensions:
+            return False
+
+        if (self.min_age, self.max_age, self.min_size, self.max_size) == (None,) * 4:
+            return True
+        if stat is None:
+            return False
+
+        age = (now - stat.st_mtime) / 86400
+        return not ((self.min_age is not None and age < self.min_age) or
+                    (self.max_age is not None and age > self.max_age) or
+                    (self.min_size is not None and stat.st_size < self.min_size) or
+                    (self.max_size is not None and stat.st_size > self.max_size))
+
+
+class Priorities:
+    ''' Rank the files found under root by the rules '''
+
+    def __init__(self, rules: List[Rule], root: str, newest_first: bool = False):
+        self.rules = rules
+        self.root = root
+        self.newest_first = newest_first
+
+    def rank(self, service: str, path: str) -> tuple:
+        ''' Return the scheduling rank of the file of service on path, its
+            priority and tie break, lower first '''
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stat = None
+
+        relative = os.path.relpath(path, self.root).replace(os.sep, '/')
+        now = time.time()
+        priority = sum(rule.priority for rule in self.rules
+                       if rule.matches(service, relative, stat, now))
+        if not self.newest_first or stat is None:
+            return (priority, 0)
+        return (priority, -stat.st_mtime)
+
+    def is_useful(self, rank: tuple) -> bool:
+        ''' Tell whether a rule raised a file of that rank above the others '''
+
+        return rank[0] < DEFAULT_PRIORITY
+
+
+def load(path: str, root: str) -> Priorities:
+    ''' Read the rules file on path for the files found under root '''
+
+    try:
+        with open(os.path.expanduser(path)) as reader:
+            config = json.load(reader)
+    except ValueError as error:
+        raise RuleError(f'{path} is not valid JSON: {error}') from error
+
+    if not isinstance(config, dict) or not isinstance(config.get('rules', []), list):
+        raise RuleError(f'{path} must hold an object with a list of rules')
+    rules = [Rule.from_dict(fields) for fields in config.get('rules', [])]
+    logging.debug('loaded %d priority rules from: %s', len(rules), path)
+    return Priorities(rules, root, newest_first=bool(config.get('newest_first')))
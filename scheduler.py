@@ -0,0 +1,201 @@
+'''
+Global scheduler of converter jobs sharing a single budget of resources.
+'''
+
+
+import time
+import bisect
+import logging
+import itertools
+import threading
+import collections
+
+import tracing
+
+
+from typing import (
+    Dict,
+    List,
+    Union,
+)
+
+
+# times a waiting job may be overtaken by smaller ones before it blocks them
+MAX_BYPASS = 8
+
+# rank of jobs no rule was applied to, as (priority, tie break)
+NO_RANK = (0, 0)
+
+
+def fifo(job) -> tuple:
+    ''' Run jobs in the order they are found '''
+
+    return ()
+
+
+def longest_first(job) -> tuple:
+    ''' Run the most expensive jobs first, so a long one found late in the
+        walk does not end up running alone at the end '''
+
+    return (-job.cost,)
+
+
+POLICIES = {
+    'fifo': fifo,
+    'lpt': longest_first,
+}
+
+
+class Job:
+    ''' A unit of work waiting for room on the budget '''
+
+    __slots__ = ('service', 'weight', 'func', 'args', 'cost', 'rank', 'key', 'bypassed',
+                 'created')
+
+    def __init__(self, service: str, weight: int, func: callable, *args, cost: float = 0,
+                 rank: tuple = NO_RANK):
+        self.service = service
+        self.weight = weight
+        self.func = func
+        self.args = args
+        self.cost = cost
+        self.rank = rank
+        self.key = None
+        self.bypassed = 0
+        self.created = time.perf_counter()
+
+    def __repr__(self):
+        return f'Job({self.service}, {self.args})'
+
+
+class SlotScheduler:
+    ''' Dispatch jobs of every service from one shared queue, running a job
+        only when its weight fits on the remaining budget.
+
+        Jobs are kept ordered by their rank, a (priority, tie break) pair,
+        then by the given key function, lower first, and by submission order
+        among equal keys. When the first job does not fit, smaller ones
+        behind it are started instead so the budget stays in use, until the
+        first one has been overtaken too many times. A job heavier than the
+        whole budget is run alone. '''
+
+    def __init__(self,
+                 budget: int,
+                 max_jobs: int = None,
+                 max_queued: int = None,
+                 service_limits: Dict[str, Union[int, None]] = None,
+                 threads: int = 1,
+                 key: callable = None):
+        self.budget = budget
+        self.key = key or fifo
+        self.max_jobs = max_jobs
+        self.service_limits = service_limits or {}
+        self.threads = threads
+        self.max_queued = max_queued or threads * 2
+        self.used = self.running = self.peak_used = 0
+        self._running_by_service = collections.Counter()
+        self._pending: List[tuple] = []
+        self._sequence = itertools.count()
+        self._closed = False
+        self._workers: List[threading.Thread] = []
+        self._cond = threading.Condition()
+
+    def start(self) -> None:
+        ''' Start the worker threads '''
+
+        for number in range(self.threads):
+            thread = threading.Thread(target=self._work,
+                                      name=f'converter-{number}',
+                                      daemon=True)
+            thread.start()
+            self._workers.append(thread)
+
+    def submit(self, job: Job) -> None:
+        ''' Queue a job, waiting while the queue is full '''
+
+        with self._cond:
+            self._cond.wait_for(self._has_room)
+            self._push(job)
+            self._cond.notify_all()
+
+    def _has_room(self) -> bool:
+        return len(self._pending) < self.max_queued
+
+    def _push(self, job: Job) -> None:
+        job.key = job.rank + self.key(job)
+        bisect.insort(self._pending, (job.key, next(self._sequence), job))
+
+    def _fits(self, job: Job) -> bool:
+        if self.max_jobs is not None and self.running >= self.max_jobs:
+            return False
+
+        limit = self.service_limits.get(job.service)
+        if limit is not None and self._running_by_service[job.service] >= limit:
+            return False
+
+        return self.running == 0 or self.used + job.weight <= self.budget
+
+    def _pick(self) -> Union[None, Job]:
+        for position, (_, _, job) in enumerate(self._pending):
+            if self._fits(job):
+                del self._pending[position]
+                for _, _, overtaken in self._pending[:position]:
+                    overtaken.bypassed += 1
+                return job
+
+            if job.bypassed >= MAX_BYPASS:
+                # let the budget drain until this one fits
+                break
+        return None
+
+    def _account(self, job: Job) -> None:
+        self.used += job.weight
+        self.running += 1
+        self.peak_used = max(self.peak_used, self.used)
+        self._running_by_service[job.service] += 1
+
+    def _unaccount(self, job: Job) -> None:
+        self.used -= job.weight
+        self.running -= 1
+        self._running_by_service[job.service] -= 1
+
+    def _take(self) -> Union[None, Job]:
+        with self._cond:
+            while True:
+                job = self._pick()
+                if job is not None:
+                    self._account(job)
+                    self._cond.notify_all()
+                    return job
+
+                if self._closed and not self._pending:
+                    return None
+                self._cond.wait()
+
+    def _release(self, job: Job) -> None:
+        with self._cond:
+            self._unaccount(job)
+            self._cond.notify_all()
+
+    def _work(self) -> None:
+        while True:
+            job = self._take()
+            if job is None:
+                return
+
+            logging.debug('running %s using %d of %d', job, self.used, self.budget)
+            tracing.complete('queued', 'wait', job.created, service=job.service)
+            try:
+                job.func(*job.args)
+            finally:
+                self._release(job)
+
+    def close(self) -> None:
+        ''' Let the workers finish the queued jobs and wait for them '''
+
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+        for thread in self._workers:
+            thread.join()
@@ -21,6 +21,26 @@ setup(name='qubes-app-usync',
       author_email='marques_yan@outlook.com',
       py_modules=[
           'preprocess',
+          'pipeline',
+          'extract',
+          'mimesniff',
+          'convcache',
+          'fileindex',
+          'scheduler',
+          'estimate',
+          'aioengine',
+          'tracing',
+          'planner',
+          'dedup',
+          'placement',
+          'journal',
+          'watcher',
+          'delivery',
+          'daemon',
+          'backends',
+          'pdfsplit',
+          'imagescale',
+          'priorities',
       ],
       scripts=[
           'qubes.Download',
@@ -0,0 +1,146 @@
+'''
+Functional test of aioengine module.
+'''
+
+
+import time
+import asyncio
+import zipfile
+import threading
+
+import pytest
+import aioengine
+import preprocess
+
+from test_pipeline import FakeIndex, _options
+
+
+def _process_state(pid: int) -> str:
+    try:
+        with open(f'/proc/{pid}/status') as reader:
+            for line in reader:
+                if line.startswith('State:'):
+                    return line.split()[1]
+    except FileNotFoundError:
+        pass
+    return 'gone'
+
+
+# pylint: disable=missing-function-docstring,redefined-outer-name
+
+
+def test_sync_workers_and_failures():
+    def worker(path, _):
+        if path == 'boom':
+            raise RuntimeError(path)
+        return path == 'ok'
+
+    index = FakeIndex([('foo', 'ok'), ('foo', 'ko'), ('foo', 'boom')])
+    result = aioengine.AsyncPipeline(index, {'foo': _options(worker, workers=2)}).run('bar')
+
+    assert result['foo'][0] == 3
+    assert sorted(result['foo'][1]) == ['boom', 'ko']
+
+
+def test_waits_do_not_hold_threads():
+    async def worker(path, _):
+        await asyncio.sleep(0.2)
+        return True
+
+    threads = []
+    index = FakeIndex([('foo', str(i)) for i in range(50)],
+                      between=lambda _: threads.append(threading.active_count()))
+    options = {'foo': _options(None, aio_worker=worker, workers=50)}
+
+    start = time.monotonic()
+    result = aioengine.AsyncPipeline(index, options, max_queued=100, budget=50).run('bar')
+
+    assert result == {'foo': (50, [])}
+    assert time.monotonic() - start < 2, 'async jobs did not run concurrently'
+    assert max(threads) < 10
+
+
+def test_timeout_fails_the_job():
+    async def worker(path, _):
+        if path == 'slow':
+            await asyncio.sleep(30)
+        return True
+
+    index = FakeIndex([('foo', 'slow'), ('foo', 'fast')])
+    options = {'foo': _options(None, aio_worker=worker, workers=2)}
+    result = aioengine.AsyncPipeline(index, options, timeout=0.1).run('bar')
+
+    assert result == {'foo': (2, ['slow'])}
+
+
+def test_cancelled_converter_is_killed(tmp_path):
+    pidfile = tmp_path / 'pid'
+    converter = tmp_path / 'converter'
+    converter.write_text(f'#!/bin/sh\nsleep 30 &\necho $! > {pidfile}\nwait\n')
+    converter.chmod(0o755)
+
+    async def convert():
+        task = asyncio.create_task(aioengine.execute_converter(str(converter), 'foo'))
+        while not pidfile.exists() or not pidfile.read_text().strip():
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(convert())
+    # the converter child was in the same process group
+    child = int(pidfile.read_text())
+    for _ in range(100):
+        if _process_state(child) in ('gone', 'Z'):
+            break
+        time.sleep(0.01)
+    assert _process_state(child) in ('gone', 'Z')
+
+
+def test_scan_index_flow(tmp_path):
+    converter = tmp_path / 'qvm-convert-pdf'
+    converter.write_text('#!/bin/sh\ncp "$1" "${1%.pdf}.trusted.pdf"\n')
+    converter.chmod(0o755)
+
+    tree = tmp_path / 'tree'
+    (tree / 'course').mkdir(parents=True)
+    (tree / 'course' / 'a.pdf').write_bytes(b'%PDF-1.4\n')
+    with zipfile.ZipFile(tree / 'course' / 'b.zip', mode='w') as writer:
+        writer.writestr('slides/c.pdf', b'%PDF-1.4\n')
+
+    options = {
+        'pdf': preprocess.pdf_options(pdf_bin_converter=str(converter), no_cache=True),
+        'zip': preprocess.zip_options(),
+    }
+    index = preprocess.ScanIndex(options)
+    options['zip']['index'] = index
+
+    result = aioengine.AsyncPipeline(index, options, policy='lpt').run(str(tree))
+
+    assert result == {'pdf': (2, []), 'zip': (1, [])}
+    assert (tree / 'course' / 'a.trusted.pdf').exists()
+    assert (tree / 'course' / 'slides' / 'c.trusted.pdf').exists()
+
+
+def test_copies_share_outputs_off_the_loop(tmp_path):
+    paths, shared = [], []
+    for name in ['a', 'b', 'c']:
+        (tmp_path / name).write_text('same content')
+        paths.append(str(tmp_path / name))
+
+    def share_worker(source, path, _):
+        shared.append((source, path, threading.current_thread().name))
+        return True
+
+    walked = threading.Event()
+    options = {'foo': _options(lambda path, _: walked.wait(5),
+                               share_worker=share_worker, weight=1)}
+    index = FakeIndex([('foo', path) for path in paths],
+                      between=lambda number: number == 2 and walked.set())
+    runner = aioengine.AsyncPipeline(index, options, deduplicate=True)
+
+    assert runner.run('bar') == {'foo': (3, [])}
+    assert [(source, path) for source, path, _ in shared] == [(paths[0], paths[1]),
+                                                              (paths[0], paths[2])]
+    assert all(name.startswith('converter') for _, _, name in shared)
+    assert runner.stats['foo']['deduplicated'] == 2
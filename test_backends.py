@@ -0,0 +1,97 @@
+'''
+Functional test of backends module.
+'''
+
+
+import io
+import os
+import sys
+
+import pytest
+import backends
+import pipeline
+import preprocess
+
+
+# pylint: disable=missing-function-docstring,redefined-outer-name
+
+
+REFERENCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backends.py')
+
+
+@pytest.fixture
+def worker_command(tmp_path):
+    ''' Write an executable running command as a converter worker '''
+
+    def write(name, command):
+        path = tmp_path / name
+        path.write_text(f'#!/bin/sh\nexec {command}\n')
+        path.chmod(0o755)
+        return str(path)
+    return write
+
+
+def test_frames_round_trip():
+    stream = io.BytesIO()
+    backends.write_frame(stream, {'args': ['a.pdf', 'ü.pdf']})
+    backends.write_frame(stream, {'ok': True})
+    stream.seek(0)
+
+    assert backends.read_frame(stream) == {'args': ['a.pdf', 'ü.pdf']}
+    assert backends.read_frame(stream) == {'ok': True}
+    assert backends.read_frame(stream) is None
+
+    with pytest.raises(backends.ProtocolError):
+        backends.read_frame(io.BytesIO(backends.HEADER.pack(10) + b'{}'))
+
+
+def test_workers_take_many_jobs(tmp_path):
+    backend = backends.PersistentBackend(f'{sys.executable} {REFERENCE} --img', processes=2)
+    try:
+        for number in range(5):
+            source = tmp_path / f'{number}.png'
+            source.write_text(f'image {number}')
+            assert backend.convert([str(source), str(tmp_path / f'{number}.trusted.png')])
+            assert (tmp_path / f'{number}.trusted.png').read_text() == f'image {number}'
+
+        assert not backend.convert([str(tmp_path / 'missing.png'), str(tmp_path / 'out.png')])
+    finally:
+        backend.close()
+    assert backend.started == 1, 'worker was started again for later jobs'
+
+
+def test_hung_or_dead_workers_are_replaced(worker_command):
+    hung = worker_command('hung', 'sleep 30')
+    backend = backends.PersistentBackend(hung, processes=1)
+    with pytest.raises(pipeline.JobTimeout):
+        backend.convert(['a.pdf'], timeout=0.2)
+    with pytest.raises(pipeline.JobTimeout):
+        backend.convert(['b.pdf'], timeout=0.2)
+    assert backend.started == 2
+    backend.close()
+
+    backend = backends.PersistentBackend(worker_command('dead', 'true'), processes=1)
+    with pytest.raises(pipeline.TransientError):
+        backend.convert(['a.pdf'])
+    backend.close()
+
+
+def test_pdfs_converted_by_persistent_workers(tmp_path, worker_command, monkeypatch):
+    tree = tmp_path / 'tree'
+    (tree / 'course').mkdir(parents=True)
+    for name in ['a', 'b', 'c']:
+        (tree / 'course' / f'{name}.pdf').write_text(f'%PDF-1.4\n{name}')
+
+    worker = worker_command('pdf-worker', f'{sys.executable} {REFERENCE} --pdf')
+    monkeypatch.setattr('sys.argv', ['preprocess.py', '--no-cache', '--skip-img', '--no-journal',
+                                     '--pdf-bin-converter', worker, '--pdf-backend', 'persistent',
+                                     '--backend-processes', '1',
+                                     '--rates-file', str(tmp_path / 'rates.json'), str(tree)])
+    cli_args = preprocess.parse_args()
+    assert preprocess.run_services(cli_args, preprocess.gen_service_options(**vars(cli_args))) == 0
+
+    assert sorted(os.listdir(tree / 'course')) == ['a.trusted.pdf', 'b.trusted.pdf',
+                                                   'c.trusted.pdf']
+    backend = backends.open_backend(worker, 1)
+    assert backend.started == 1
+    backends.close_backends()
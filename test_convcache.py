@@ -0,0 +1,100 @@
+'''
+Functional test of convcache module.
+'''
+
+
+import os
+import pathlib
+
+import pytest
+import convcache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    ''' Return an empty cache with room for 10 bytes '''
+
+    return convcache.ConversionCache(str(tmp_path / pathlib.Path('cache')), 10)
+
+
+def _write(path: pathlib.Path, content: bytes) -> str:
+    path.write_bytes(content)
+    return str(path)
+
+
+# pylint: disable=missing-function-docstring,redefined-outer-name
+
+
+def test_key_depends_on_content_and_namespace(tmp_path, cache):
+    first = _write(tmp_path / 'a', b'foo')
+    second = _write(tmp_path / 'b', b'foo')
+    third = _write(tmp_path / 'c', b'bar')
+
+    assert cache.key(first) == cache.key(second)
+    assert cache.key(first) != cache.key(third)
+    assert cache.key(first, 'pdf') != cache.key(first, 'img')
+
+
+def test_fetch_stored_output(tmp_path, cache):
+    key = cache.key(_write(tmp_path / 'untrusted', b'foo'))
+    trusted = _write(tmp_path / 'trusted', b'converted')
+    os.chmod(trusted, 0o644)
+    cache.store(key, trusted)
+
+    dest = tmp_path / 'dest'
+    assert cache.fetch(key, str(dest)), 'stored output was not found'
+    assert dest.read_bytes() == b'converted'
+    assert dest.stat().st_mode & 0o777 == 0o644
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_fetch_missing_entry(tmp_path, cache):
+    dest = tmp_path / 'dest'
+    assert not cache.fetch('0' * 64, str(dest))
+    assert not dest.exists()
+    assert cache.misses == 1
+
+
+def test_corrupted_entry_is_discarded(tmp_path, cache):
+    key = cache.key(_write(tmp_path / 'untrusted', b'foo'))
+    cache.store(key, _write(tmp_path / 'trusted', b'converted'))
+
+    # pylint: disable=protected-access
+    with open(cache._object_path(key), 'ab') as writer:
+        writer.write(b'!')
+
+    dest = tmp_path / 'dest'
+    assert not cache.fetch(key, str(dest)), 'corrupted output was trusted'
+    assert not dest.exists()
+    assert not os.path.exists(cache._object_path(key))
+
+
+def test_least_recently_used_is_evicted(tmp_path, cache):
+    keys = []
+    for i, content in enumerate([b'aaaa', b'bbbb']):
+        key = cache.key(_write(tmp_path / f'in{i}', content))
+        cache.store(key, _write(tmp_path / f'out{i}', content))
+        keys.append(key)
+
+    # pylint: disable=protected-access
+    os.utime(cache._object_path(keys[0]), (0, 0))
+    os.utime(cache._object_path(keys[1]), (1, 1))
+    assert cache.fetch(keys[0], str(tmp_path / 'dest'))
+
+    key = cache.key(_write(tmp_path / 'in2', b'cccc'))
+    cache.store(key, _write(tmp_path / 'out2', b'cccc'))
+
+    assert cache.fetch(keys[0], str(tmp_path / 'dest')), 'recently used entry was evicted'
+    assert not cache.fetch(keys[1], str(tmp_path / 'dest')), 'least used entry was kept'
+    assert cache.fetch(key, str(tmp_path / 'dest'))
+
+
+def test_outputs_larger_than_cap_are_not_stored(tmp_path, cache):
+    key = cache.key(_write(tmp_path / 'untrusted', b'foo'))
+    cache.store(key, _write(tmp_path / 'trusted', b'x' * 11))
+    assert not cache.fetch(key, str(tmp_path / 'dest'))
+
+
+def test_open_cache_is_shared(tmp_path):
+    directory = str(tmp_path / 'shared')
+    assert convcache.open_cache(directory, 10) is convcache.open_cache(directory, 10)
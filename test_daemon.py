@@ -0,0 +1,124 @@
+'''
+Functional test of daemon module.
+'''
+
+
+import os
+import threading
+
+import pytest
+import daemon
+import pipeline
+import preprocess
+
+
+# pylint: disable=missing-function-docstring,redefined-outer-name
+
+
+@pytest.fixture
+def serve(tmp_path):
+    ''' Start a job server calling the given run_job, stopped after the test '''
+
+    servers = []
+
+    def start(run_job):
+        server = daemon.JobServer(str(tmp_path / 'run' / 'daemon.sock'), run_job)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_events_of_a_job_are_streamed(tmp_path, serve):
+    def run_job(path, options, reply):
+        reply('progress', services={'pdf': {'found': 1, 'done': 0, 'failed': 0}})
+        return {'exit_code': 0, 'path': path, 'options': options}
+
+    server = serve(run_job)
+    events = list(daemon.submit(server.socket_path, str(tmp_path), incremental=True,
+                                verbose=True))
+
+    assert [event['event'] for event in events] == ['accepted', 'progress', 'done']
+    assert events[-1]['path'] == str(tmp_path)
+    assert events[-1]['options'] == {'incremental': True}, 'unknown option was passed on'
+    assert os.stat(server.socket_path).st_mode & 0o077 == 0, 'socket is open to others'
+
+
+def test_one_job_at_a_time_on_a_path(tmp_path, serve):
+    started, release = threading.Event(), threading.Event()
+
+    def run_job(*_):
+        started.set()
+        release.wait(5)
+        return {}
+
+    server = serve(run_job)
+    first = daemon.submit(server.socket_path, str(tmp_path))
+    assert next(first)['event'] == 'accepted'
+    assert started.wait(5)
+
+    with pytest.raises(daemon.DaemonError, match='already running'):
+        list(daemon.submit(server.socket_path, str(tmp_path)))
+
+    release.set()
+    assert [event['event'] for event in first] == ['done']
+    with pytest.raises(daemon.DaemonError, match='no such file'):
+        list(daemon.submit(server.socket_path, str(tmp_path / 'missing')))
+
+
+def test_stale_socket_is_replaced(tmp_path, serve):
+    server = serve(lambda *_: {})
+    with pytest.raises(daemon.DaemonError, match='already listens'):
+        daemon.JobServer(server.socket_path, lambda *_: {})
+
+    server.shutdown()
+    server.socket.close()
+    assert os.path.exists(server.socket_path)
+    assert not daemon.is_listening(server.socket_path)
+    serve(lambda *_: {})
+
+
+def test_jobs_share_the_converters_of_the_daemon(tmp_path, serve, monkeypatch):
+    stub = tmp_path / 'qvm-convert-pdf'
+    stub.write_text('#!/bin/sh\ncp "$1" "${1%.pdf}.trusted.pdf" && rm "$1"\n')
+    stub.chmod(0o755)
+
+    trees = []
+    for name in ['first', 'second']:
+        tree = tmp_path / name
+        tree.mkdir()
+        (tree / 'book.pdf').write_text(f'%PDF-1.4\n{name}')
+        trees.append(tree)
+
+    monkeypatch.setattr('sys.argv', ['preprocess.py', '--daemon', '--no-cache', '--skip-img',
+                                     '--pdf-bin-converter', str(stub),
+                                     '--index-file', str(tmp_path / 'index.sqlite'),
+                                     '--no-journal',
+                                     '--rates-file', str(tmp_path / 'rates.json')])
+    cli_args = preprocess.parse_args()
+    service_options = preprocess.gen_service_options(**vars(cli_args))
+    slots = pipeline.build_scheduler(service_options, max_workers=1)
+    slots.start()
+
+    def run_job(path, options, _):
+        job_args = preprocess.argparse.Namespace(**{**vars(cli_args), **options,
+                                                    'directory': path})
+        return {'exit_code': preprocess.run_services(job_args, service_options, slots=slots)}
+
+    server = serve(run_job)
+    for tree in trees:
+        assert list(daemon.submit(server.socket_path, str(tree)))[-1]['exit_code'] == 0
+
+    # a single file is converted on its own
+    notes = trees[1] / 'notes.pdf'
+    notes.write_text('%PDF-1.4\nnotes')
+    assert list(daemon.submit(server.socket_path, str(notes)))[-1]['exit_code'] == 0
+    slots.close()
+
+    assert sorted(os.listdir(trees[0])) == ['book.trusted.pdf']
+    assert sorted(os.listdir(trees[1])) == ['book.trusted.pdf', 'notes.trusted.pdf']
+    assert slots.peak_used <= slots.budget
@@ -0,0 +1,48 @@
+'''
+Functional test of dedup module.
+'''
+
+
+import dedup
+
+
+# pylint: disable=missing-function-docstring
+
+
+def test_only_files_sharing_a_size_are_hashed(tmp_path, monkeypatch):
+    hashed = []
+    hash_file = dedup.convcache.hash_file
+    monkeypatch.setattr(dedup.convcache, 'hash_file',
+                        lambda path: hashed.append(path) or hash_file(path))
+
+    files = {'a': b'one', 'b': b'four', 'c': b'two', 'd': b'one'}
+    for name, content in files.items():
+        (tmp_path / name).write_bytes(content)
+    path = lambda name: str(tmp_path / name)
+
+    finder = dedup.Deduplicator()
+    assert finder.add('pdf', path('a')) is None
+    assert finder.add('pdf', path('b')) is None
+    assert hashed == []
+
+    assert finder.add('pdf', path('c')) is None, 'same size is not the same content'
+    assert finder.add('pdf', path('d')) == path('a')
+    assert finder.add('image', path('d')) is None, 'services do not share outputs'
+    assert path('b') not in hashed
+
+    assert finder.finish('pdf', path('a'), True) == ([path('d')], None)
+    assert finder.finish('pdf', path('c'), True) == ([], None)
+
+
+def test_failed_leader_promotes_a_copy(tmp_path):
+    paths = []
+    for name in ['a', 'b', 'c']:
+        (tmp_path / name).write_text('same')
+        paths.append(str(tmp_path / name))
+
+    finder = dedup.Deduplicator()
+    assert [finder.add('pdf', path) for path in paths] == [None, paths[0], paths[0]]
+
+    assert finder.finish('pdf', paths[0], False) == ([], paths[1])
+    assert finder.finish('pdf', paths[1], True) == ([paths[2]], None)
+
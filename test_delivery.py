@@ -0,0 +1,90 @@
+'''
+Functional test of delivery module.
+'''
+
+
+import os
+import time
+import tarfile
+
+import delivery
+
+
+# pylint: disable=missing-function-docstring
+
+
+def _tree(tmp_path, count):
+    tree = tmp_path / 'tree'
+    paths = []
+    for number in range(count):
+        path = tree / f'course-{number % 2}' / f'notes-{number}.trusted.pdf'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(f'trusted {number}')
+        paths.append(str(path))
+    return tree, paths
+
+
+def _incoming(tmp_path):
+    incoming = tmp_path / 'incoming'
+    incoming.mkdir()
+    return incoming, f'cp -r -t {incoming}'
+
+
+def test_batches_keep_the_layout_of_the_tree(tmp_path):
+    tree, paths = _tree(tmp_path, 5)
+    incoming, command = _incoming(tmp_path)
+
+    shipping = delivery.open_delivery(str(tree), command=command, max_files=2, window=60)
+    for path in paths:
+        shipping.add(path)
+    shipping.add(paths[0])
+    assert shipping.close()
+
+    batches = sorted(os.listdir(incoming))
+    assert len(batches) == 3 and shipping.batches == 3
+    for number, path in enumerate(paths):
+        relative = os.path.relpath(path, tree)
+        assert (incoming / batches[number // 2] / relative).read_text() == f'trusted {number}'
+    assert os.path.exists(paths[0]), 'delivered file was removed from the tree'
+    assert not os.path.exists(shipping.staging_dir), 'staging directory was left behind'
+
+
+def test_batch_is_shipped_once_its_window_is_over(tmp_path):
+    tree, paths = _tree(tmp_path, 1)
+    incoming, command = _incoming(tmp_path)
+
+    shipping = delivery.open_delivery(str(tree), command=command, window=0.2)
+    shipping.add(paths[0])
+    for _ in range(100):
+        if os.listdir(incoming):
+            break
+        time.sleep(0.05)
+    assert os.listdir(incoming), 'batch waited for the delivery to be closed'
+    assert shipping.close()
+
+
+def test_packed_batch_is_a_single_archive(tmp_path):
+    tree, paths = _tree(tmp_path, 3)
+    incoming, command = _incoming(tmp_path)
+    (tree / '.hidden').write_text('temporary')
+
+    shipping = delivery.open_delivery(str(tree), command=command, pack=True)
+    shipping.add(paths[0])
+    shipping.add_rest()
+    assert shipping.close()
+
+    archives = os.listdir(incoming)
+    assert len(archives) == 1 and archives[0].endswith('.tar')
+    with tarfile.open(incoming / archives[0]) as archive:
+        names = sorted(name.split('/', 1)[1] for name in archive.getnames())
+    assert names == sorted(os.path.relpath(path, tree) for path in paths)
+
+
+def test_failed_batches_are_reported(tmp_path):
+    tree, paths = _tree(tmp_path, 2)
+
+    shipping = delivery.open_delivery(str(tree), command='false')
+    for path in paths:
+        shipping.add(path)
+    assert not shipping.close()
+    assert sorted(shipping.failed) == sorted(paths)
@@ -0,0 +1,96 @@
+'''
+Functional test of estimate module.
+'''
+
+
+import struct
+
+import estimate
+
+
+def _pdf(pages: int, xref: bool = True) -> bytes:
+    ''' Minimal pdf with a flat page tree and its cross-reference table '''
+
+    kids = ' '.join(f'{3 + i} 0 R' for i in range(pages))
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>',
+               f'<< /Kids [{kids}] /Type /Pages /Count {pages} >>'.encode()]
+    objects += [b'<< /Type /Page /Parent 2 0 R >>'] * pages
+
+    content, offsets = bytearray(b'%PDF-1.4\n'), []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(content))
+        content += f'{number} 0 obj\n'.encode() + body + b'\nendobj\n'
+
+    startxref = len(content)
+    if xref:
+        content += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode()
+        for offset in offsets:
+            content += f'{offset:010d} 00000 n \n'.encode()
+    content += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n'.encode()
+    content += f'startxref\n{startxref}\n%%EOF\n'.encode()
+    return bytes(content)
+
+
+def _jpeg(width: int, height: int) -> bytes:
+    app0 = b'\xff\xe0' + struct.pack('>H', 16) + b'JFIF\x00' + b'\x00' * 9
+    sof = b'\xff\xc0' + struct.pack('>HBHHB', 11, 8, height, width, 3) + b'\x00' * 3
+    return b'\xff\xd8' + app0 + sof + b'\xff\xd9'
+
+
+# pylint: disable=missing-function-docstring
+
+
+def test_pdf_pages_from_xref(tmp_path):
+    path = tmp_path / 'foo.pdf'
+    path.write_bytes(_pdf(12))
+    assert estimate.pdf_pages(str(path)) == 12
+
+
+def test_pdf_pages_without_xref(tmp_path):
+    path = tmp_path / 'foo.pdf'
+    path.write_bytes(_pdf(3, xref=False))
+    assert estimate.pdf_pages(str(path)) == 3
+
+    path.write_bytes(b'%PDF-1.4\nnothing here\n')
+    assert estimate.pdf_pages(str(path)) is None
+
+
+def test_image_size(tmp_path):
+    png = b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR' + struct.pack('>II', 640, 480)
+    gif = b'GIF89a' + struct.pack('<HH', 32, 16) + b'\x00' * 8
+    for name, content, expected in [('a.png', png, (640, 480)),
+                                    ('b.jpg', _jpeg(1920, 1080), (1920, 1080)),
+                                    ('c.gif', gif, (32, 16)),
+                                    ('d.jpg', b'\xff\xd8\xff\xe0\x00', None)]:
+        path = tmp_path / name
+        path.write_bytes(content)
+        assert estimate.image_size(str(path)) == expected, name
+
+
+def test_costs_follow_content(tmp_path):
+    short, long = tmp_path / 'short.pdf', tmp_path / 'long.pdf'
+    short.write_bytes(_pdf(2))
+    long.write_bytes(_pdf(200))
+    assert estimate.pdf_cost(str(long)) > estimate.pdf_cost(str(short))
+
+    image = tmp_path / 'large.png'
+    image.write_bytes(b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR' + struct.pack('>II', 4000, 3000))
+    assert estimate.image_cost(str(image), max_pixels=1000) == \
+        estimate.STARTUP_COST + 1000 * estimate.IMAGE_PIXEL_COST
+    assert estimate.image_cost(str(image)) > estimate.image_cost(str(image), max_pixels=1000)
+
+    assert estimate.size_cost(str(tmp_path / 'missing')) == estimate.STARTUP_COST
+
+
+def test_recorded_rates_blend_with_previous_runs(tmp_path):
+    path = str(tmp_path / 'cache' / 'rates.json')
+    assert estimate.load_rates(path) == {}
+
+    estimate.record_rates(path, {'pdf': {'done': 10, 'seconds': 100.0}})
+    rates = estimate.record_rates(path, {'pdf': {'done': 5, 'seconds': 100.0},
+                                         'image': {'done': 0, 'seconds': 0}})
+
+    assert estimate.load_rates(path) == rates
+    assert rates['pdf']['files'] == 15
+    assert rates['pdf']['seconds_per_file'] == 10 + estimate.RATE_WEIGHT * (20 - 10)
+    assert 'image' not in rates, 'a service with nothing done has no rate'
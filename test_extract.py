@@ -0,0 +1,116 @@
+'''
+Functional test of extract module.
+'''
+
+
+import io
+import os
+import pathlib
+import zipfile
+
+import pytest
+import extract
+
+
+def _zip_bytes(members: dict, compression: int = zipfile.ZIP_STORED) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, mode='w', compression=compression) as writer:
+        for name, content in members.items():
+            writer.writestr(name, content)
+    return buffer.getvalue()
+
+
+def _nested(depth: int) -> bytes:
+    ''' Archive holding a pdf on every level, down to depth levels '''
+
+    content = _zip_bytes({f'level{depth}.pdf': b'%PDF-1.4\n'})
+    for level in range(depth - 1, 0, -1):
+        content = _zip_bytes({f'level{level}.pdf': b'%PDF-1.4\n',
+                              f'nested{level + 1}.zip': content})
+    return content
+
+
+@pytest.fixture
+def archive(tmp_path):
+    ''' Write the given bytes as an archive inside a nested directory '''
+
+    def factory(content: bytes) -> pathlib.Path:
+        os.makedirs(tmp_path / 'course', exist_ok=True)
+        path = tmp_path / 'course' / 'foo.zip'
+        path.write_bytes(content)
+        return path
+    return factory
+
+
+# pylint: disable=missing-function-docstring,redefined-outer-name
+
+
+def test_members_are_extracted_in_parallel(archive):
+    members = {f'dir/{i}.txt': os.urandom(64) for i in range(20)}
+    path = archive(_zip_bytes(members))
+
+    extracted = list(extract.extract_archive(str(path), workers=4))
+
+    assert sorted(extracted) == sorted(str(path.parent / name) for name in members)
+    for name, content in members.items():
+        assert (path.parent / name).read_bytes() == content
+
+
+def test_nested_archives_up_to_depth(archive):
+    path = archive(_nested(4))
+
+    extracted = list(extract.extract_archive(str(path), max_depth=3))
+    names = sorted(os.path.basename(member) for member in extracted)
+
+    # the archive found on the 3rd level is left alone
+    assert names == ['level1.pdf', 'level2.pdf', 'level3.pdf', 'nested4.zip']
+    assert not (path.parent / 'nested2.zip').exists(), 'nested zip was not removed'
+
+
+def test_nested_archives_are_kept_when_asked(archive):
+    path = archive(_nested(2))
+
+    extracted = list(extract.extract_archive(str(path), flush_nested=False))
+
+    assert str(path.parent / 'nested2.zip') in extracted
+    assert (path.parent / 'level2.pdf').exists()
+
+
+def test_unreadable_nested_archive_is_kept(archive):
+    path = archive(_zip_bytes({'broken.zip': b'PK\x05\x06' + b'\x00' * 10 + b'junk' * 8}))
+
+    extracted = list(extract.extract_archive(str(path)))
+    assert extracted == [str(path.parent / 'broken.zip')]
+
+
+def test_member_count_limit(archive):
+    path = archive(_zip_bytes({f'{i}.txt': b'foo' for i in range(5)}))
+
+    with pytest.raises(extract.ExtractionError):
+        list(extract.extract_archive(str(path), max_members=4))
+
+
+def test_size_limit_counts_nested_archives(archive):
+    inner = _zip_bytes({'big.bin': b'x' * 4096})
+    path = archive(_zip_bytes({'a.zip': inner, 'b.zip': inner}))
+
+    with pytest.raises(extract.ExtractionError):
+        list(extract.extract_archive(str(path), max_bytes=6000, workers=1))
+
+
+def test_compression_ratio_limit(archive):
+    size = extract.RATIO_THRESHOLD * 2
+    path = archive(_zip_bytes({'bomb.bin': b'\0' * size}, compression=zipfile.ZIP_DEFLATED))
+
+    with pytest.raises(extract.ExtractionError):
+        list(extract.extract_archive(str(path), buffer_size=64 * 1024))
+
+    assert not (path.parent / 'bomb.bin').exists(), 'partial member was left behind'
+
+
+def test_member_path_sanitizing(tmp_path):
+    directory = str(tmp_path)
+    assert extract.member_path(directory, '../../foo') == str(tmp_path / 'foo')
+    assert extract.member_path(directory, '/etc/foo') == str(tmp_path / 'etc' / 'foo')
+    assert extract.member_path(directory, './a/./b') == str(tmp_path / 'a' / 'b')
+    assert extract.member_path(directory, '../') is None
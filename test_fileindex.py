@@ -0,0 +1,67 @@
+'''
+Functional test of fileindex module.
+'''
+
+
+import os
+import pathlib
+
+import pytest
+import fileindex
+
+
+@pytest.fixture
+def file_index(tmp_path):
+    ''' Return an empty index stored outside of the scanned tree '''
+
+    return fileindex.FileIndex(str(tmp_path / pathlib.Path('index.sqlite')))
+
+
+# pylint: disable=missing-function-docstring,redefined-outer-name
+
+
+def test_settled_file_is_unchanged(tmp_path, file_index):
+    target_file = tmp_path / 'tree' / 'foo'
+    os.makedirs(target_file.parent)
+    target_file.write_text('foo')
+
+    file_index.record_many([(str(target_file), 'pdf', 'done')])
+    known = file_index.snapshot(str(tmp_path / 'tree'))
+
+    assert fileindex.FileIndex.is_unchanged(known[str(target_file)], target_file.stat())
+
+    target_file.write_text('changed')
+    assert not fileindex.FileIndex.is_unchanged(known[str(target_file)], target_file.stat())
+
+
+def test_unsettled_states_are_not_unchanged(tmp_path, file_index):
+    target_file = tmp_path / 'foo'
+    target_file.write_text('foo')
+
+    for state in ['pending', 'failed']:
+        file_index.record_many([(str(target_file), 'pdf', state)])
+        known = file_index.snapshot(str(tmp_path))[str(target_file)]
+        assert not fileindex.FileIndex.is_unchanged(known, target_file.stat()), state
+
+
+def test_vanished_files_are_removed(tmp_path, file_index):
+    target_file = tmp_path / 'foo'
+    target_file.write_text('foo')
+    file_index.record_many([(str(target_file), None, 'ignored')])
+
+    target_file.unlink()
+    file_index.record_many([(str(target_file), 'pdf', 'done')])
+
+    assert not file_index.snapshot(str(tmp_path))
+
+
+def test_snapshot_is_limited_to_directory(tmp_path, file_index):
+    for name in ['foo', 'foobar']:
+        os.mkdir(tmp_path / name)
+        (tmp_path / name / 'baz').write_text(name)
+        file_index.record_many([(str(tmp_path / name / 'baz'), None, 'ignored')])
+
+    assert list(file_index.snapshot(str(tmp_path / 'foo'))) == [str(tmp_path / 'foo' / 'baz')]
+
+    file_index.forget([str(tmp_path / 'foo' / 'baz')])
+    assert not file_index.snapshot(str(tmp_path / 'foo'))
@@ -0,0 +1,96 @@
+'''
+Functional test of imagescale module.
+'''
+
+
+import os
+import struct
+import tempfile
+
+import pytest
+import estimate
+import imagescale
+import preprocess
+
+
+# pylint: disable=missing-function-docstring,redefined-outer-name
+
+
+def png_header(width, height):
+    return b'\x89PNG\r\n\x1a\n' + b'\x00\x00\x00\x0dIHDR' + struct.pack('>II', width, height)
+
+
+@pytest.fixture
+def tools(tmp_path):
+    ''' Stub downscale and convert commands logging their calls '''
+
+    log = tmp_path / 'calls.log'
+    small = tmp_path / 'small-header'
+    small.write_bytes(png_header(100, 100))
+    scripts = {
+        # the downscaled copy is a 100x100 png, the image only comes on stdin
+        'downscale': f'echo downscale "$1" "$(head -c 4 | tail -c 3)" >> {log}\n'
+                     f'cat {small}\n',
+        'broken-downscale': 'exit 1\n',
+        'convert': f'echo convert "$1" >> {log}\ncp "$1" "$2"\n',
+    }
+    for name, body in scripts.items():
+        (tmp_path / name).write_text(f'#!/bin/sh\n{body}')
+        (tmp_path / name).chmod(0o755)
+    return tmp_path, log
+
+
+def test_only_oversized_images_are_downscaled(tmp_path, tools):
+    bin_dir, _ = tools
+    big = tmp_path / 'big.png'
+    big.write_bytes(png_header(4000, 3000))
+    unknown = tmp_path / 'unknown.png'
+    unknown.write_bytes(b'not an image')
+
+    assert imagescale.is_oversized(str(big), 10_000)
+    assert not imagescale.is_oversized(str(big), 12_000_000)
+    assert not imagescale.is_oversized(str(unknown), 10_000)
+
+    scaled = imagescale.downscale(str(big), 10_000, f'{bin_dir / "downscale"} {{pixels}}')
+    assert os.path.basename(scaled) == 'big.png'
+    assert estimate.image_size(scaled) == (100, 100)
+    imagescale.discard(scaled)
+    assert not os.path.exists(os.path.dirname(scaled))
+
+    before = set(os.listdir(tempfile.gettempdir()))
+    with pytest.raises(imagescale.ScaleError):
+        imagescale.downscale(str(big), 10_000, str(bin_dir / 'broken-downscale'))
+    with pytest.raises(imagescale.ScaleError):
+        imagescale.downscale(str(big), 10_000, 'cat {input}')
+    assert set(os.listdir(tempfile.gettempdir())) <= before, 'failed copies were left behind'
+
+
+@pytest.mark.parametrize('downscale', ['downscale', 'broken-downscale'])
+def test_large_images_are_converted_downscaled(tmp_path, tools, monkeypatch, downscale):
+    bin_dir, log = tools
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    (tmp_path / 'home').mkdir()
+    tree = tmp_path / 'tree'
+    tree.mkdir()
+    (tree / 'big.png').write_bytes(png_header(4000, 3000))
+    (tree / 'small.png').write_bytes(png_header(200, 100))
+
+    monkeypatch.setattr('sys.argv', [
+        'preprocess.py', '--no-cache', '--skip-pdf', '--no-journal', '--no-dedup',
+        '--img-bin-converter', str(bin_dir / 'convert'),
+        '--max-image-pixels', '1000000',
+        '--img-downscale-command', f'{bin_dir / downscale} {{pixels}}',
+        '--rates-file', str(tmp_path / 'rates.json'), str(tree)])
+    cli_args = preprocess.parse_args()
+    assert preprocess.run_services(cli_args, preprocess.gen_service_options(**vars(cli_args))) == 0
+
+    calls = log.read_text().splitlines()
+    assert [call for call in calls if call.startswith('downscale')] == \
+        (['downscale 1000000 PNG'] if downscale == 'downscale' else [])
+    assert f'convert {tree / "small.png"}' in calls
+    assert (f'convert {tree / "big.png"}' in calls) is (downscale != 'downscale')
+
+    assert sorted(os.listdir(tree)) == ['big.trusted.png', 'small.trusted.png']
+    expected = (100, 100) if downscale == 'downscale' else (4000, 3000)
+    assert estimate.image_size(str(tree / 'big.trusted.png')) == expected
+    assert (tmp_path / 'home' / 'QubesUntrustedIMGs' / 'big.png').exists()
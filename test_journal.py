@@ -0,0 +1,61 @@
+'''
+Functional test of journal module.
+'''
+
+
+import os
+
+import pytest
+import journal
+
+
+# pylint: disable=missing-function-docstring
+
+
+def test_replay_of_an_interrupted_run(tmp_path):
+    path = str(tmp_path / 'journals' / 'run.jsonl')
+    run_journal = journal.Journal(path)
+    run_journal.record('done.pdf', 'converting', output=os.path.abspath('done.trusted.pdf'))
+    run_journal.record('done.pdf', 'converted')
+    run_journal.record('done.pdf', 'moved')
+    run_journal.record('busy.pdf', 'converting', output=os.path.abspath('busy.trusted.pdf'))
+    run_journal.record('archive.zip', 'extracted')
+    run_journal.record('bad.pdf', 'failed')
+    run_journal.close()
+
+    # a crash in the middle of a write leaves a torn line behind
+    with open(path, 'a') as writer:
+        writer.write('{"path": "/torn", "sta')
+
+    resumed = journal.Journal(path, resume=True)
+
+    assert resumed.is_settled('done.pdf')
+    assert resumed.is_settled('archive.zip')
+    assert not resumed.is_settled('busy.pdf')
+    assert sorted(resumed.settled()) == sorted(os.path.abspath(name) for name in
+                                               ['done.pdf', 'done.trusted.pdf', 'archive.zip'])
+    assert list(resumed.in_flight()) == [os.path.abspath('busy.pdf')]
+    resumed.close()
+
+
+def test_new_run_starts_an_empty_journal(tmp_path):
+    path = str(tmp_path / 'run.jsonl')
+    run_journal = journal.Journal(path)
+    run_journal.record('a.pdf', 'moved')
+    run_journal.close()
+
+    assert not journal.Journal(path).is_settled('a.pdf')
+    assert os.path.getsize(path) == 0
+    with pytest.raises(ValueError):
+        journal.Journal(path).record('a.pdf', 'lost')
+
+
+def test_prune_removes_old_journals(tmp_path):
+    old, recent = tmp_path / 'old.jsonl', tmp_path / 'recent.jsonl'
+    old.write_text('')
+    recent.write_text('')
+    os.utime(old, (0, 0))
+
+    journal.prune(str(tmp_path))
+
+    assert not old.exists() and recent.exists()
@@ -0,0 +1,140 @@
+'''
+Functional test of mimesniff module.
+'''
+
+
+import zlib
+import struct
+import pathlib
+import secrets
+import zipfile
+import subprocess
+from unittest import mock
+
+import pytest
+import mimesniff
+
+
+def _png(width: int, height: int) -> bytes:
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    chunk = b'IHDR' + ihdr
+    return (b'\x89PNG\r\n\x1a\n' + struct.pack('>I', len(ihdr)) + chunk
+            + struct.pack('>I', zlib.crc32(chunk)))
+
+
+def _zip(path: pathlib.Path, *members: str) -> None:
+    with zipfile.ZipFile(path, mode='w') as writer:
+        for member in members:
+            writer.writestr(member, b'foo')
+
+
+CORPUS_HEADERS = {
+    'doc.pdf': b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n1 0 obj\n',
+    'short.pdf': b'%PDF-',
+    'prefixed.pdf': b'junk%PDF-1.7\n',
+    'not.pdf': b'%PDF',
+    'image.png': _png(10, 20),
+    'truncated.png': b'\x89PNG\r\n\x1a\n' + b'\x00' * 8,
+    'photo.jpg': b'\xff\xd8\xff\xe0\x00\x10JFIF\x00',
+    'tiny.jpg': b'\xff\xd8\xff',
+    'anim.gif': b'GIF89a\x01\x00\x01\x00',
+    'empty': b'',
+    'notes.txt': b'hello world\n',
+    'page.html': b'<!DOCTYPE html><html><body>foo</body></html>',
+    'archive.gz': b'\x1f\x8b\x08\x00\x00\x00\x00\x00',
+    'pk': b'PK\x03\x04',
+    'random': None,
+}
+
+CORPUS_ZIPS = {
+    'plain.zip': ('foo.txt', 'bar/baz.pdf'),
+    'dirs.zip': ('dir/', 'dir/foo'),
+    'nothing.zip': (),
+    'book.epub': ('mimetype',),
+    'report.docx': ('[Content_Types].xml', 'word/document.xml'),
+    'lib.jar': ('META-INF/MANIFEST.MF',),
+}
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    ''' Generate files of every routed type and some which must not be routed '''
+
+    paths = []
+    for name, header in CORPUS_HEADERS.items():
+        path = tmp_path / pathlib.Path(name)
+        path.write_bytes(secrets.token_bytes(256) if header is None else header)
+        paths.append(str(path))
+
+    for name, members in CORPUS_ZIPS.items():
+        path = tmp_path / pathlib.Path(name)
+        _zip(path, *members)
+        paths.append(str(path))
+
+    odd = tmp_path / pathlib.Path('-odd name\nwith newline.pdf')
+    odd.write_bytes(CORPUS_HEADERS['doc.pdf'])
+    paths.append(str(odd))
+    return paths
+
+
+# pylint: disable=missing-function-docstring,redefined-outer-name
+
+
+@pytest.mark.skipif(not pathlib.Path(mimesniff.FILE_BINARY).exists(),
+                    reason='file(1) is not available')
+def test_sniff_agrees_with_file(corpus):
+    sniffed = 0
+    for path in corpus:
+        mimetype = mimesniff.sniff(path)
+        if mimetype is not None:
+            sniffed += 1
+            assert mimetype == mimesniff.file_mimetype(path), f'disagreement on {path}'
+
+    assert sniffed >= 8, 'sniffer identified too few files'
+
+
+@pytest.mark.skipif(not pathlib.Path(mimesniff.FILE_BINARY).exists(),
+                    reason='file(1) is not available')
+def test_detect_agrees_with_file(corpus):
+    detected = mimesniff.detect(corpus)
+
+    assert set(detected) == set(corpus)
+    for path in corpus:
+        assert detected[path] == mimesniff.file_mimetype(path), f'disagreement on {path}'
+
+
+def test_detect_forks_once_for_unknowns(tmp_path, monkeypatch):
+    known = tmp_path / pathlib.Path('foo.pdf')
+    known.write_bytes(b'%PDF-1.4\n')
+
+    unknowns = []
+    for i in range(3):
+        path = tmp_path / pathlib.Path(str(i))
+        path.write_bytes(b'foo')
+        unknowns.append(str(path))
+
+    output = mock.Mock(stdout=b'text/plain\n' * len(unknowns))
+    run_mock = mock.Mock(return_value=output)
+    monkeypatch.setattr(subprocess, 'run', run_mock)
+
+    detected = mimesniff.detect([str(known)] + unknowns)
+
+    run_mock.assert_called_once()
+    assert run_mock.call_args[1]['input'] == '\n'.join(unknowns).encode()
+    assert detected[str(known)] == 'application/pdf'
+    assert all(detected[path] == 'text/plain' for path in unknowns)
+
+
+def test_detect_without_unknowns_does_not_fork(tmp_path, monkeypatch):
+    known = tmp_path / pathlib.Path('foo.pdf')
+    known.write_bytes(b'%PDF-1.4\n')
+
+    run_mock = mock.Mock()
+    monkeypatch.setattr(subprocess, 'run', run_mock)
+
+    assert mimesniff.detect([str(known)]) == {str(known): 'application/pdf'}
+    run_mock.assert_not_called()
+
+
+def test_sniff_unreadable_file(tmp_path):
+    assert mimesniff.sniff(str(tmp_path / pathlib.Path('missing'))) is None
@@ -0,0 +1,194 @@
+'''
+Functional test of pdfsplit module.
+'''
+
+
+import os
+import json
+import threading
+
+import pytest
+import pdfsplit
+import preprocess
+
+
+# pylint: disable=missing-function-docstring,redefined-outer-name
+
+
+@pytest.fixture
+def tools(tmp_path):
+    ''' Stub split, merge and convert commands logging their calls '''
+
+    log = tmp_path / 'calls.log'
+    scripts = {
+        # the pdf only comes on stdin, a chunk tells which pages it holds
+        'split': f'echo split "$1" "$2" "$(head -n 1)" >> {log}\n'
+                 'printf "%%PDF-1.4\\npages $1-$2\\n"\n',
+        'hung-split': 'exec sleep 30\n',
+        'merge': f'echo merge >> {log}\nout="$1"; shift\ncat "$@" > "$out"\n',
+        'broken-merge': 'exit 1\n',
+        'broken-convert': 'exit 1\n',
+        'convert': f'echo convert "$(basename "$1")" >> {log}\n'
+                   'cp "$1" "${1%.pdf}.trusted.pdf" && rm "$1"\n',
+    }
+    for name, body in scripts.items():
+        (tmp_path / name).write_text(f'#!/bin/sh\n{body}')
+        (tmp_path / name).chmod(0o755)
+    return tmp_path, log
+
+
+def test_page_ranges():
+    assert pdfsplit.page_ranges(120, 50) == [(1, 50), (51, 100), (101, 120)]
+    assert pdfsplit.page_ranges(50, 50) == [(1, 50)]
+    assert pdfsplit.page_ranges(0, 50) == []
+
+
+def test_expand_fills_every_word():
+    assert pdfsplit.expand('merge --out={output} {inputs} -- "a b"',
+                           inputs=['1.pdf', '2 x.pdf'], output='o.pdf') == \
+        ['merge', '--out=o.pdf', '1.pdf', '2 x.pdf', '--', 'a b']
+
+
+def test_split_and_merge_keep_page_order(tmp_path, tools):
+    bin_dir, log = tools
+    source = tmp_path / 'book.pdf'
+    source.write_text('%PDF-1.4\n')
+
+    chunks = pdfsplit.split(str(source), str(tmp_path), [(1, 2), (3, 3)],
+                            f'{bin_dir / "split"} {{first}} {{last}}')
+    assert [os.path.basename(chunk) for chunk in chunks] == ['book.pages-0001-0002.pdf',
+                                                             'book.pages-0003-0003.pdf']
+    assert log.read_text().splitlines() == ['split 1 2 %PDF-1.4', 'split 3 3 %PDF-1.4']
+
+    output = tmp_path / 'out.pdf'
+    pdfsplit.merge(chunks, str(output), f'{bin_dir / "merge"} {{output}} {{inputs}}')
+    assert output.read_text() == '%PDF-1.4\npages 1-2\n%PDF-1.4\npages 3-3\n'
+
+    with pytest.raises(pdfsplit.SplitError):
+        pdfsplit.merge(chunks, str(output), f'{bin_dir / "broken-merge"} {{output}}')
+    assert not [name for name in os.listdir(tmp_path) if name.startswith('.')], \
+        'partial output was left behind'
+
+
+def _run(tmp_path, bin_dir, tree, merge='merge', convert='convert', *args, split='split'):
+    monkeypatch = pytest.MonkeyPatch()
+    monkeypatch.setattr('sys.argv', [
+        'preprocess.py', '--cache-dir', str(tmp_path / 'cache'), '--skip-img', '--no-journal',
+        '--no-dedup',
+        '--pdf-bin-converter', str(bin_dir / convert),
+        '--pdf-split', '--pdf-split-pages', '100', '--pdf-chunk-pages', '50',
+        '--pdf-split-command', f'{bin_dir / split} {{first}} {{last}}',
+        '--pdf-merge-command', f'{bin_dir / merge} {{output}} {{inputs}}',
+        '--rates-file', str(tmp_path / 'rates.json'), *args, str(tree)])
+    try:
+        cli_args = preprocess.parse_args()
+    finally:
+        monkeypatch.undo()
+
+    # a run waiting on itself would never end
+    runners, exit_codes = [], []
+    thread = threading.Thread(target=lambda: exit_codes.append(preprocess.run_services(
+        cli_args, preprocess.gen_service_options(**vars(cli_args)), on_start=runners.append)),
+                              daemon=True)
+    thread.start()
+    thread.join(20)
+    assert exit_codes == [0], 'run did not finish'
+    return runners[0]
+
+
+def _tree(tmp_path):
+    tree = tmp_path / 'tree'
+    tree.mkdir()
+    (tree / 'big.pdf').write_text('%PDF-1.4\n1 0 obj << /Type /Pages /Count 120 >> endobj\n')
+    (tree / 'small.pdf').write_text('%PDF-1.4\n1 0 obj << /Type /Pages /Count 3 >> endobj\n')
+    return tree
+
+
+@pytest.mark.parametrize('merge, whole', [('merge', False), ('broken-merge', True)])
+@pytest.mark.parametrize('batch_files', ['1', '2'])
+def test_large_pdfs_are_converted_in_chunks(tmp_path, tools, monkeypatch, merge, whole,
+                                            batch_files):
+    bin_dir, log = tools
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    tree = _tree(tmp_path)
+
+    runner = _run(tmp_path, bin_dir, tree, merge, 'convert', '--batch-files', batch_files)
+
+    calls = log.read_text().splitlines()
+    chunks = sorted(call for call in calls if '.pages-' in call)
+    assert chunks == [f'convert big.pages-{pages}.pdf'
+                      for pages in ['0001-0050', '0051-0100', '0101-0120']]
+    assert 'convert small.pdf' in calls
+    assert ('convert big.pdf' in calls) is whole
+
+    assert sorted(os.listdir(tree)) == ['big.trusted.pdf', 'small.trusted.pdf']
+    if not whole:
+        assert (tree / 'big.trusted.pdf').read_text() == ''.join(
+            f'%PDF-1.4\npages {pages}\n' for pages in ['1-50', '51-100', '101-120'])
+        assert (tmp_path / 'home' / 'QubesUntrustedPDFs' / 'big.pdf').exists()
+    assert not os.listdir(tmp_path / 'home' / '.cache' / 'qubes-usync' / 'split')
+
+    # chunk outputs would never be used again
+    cached = [name for _, _, names in os.walk(tmp_path / 'cache' / 'objects')
+              for name in names if '.' not in name]
+    assert len(cached) == (2 if whole else 1)
+
+    # chunks are steps of a single conversion
+    assert {service: (stats['found'], stats['done']) for service, stats in runner.stats.items()
+            if stats['found']} == {'pdf': (1, 1), 'pdfsplit': (1, 1)}
+    with open(tmp_path / 'rates.json') as reader:
+        assert json.load(reader)['pdf']['files'] == 1
+
+
+def test_chunks_are_not_held_in_open_batches(tmp_path, tools, monkeypatch):
+    bin_dir, _ = tools
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    tree = _tree(tmp_path)
+    (tree / 'small.pdf').unlink()
+
+    # the last chunk would wait alone for a batch of two
+    _run(tmp_path, bin_dir, tree, 'merge', 'convert', '--batch-files', '2')
+
+    assert os.listdir(tree) == ['big.trusted.pdf']
+
+
+def test_hung_split_falls_back_to_whole_conversion(tmp_path, tools, monkeypatch):
+    bin_dir, log = tools
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    tree = _tree(tmp_path)
+
+    _run(tmp_path, bin_dir, tree, 'merge', 'convert', '--pdf-timeout', '0.5',
+         split='hung-split')
+
+    assert 'convert big.pdf' in log.read_text().splitlines()
+    assert sorted(os.listdir(tree)) == ['big.trusted.pdf', 'small.trusted.pdf']
+
+
+def test_whole_conversion_failure_is_reported(tmp_path, tools, monkeypatch):
+    bin_dir, _ = tools
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    tree = _tree(tmp_path)
+
+    runner = _run(tmp_path, bin_dir, tree, 'broken-merge', 'broken-convert')
+
+    assert runner.stats['pdfsplit']['failed'] == [str(tree / 'big.pdf')]
+    assert (tree / 'big.pdf').exists()
+
+
+def test_chunks_are_neither_delivered_nor_indexed(tmp_path, tools, monkeypatch):
+    bin_dir, log = tools
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    tree, incoming = _tree(tmp_path), tmp_path / 'incoming'
+    incoming.mkdir()
+    args = ['--incremental', '--index-file', str(tmp_path / 'index.db'),
+            '--deliver', '--deliver-command', f'cp -r -t {incoming}']
+
+    _run(tmp_path, bin_dir, tree, 'merge', 'convert', *args)
+    delivered = sorted(name for _, _, names in os.walk(incoming) for name in names)
+    assert delivered == ['big.trusted.pdf', 'small.trusted.pdf']
+
+    # the merged output is known as such on the next run
+    log.write_text('')
+    _run(tmp_path, bin_dir, tree, 'merge', 'convert', *args)
+    assert log.read_text() == ''
+    assert sorted(os.listdir(tree)) == ['big.trusted.pdf', 'small.trusted.pdf']
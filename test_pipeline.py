@@ -0,0 +1,394 @@
+'''
+Functional test of pipeline module.
+'''
+
+
+import os
+import pathlib
+import zipfile
+import threading
+
+import pytest
+import pipeline
+import preprocess
+
+
+class FakeIndex:
+    ''' Scan index replacement which dispatches a fixed list of files '''
+
+    def __init__(self, items: list, between: callable = None):
+        self.sink = None
+        self.items = items
+        self.between = between
+        self.claimed, self.finished = [], []
+
+    def walk(self, _):
+        for number, (service, path) in enumerate(self.items):
+            self.sink(service, path)
+            if self.between is not None:
+                self.between(number)
+
+    def claim(self, path):
+        self.claimed.append(path)
+
+    def finish(self, service, items, failed_items):
+        self.finished.append((service, items, failed_items))
+
+
+def _options(worker, **kwargs):
+    options = preprocess.get_option_template(worker=worker, **kwargs)
+    options['executor_kwargs'] = {'max_workers': kwargs.get('workers', 1)}
+    return options
+
+
+# pylint: disable=missing-function-docstring,redefined-outer-name
+
+
+def test_work_starts_before_walk_ends():
+    started = threading.Event()
+
+    def worker(path, _):
+        started.set()
+        return True
+
+    def between(number):
+        if number == 0:
+            assert started.wait(5), 'first file waited for the whole walk'
+
+    index = FakeIndex([('foo', str(i)) for i in range(3)], between=between)
+    result = pipeline.Pipeline(index, {'foo': _options(worker)}).run('bar')
+
+    assert result == {'foo': (3, [])}
+
+
+def test_full_queue_pauses_the_walk():
+    release = threading.Event()
+    dispatched = []
+
+    def worker(path, _):
+        release.wait(5)
+        return True
+
+    index = FakeIndex([('foo', str(i)) for i in range(6)],
+                      between=dispatched.append)
+    runner = pipeline.Pipeline(index, {'foo': _options(worker)}, max_queued=1)
+
+    thread = threading.Thread(target=runner.run, args=('bar',))
+    thread.start()
+    thread.join(0.2)
+
+    # one file on the worker, one on the queue and one waiting to be queued
+    assert len(dispatched) <= 2, 'walk was not paused by a full queue'
+
+    release.set()
+    thread.join(5)
+    assert len(dispatched) == 6
+    assert runner.stats['foo']['done'] == 6
+
+
+def test_failures_are_reported():
+    def worker(path, _):
+        if path == 'boom':
+            raise RuntimeError(path)
+        return path == 'ok'
+
+    index = FakeIndex([('foo', 'ok'), ('foo', 'ko'), ('foo', 'boom')])
+    result = pipeline.Pipeline(index, {'foo': _options(worker, workers=2)}).run('bar')
+
+    assert result['foo'][0] == 3
+    assert sorted(result['foo'][1]) == ['boom', 'ko']
+    assert ('foo', ['ko'], ['ko']) in index.finished
+    assert ('foo', ['ok'], []) in index.finished
+
+
+def test_foreground_service_runs_while_walking():
+    processed = []
+
+    def unpack(path, _):
+        # a foreground worker may find more files for other services
+        runner.dispatch('foo', f'{path}/member')
+        return True
+
+    def worker(path, _):
+        processed.append(path)
+        return True
+
+    index = FakeIndex([('zip', 'a.zip'), ('foo', 'b')])
+    runner = pipeline.Pipeline(index, {
+        'zip': _options(unpack, background=False),
+        'foo': _options(worker, output=lambda path: f'{path}.out'),
+    })
+    result = runner.run('bar')
+
+    assert result == {'zip': (1, []), 'foo': (2, [])}
+    assert sorted(processed) == ['a.zip/member', 'b']
+    assert sorted(index.claimed) == ['a.zip/member.out', 'b.out']
+
+
+def test_global_worker_limit():
+    lock, running, peak = threading.Lock(), [0], [0]
+
+    def worker(path, _):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        threading.Event().wait(0.01)
+        with lock:
+            running[0] -= 1
+        return True
+
+    index = FakeIndex([(service, str(i)) for i in range(10) for service in ['foo', 'bar']])
+    options = {'foo': _options(worker, workers=3), 'bar': _options(worker, workers=3)}
+    pipeline.Pipeline(index, options, max_workers=2).run('baz')
+
+    assert peak[0] <= 2
+
+
+def test_pipelines_sharing_slots_keep_to_one_budget():
+    lock, running, peak = threading.Lock(), [0], [0]
+
+    def worker(path, _):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        threading.Event().wait(0.01)
+        with lock:
+            running[0] -= 1
+        return True
+
+    options = {'foo': _options(worker, workers=3)}
+    slots = pipeline.build_scheduler(options, max_workers=2)
+    slots.start()
+
+    runners = [pipeline.Pipeline(FakeIndex([('foo', str(i)) for i in range(10)]),
+                                 options, slots=slots) for _ in range(3)]
+    threads = [threading.Thread(target=runner.run, args=('baz',)) for runner in runners]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    slots.close()
+
+    assert peak[0] <= 2
+    assert all(runner.stats['foo']['done'] == 10 for runner in runners)
+
+
+@pytest.fixture
+def sync_tree(tmp_path):
+    ''' Tree with a pdf and a zip holding another pdf '''
+
+    (tmp_path / 'course').mkdir()
+    (tmp_path / 'course' / 'a.pdf').write_bytes(b'%PDF-1.4\n')
+    with zipfile.ZipFile(tmp_path / 'course' / 'b.zip', mode='w') as writer:
+        writer.writestr('slides/c.pdf', b'%PDF-1.4\n')
+    return tmp_path
+
+
+def test_pipeline_with_scan_index(sync_tree):
+    converted = []
+
+    def convert(path, _):
+        converted.append(path)
+        pathlib.Path(preprocess.trusted_path(path)).write_bytes(b'%PDF-1.4\n')
+        return True
+
+    options = {
+        'pdf': _options(convert, mimes=('application/pdf',), output=preprocess.trusted_path),
+        'zip': preprocess.zip_options(),
+    }
+    index = preprocess.ScanIndex(options)
+    options['zip']['index'] = index
+
+    result = pipeline.Pipeline(index, options).run(str(sync_tree))
+
+    expected = sorted([str(sync_tree / 'course' / 'a.pdf'),
+                       str(sync_tree / 'course' / 'slides' / 'c.pdf')])
+    assert sorted(converted) == expected, 'trusted outputs or members were not handled once'
+    assert result == {'pdf': (2, []), 'zip': (1, [])}
+    assert not os.path.exists(sync_tree / 'course' / 'b.zip')
+
+
+def test_members_are_converted_while_archive_extracts(sync_tree, monkeypatch):
+    with zipfile.ZipFile(sync_tree / 'course' / 'b.zip', mode='a') as writer:
+        writer.writestr('slides/d.pdf', b'%PDF-1.4\n')
+
+    first_converted = threading.Event()
+    original_extract = preprocess.extract.extract_archive
+
+    def slow_extract(path, **kwargs):
+        for number, member in enumerate(original_extract(path, **kwargs)):
+            yield member
+            if number == 0:
+                assert first_converted.wait(5), 'member waited for the whole archive'
+
+    monkeypatch.setattr(preprocess.extract, 'extract_archive', slow_extract)
+
+    def convert(path, _):
+        first_converted.set()
+        return True
+
+    options = {
+        'pdf': _options(convert, mimes=('application/pdf',), workers=2),
+        'zip': preprocess.zip_options(),
+    }
+    index = preprocess.ScanIndex(options)
+    options['zip']['index'] = index
+
+    result = pipeline.Pipeline(index, options).run(str(sync_tree))
+    assert result == {'pdf': (3, []), 'zip': (1, [])}
+
+
+@pytest.fixture
+def stub_converter(tmp_path):
+    ''' Pdf converter logging each launch, which fails on files named bad
+        leaving a partial output behind '''
+
+    log = tmp_path / 'launches.log'
+    stub = tmp_path / 'qvm-convert-pdf'
+    stub.write_text(f'''#!/bin/sh
+echo "$@" >> {log}
+status=0
+for path; do
+    case "$path" in
+        *bad*) status=1; echo partial > "${{path%.pdf}}.trusted.pdf" ;;
+        *) cp "$path" "${{path%.pdf}}.trusted.pdf" && rm "$path" ;;
+    esac
+done
+exit $status
+''')
+    stub.chmod(0o755)
+    return str(stub), log
+
+
+def _convert_tree(directory, binary, **kwargs):
+    options = {'pdf': preprocess.pdf_options(pdf_bin_converter=binary, no_cache=True, **kwargs)}
+    index = preprocess.ScanIndex(options)
+    return pipeline.Pipeline(index, options).run(str(directory))
+
+
+@pytest.mark.parametrize('batch_files, launches', [(1, 10), (4, 3)])
+def test_batches_reduce_converter_launches(tmp_path, stub_converter, batch_files, launches):
+    binary, log = stub_converter
+    (tmp_path / 'tree').mkdir()
+    for number in range(10):
+        (tmp_path / 'tree' / f'{number}.pdf').write_bytes(b'%PDF-1.4\n')
+
+    result = _convert_tree(tmp_path / 'tree', binary, batch_files=batch_files)
+
+    assert result == {'pdf': (10, [])}
+    assert len(log.read_text().splitlines()) == launches
+    assert len(list((tmp_path / 'tree').glob('*.trusted.pdf'))) == 10
+
+
+def test_batch_failures_are_reported_per_file(tmp_path, stub_converter):
+    binary, log = stub_converter
+    (tmp_path / 'tree').mkdir()
+    for name in ['a.pdf', 'bad.pdf', 'c.pdf']:
+        (tmp_path / 'tree' / name).write_bytes(b'%PDF-1.4\n')
+    (tmp_path / 'tree' / 'big.pdf').write_bytes(b'%PDF-1.4\n' + b'0' * 2 * 1024 * 1024)
+
+    result = _convert_tree(tmp_path / 'tree', binary, batch_files=10, batch_size=1)
+
+    assert result == {'pdf': (4, [str(tmp_path / 'tree' / 'bad.pdf')])}
+    assert not (tmp_path / 'tree' / 'bad.trusted.pdf').exists(), 'partial output was kept'
+    assert (tmp_path / 'tree' / 'a.trusted.pdf').exists()
+    # the file bigger than a batch is converted alone
+    assert sorted(len(line.split()) for line in log.read_text().splitlines()) == [1, 3]
+
+
+def test_transient_failures_are_retried():
+    attempts = []
+
+    def worker(path, _):
+        attempts.append(path)
+        if path == 'flaky' and len(attempts) < 3:
+            raise pipeline.TransientError('dispvm did not start')
+        if path == 'broken':
+            raise pipeline.JobTimeout('wedged')
+        return True
+
+    index = FakeIndex([('foo', 'flaky')])
+    runner = pipeline.Pipeline(index, {'foo': _options(worker)}, max_retries=2, backoff=0.01)
+    assert runner.run('bar') == {'foo': (1, [])}
+    assert attempts == ['flaky'] * 3
+    assert runner.stats['foo']['retries'] == 2
+
+    attempts.clear()
+    index = FakeIndex([('foo', 'broken')])
+    runner = pipeline.Pipeline(index, {'foo': _options(worker)}, max_retries=1, backoff=0.01)
+    assert runner.run('bar') == {'foo': (1, ['broken'])}
+    assert attempts == ['broken'] * 2
+    assert runner.stats['foo']['timeouts'] == 2
+
+
+def test_hung_converter_times_out(tmp_path):
+    converter = tmp_path / 'qvm-convert-pdf'
+    converter.write_text('#!/bin/sh\ncase "$1" in *hang*) sleep 30 ;; esac\n'
+                         'cp "$1" "${1%.pdf}.trusted.pdf"\n')
+    converter.chmod(0o755)
+    (tmp_path / 'tree').mkdir()
+    for name in ['hang.pdf', 'ok.pdf']:
+        (tmp_path / 'tree' / name).write_bytes(b'%PDF-1.4\n')
+
+    options = {'pdf': preprocess.pdf_options(pdf_bin_converter=str(converter),
+                                             pdf_timeout=0.2, no_cache=True)}
+    runner = pipeline.Pipeline(preprocess.ScanIndex(options), options, budget=1600,
+                               max_retries=1, backoff=0.01)
+
+    assert runner.run(str(tmp_path / 'tree')) == {'pdf': (2, [str(tmp_path / 'tree' / 'hang.pdf')])}
+    assert runner.stats['pdf']['timeouts'] == 2
+    assert runner.stats['pdf']['retries'] == 1
+
+
+def test_identical_files_are_converted_once(tmp_path, stub_converter):
+    binary, log = stub_converter
+    tree = tmp_path / 'tree'
+    for folder in ['course-1', 'course-2', 'course-3']:
+        (tree / folder).mkdir(parents=True)
+        (tree / folder / 'slides.pdf').write_bytes(b'%PDF-1.4\nsame slides\n')
+    (tree / 'course-1' / 'other.pdf').write_bytes(b'%PDF-1.4\nother file\n')
+
+    options = {'pdf': preprocess.pdf_options(pdf_bin_converter=binary, no_cache=True,
+                                             untrusted_pdf_dir=str(tmp_path / 'untrusted'),
+                                             dedup_link='copy')}
+    runner = pipeline.Pipeline(preprocess.ScanIndex(options), options, deduplicate=True)
+    result = runner.run(str(tree))
+
+    assert result == {'pdf': (4, [])}
+    assert len(log.read_text().splitlines()) == 2
+    assert runner.stats['pdf']['deduplicated'] == 2
+    for folder in ['course-1', 'course-2', 'course-3']:
+        assert (tree / folder / 'slides.trusted.pdf').read_bytes() == b'%PDF-1.4\nsame slides\n'
+    assert len(list((tmp_path / 'untrusted').glob('slides*.pdf'))) == 2, \
+        'originals of copies were not kept'
+
+
+def test_copy_is_converted_when_its_leader_fails(tmp_path):
+    converted, shared = [], []
+    paths = []
+    for name in ['a', 'b', 'c']:
+        path = tmp_path / name
+        path.write_text('same content')
+        paths.append(str(path))
+
+    walked = threading.Event()
+
+    def worker(path, _):
+        # copies all wait on the leader, its failure promotes one of them
+        walked.wait(5)
+        converted.append(path)
+        return not path.endswith('a')
+
+    def share_worker(source, path, _):
+        shared.append((source, path))
+        return True
+
+    options = {'foo': _options(worker, share_worker=share_worker, weight=1)}
+    index = FakeIndex([('foo', path) for path in paths],
+                      between=lambda number: number == 2 and walked.set())
+    runner = pipeline.Pipeline(index, options, deduplicate=True)
+    result = runner.run('bar')
+
+    assert result == {'foo': (3, [paths[0]])}
+    assert converted == paths[:2]
+    assert shared == [(paths[1], paths[2])]
@@ -0,0 +1,110 @@
+'''
+Functional test of placement module.
+'''
+
+
+import os
+import errno
+import pathlib
+
+import pytest
+import placement
+import preprocess
+
+
+# pylint: disable=missing-function-docstring
+
+
+@pytest.mark.parametrize('method', placement.COPY_METHODS)
+def test_copy_methods(tmp_path, method):
+    source, dest = tmp_path / 'source', tmp_path / 'dest'
+    source.write_bytes(os.urandom(3 * placement.BUFFER_SIZE + 17))
+    source.chmod(0o644)
+
+    try:
+        used = placement.copy(str(source), str(dest), methods=(method,))
+    except OSError as error:
+        pytest.skip(f'{method} is not supported here: {error}')
+
+    assert used == method
+    assert dest.read_bytes() == source.read_bytes()
+    assert dest.stat().st_mode & 0o777 == 0o644
+    assert sorted(os.listdir(tmp_path)) == ['dest', 'source']
+
+
+def test_unsupported_methods_fall_back(tmp_path, monkeypatch):
+    def unsupported(*_):
+        raise OSError(errno.EXDEV, 'cross device')
+
+    monkeypatch.setitem(placement.PRIMITIVES, 'reflink', unsupported)
+    monkeypatch.setitem(placement.PRIMITIVES, 'copy_file_range', unsupported)
+    source, dest = tmp_path / 'source', tmp_path / 'dest'
+    source.write_text('content')
+
+    assert placement.copy(str(source), str(dest)) in ('sendfile', 'buffered')
+    assert dest.read_text() == 'content'
+
+
+@pytest.mark.parametrize('mode', placement.LINK_MODES)
+def test_link(tmp_path, mode):
+    source, dest = tmp_path / 'source', tmp_path / 'dest'
+    source.write_text('trusted')
+    source.chmod(0o644)
+
+    used = placement.link(str(source), str(dest), mode=mode)
+
+    assert dest.read_text() == 'trusted'
+    assert dest.stat().st_mode & 0o777 == 0o644
+    assert (source.stat().st_ino == dest.stat().st_ino) == (used == 'hardlink')
+    if mode == 'copy':
+        assert used != 'reflink', 'a copy must not share extents'
+
+
+def test_move_across_filesystems_copies(tmp_path, monkeypatch):
+    def cross_device(*_):
+        raise OSError(errno.EXDEV, 'cross device')
+
+    monkeypatch.setattr(placement.os, 'rename', cross_device)
+    source, dest = tmp_path / 'source', tmp_path / 'dest'
+    source.write_text('content')
+    os.utime(source, (1, 1))
+
+    assert placement.move(str(source), str(dest)) in placement.COPY_METHODS
+    assert not source.exists()
+    assert dest.read_text() == 'content'
+    assert dest.stat().st_mtime == 1
+
+
+def test_store_keeps_relative_paths(tmp_path):
+    tree, store = tmp_path / 'tree', tmp_path / 'store'
+    for course in ['math', 'physics']:
+        (tree / course).mkdir(parents=True)
+        (tree / course / 'week1.png').write_text(course)
+
+    for course in ['math', 'physics']:
+        placement.move_to_store(str(tree / course / 'week1.png'), str(store), str(tree))
+    (tree / 'math' / 'week1.png').write_text('again')
+    moved = placement.move_to_store(str(tree / 'math' / 'week1.png'), str(store), str(tree))
+
+    assert (store / 'math' / 'week1.png').read_text() == 'math'
+    assert (store / 'physics' / 'week1.png').read_text() == 'physics'
+    assert pathlib.Path(moved) == store / 'math' / 'week1.1.png'
+
+    outside = tmp_path / 'outside.png'
+    outside.write_text('outside')
+    assert placement.store_path(str(outside), str(store), str(tree)) == str(store / 'outside.png')
+
+
+def test_run_images_keeps_courses_apart(tmp_path, monkeypatch):
+    tree, store = tmp_path / 'tree', tmp_path / 'untrusted'
+    options = preprocess.image_options(untrusted_dir=str(store), no_cache=True)
+    options['root'] = str(tree)
+    monkeypatch.setattr(preprocess, 'execute_converter', lambda *_, **__: True)
+
+    for course in ['math', 'physics']:
+        (tree / course).mkdir(parents=True)
+        (tree / course / 'cover.png').write_text(course)
+        assert preprocess.run_images(str(tree / course / 'cover.png'), options)
+
+    assert (store / 'math' / 'cover.png').read_text() == 'math'
+    assert (store / 'physics' / 'cover.png').read_text() == 'physics'
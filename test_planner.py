@@ -0,0 +1,102 @@
+'''
+Functional test of planner module.
+'''
+
+
+import io
+import os
+import json
+import zipfile
+
+import planner
+import preprocess
+
+from test_estimate import _pdf, _jpeg
+
+
+def _zip(members: dict) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, mode='w', compression=zipfile.ZIP_DEFLATED) as writer:
+        for name, content in members.items():
+            writer.writestr(name, content)
+    return buffer.getvalue()
+
+
+def _tree(tmp_path):
+    tree = tmp_path / 'tree'
+    os.makedirs(tree / 'week-1')
+    for number in range(5):
+        (tree / 'week-1' / f'{number}.pdf').write_bytes(_pdf(number + 1))
+    (tree / 'photo.jpg').write_bytes(_jpeg(1920, 1080))
+    (tree / 'notes.txt').write_text('nothing to convert')
+    (tree / 'material.zip').write_bytes(_zip({'a.pdf': _pdf(3),
+                                              'b.png': b'0' * 100,
+                                              'inner.zip': _zip({'c.pdf': _pdf(1)}),
+                                              'readme.txt': 'hello'}))
+    return tree
+
+
+def _snapshot(tree) -> dict:
+    return {path: path.stat().st_mtime_ns for path in tree.rglob('*')}
+
+
+# pylint: disable=missing-function-docstring
+
+
+def test_plan_counts_work_without_changing_the_tree(tmp_path):
+    tree = _tree(tmp_path)
+    before = _snapshot(tree)
+
+    index = preprocess.ScanIndex(preprocess.gen_service_options())
+    plan = planner.build_plan(index, str(tree), max_workers=4)
+
+    assert _snapshot(tree) == before, 'planning changed the tree'
+    services = plan['services']
+    assert services['pdf']['files'] == 5
+    assert services['pdf']['zip_members'] == 1
+    assert services['pdf']['launches'] == 6
+    assert services['image']['files'] == 1
+    assert services['image']['launches'] == 2
+    assert plan['totals']['ignored'] == 1
+
+    [archive] = plan['zips']
+    assert archive['members'] == 4
+    assert archive['nested_zips'] == 1
+    assert archive['bytes'] == sum(info.file_size for info in
+                                   zipfile.ZipFile(tree / 'material.zip').infolist())
+    assert services['pdf']['rate'] == 'estimated'
+    json.dumps(plan)
+
+
+def test_plan_uses_recorded_rates_and_batches(tmp_path):
+    tree = _tree(tmp_path)
+    service_options = preprocess.gen_service_options(batch_files=4)
+    rates = {'pdf': {'seconds_per_file': 30.0, 'files': 100}}
+
+    plan = planner.build_plan(preprocess.ScanIndex(service_options), str(tree),
+                              rates=rates, max_workers=2)
+
+    pdf = plan['services']['pdf']
+    assert pdf['launches'] == 2
+    assert pdf['rate'] == 'recorded'
+    assert pdf['converter_seconds'] == 6 * 30.0
+    assert plan['totals']['wall_seconds'] >= pdf['converter_seconds'] / 2
+
+
+def test_count_launches_splits_batches_by_size():
+    options = preprocess.get_option_template(batch_worker=print)
+    options['executor_kwargs'] = {'batch_files': 3, 'batch_bytes': 100}
+
+    assert planner.count_launches(options, [10] * 7) == 3
+    assert planner.count_launches(options, [60, 60, 500, 10]) == 3
+
+
+def test_plan_leaves_the_file_index_untouched(tmp_path):
+    tree = _tree(tmp_path)
+    file_index = preprocess.fileindex.FileIndex(str(tmp_path / 'index.sqlite'))
+    index = preprocess.ScanIndex(preprocess.gen_service_options(),
+                                 file_index=file_index, read_only=True)
+
+    planner.build_plan(index, str(tree))
+
+    assert file_index.snapshot(str(tree)) == {}
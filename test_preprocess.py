@@ -3,12 +3,13 @@ Functional test of preprocess module.
 '''
 
 
+import io
 import os
 import pathlib
 import secrets
+import time
 import zipfile
 import subprocess
-import concurrent.futures
 from unittest import mock
 
 import pytest
@@ -73,6 +74,9 @@ def bin_services_factory(tmp_path):
 # pylint: disable=missing-function-docstring,redefined-outer-name
 
 
+ENGINES = ['threads', 'asyncio']
+
+
 def test_scanned_files(tmp_path):
     last_dir = tmp_path
     choosen = []
@@ -111,152 +115,184 @@ def test_mimetype_verification_fails_on_invalid(custom_mimetype):
     assert not preprocess.is_mimetype('bar', *mimes), 'mimetype asserted false when was true'
 
 
-def test_unzip(zip_factory):
-    tmp_path, zip_mock, zip_file = zip_factory
+def test_scan_index_probes_each_file_once(tmp_path, monkeypatch):
+    mimes = {'a.pdf': 'application/pdf',
+             'b.png': 'image/png',
+             'c.zip': 'application/zip',
+             'd.txt': 'text/plain',}
 
-    preprocess.unzip(zip_file)
+    nested = tmp_path / pathlib.Path('nested')
+    os.mkdir(nested)
+    for name in mimes:
+        with open(nested / pathlib.Path(name), 'w') as _:
+            pass
 
-    zip_mock.assert_called_with(zip_file)
-    zip_mock.extractall.assert_called_with(str(tmp_path))
-    zip_mock.__enter__.assert_called()
+    probe_mock = mock.Mock(side_effect=lambda path: mimes[os.path.basename(path)])
+    monkeypatch.setattr(preprocess.mimesniff, 'sniff', probe_mock)
 
-    assert not zip_file.exists(), 'zip file was not removed'
+    index = preprocess.ScanIndex(preprocess.gen_service_options()).scan(str(tmp_path))
 
+    assert probe_mock.call_count == len(mimes), 'files were probed more than once'
+    assert index.items('pdf') == [str(nested / 'a.pdf')]
+    assert index.items('image') == [str(nested / 'b.png')]
+    assert index.items('zip') == [str(nested / 'c.zip')]
+    assert index.ignored == 1
 
-def test_unzip_keeps_zipfiles(zip_factory):
-    _, _, zip_file = zip_factory
 
-    preprocess.unzip(zip_file, flush=False)
-    assert zip_file.exists(), 'zip file were removed'
+def test_incremental_scan_skips_settled_files(tmp_path, monkeypatch):
+    mimes = {'a.pdf': 'application/pdf', 'b.txt': 'text/plain', 'c.pdf': 'application/pdf'}
+    tree = tmp_path / 'tree'
+    os.mkdir(tree)
+    for name in ['a.pdf', 'b.txt']:
+        (tree / name).write_text(name)
 
+    probe_mock = mock.Mock(side_effect=lambda path: mimes[os.path.basename(path)])
+    monkeypatch.setattr(preprocess.mimesniff, 'sniff', probe_mock)
 
-def test_check_binaries(bin_services_factory):
-    options = bin_services_factory()
-    result = preprocess.check_binaries(options)
-    assert result, 'fake binaries failed to pass verification'
+    file_index = preprocess.fileindex.FileIndex(str(tmp_path / 'db' / 'index.sqlite'))
+    service_options = preprocess.gen_service_options()
 
+    index = preprocess.ScanIndex(service_options, file_index=file_index).scan(str(tree))
+    assert index.items('pdf') == [str(tree / 'a.pdf')]
 
-def test_find_missing_binaries(bin_services_factory):
-    # only create binaries from index 1
-    service_options = bin_services_factory(1)
-    expected_missing = [list(service_options.values())[0]['package'],]
+    # the converted pdf vanishes and its trusted output shows up
+    (tree / 'a.trusted.pdf').write_text('trusted')
+    (tree / 'a.pdf').unlink()
+    index.finish('pdf', index.items('pdf'), [])
+    (tree / 'c.pdf').write_text('new')
 
-    faileds = preprocess.find_missing_packages(service_options)
-    assert expected_missing == faileds, 'invalid missing packages found'
+    probe_mock.reset_mock()
+    index = preprocess.ScanIndex(service_options, file_index=file_index).scan(str(tree))
 
+    assert index.items('pdf') == [str(tree / 'c.pdf')]
+    assert index.up_to_date == 2, 'trusted output and ignored file should be settled'
+    probe_mock.assert_called_once_with(str(tree / 'c.pdf'))
 
-def test_execute_converter_escapes_shell_chars(monkeypatch):
-    fake_binary = 'foo'
-    fake_arguments = ['bar ; yada', 'baz',]
-    expected_cmd = "foo 'bar ; yada' baz"
 
-    check_cmd_mock = mock.Mock()
-    monkeypatch.setattr(preprocess, 'check_cmd', check_cmd_mock)
+def test_incremental_scan_retries_failed_and_changed_files(tmp_path):
+    tree = tmp_path / 'tree'
+    os.mkdir(tree)
+    target_file = tree / 'a.pdf'
+    target_file.write_bytes(b'%PDF-1.4\n')
 
-    preprocess.execute_converter(fake_binary, *fake_arguments)
-    check_cmd_mock.assert_called_with(expected_cmd)
+    file_index = preprocess.fileindex.FileIndex(str(tmp_path / 'index.sqlite'))
+    service_options = {'pdf': preprocess.pdf_options()}
 
+    index = preprocess.ScanIndex(service_options, file_index=file_index).scan(str(tree))
+    index.finish('pdf', index.items('pdf'), index.items('pdf'))
 
-def test_handle_futures(monkeypatch):
-    services = [('foo', lambda: True),
-                ('bar', RuntimeError),
-                ('baz', lambda: 'yada'),]
+    index = preprocess.ScanIndex(service_options, file_index=file_index).scan(str(tree))
+    assert index.items('pdf') == [str(target_file)], 'failed file was not retried'
+    index.finish('pdf', index.items('pdf'), [])
 
-    expected_result = [('foo', True, None),
-                       ('bar', None, RuntimeError),
-                       ('baz', 'yada', None),]
+    index = preprocess.ScanIndex(service_options, file_index=file_index).scan(str(tree))
+    assert not index.items('pdf'), 'done file was scheduled again'
 
-    future_to_service = {}
-    for name, effect in services:
-        future_mock = mock.Mock()
-        future_mock.result.side_effect = effect
-        future_to_service[future_mock] = name
+    target_file.write_bytes(b'%PDF-1.5\nchanged')
+    index = preprocess.ScanIndex(service_options, file_index=file_index).scan(str(tree))
+    assert index.items('pdf') == [str(target_file)], 'changed file was not scheduled'
 
-    monkeypatch.setattr(concurrent.futures,
-                        'as_completed',
-                        mock.Mock(return_value=future_to_service.keys()))
 
-    result_gen = preprocess.handle_futures(future_to_service)
-    assertion_msg = '%s from future differs from expected'
+def test_run_zips_classifies_extracted_members(tmp_path):
+    nested = io.BytesIO()
+    with zipfile.ZipFile(nested, mode='w') as writer:
+        writer.writestr('e.pdf', b'%PDF-1.4\n')
 
-    for service, result, error in expected_result:
-        past_service, past_result, past_error = next(result_gen)
-        assert service == past_service, assertion_msg % 'service'
-        assert result == past_result, assertion_msg % 'result'
-        if past_error:
-            assert isinstance(past_error, error), assertion_msg % 'exception instance'
-        else:
-            assert past_error == error, assertion_msg % 'error'
+    target_file = tmp_path / pathlib.Path('foo.zip')
+    with zipfile.ZipFile(target_file, mode='w') as writer:
+        writer.writestr('dir/bar.pdf', b'%PDF-1.4\n')
+        writer.writestr('dir/baz.zip', nested.getvalue())
 
+    options = preprocess.zip_options()
+    options['index'] = preprocess.ScanIndex(preprocess.gen_service_options())
 
-def _dump_equal(item1, item2):
-    return item1 == item2
+    assert preprocess.run_zips(str(target_file), options)
+    assert sorted(options['index'].items('pdf')) == [str(tmp_path / 'dir' / 'bar.pdf'),
+                                                     str(tmp_path / 'dir' / 'e.pdf')]
+    assert not options['index'].items('zip'), 'nested zip should not be scheduled'
+    assert not (tmp_path / 'dir' / 'baz.zip').exists(), 'nested zip was not removed'
+    assert not target_file.exists(), 'zip file was not removed'
 
 
-def test_wait_futures():
-    items = ['foo', 'baz',]
-    expected_faileds = ['baz',]
+def test_run_zips_fails_past_limits(tmp_path):
+    target_file = tmp_path / pathlib.Path('foo.zip')
+    with zipfile.ZipFile(target_file, mode='w') as writer:
+        for i in range(3):
+            writer.writestr(f'{i}.txt', b'foo')
 
-    faileds = preprocess.wait_futures(_dump_equal, items, 'foo')
+    options = preprocess.zip_options(zip_max_members=2)
+    options['index'] = preprocess.ScanIndex(preprocess.gen_service_options())
 
-    assert expected_faileds == faileds
+    assert not preprocess.run_zips(str(target_file), options)
+    assert target_file.exists(), 'zip file was removed after failing'
 
 
-def _foo_worker(item, options):
-    return options['predicate']['func'](item, options['match'])
+def test_unzip(zip_factory):
+    tmp_path, zip_mock, zip_file = zip_factory
 
+    preprocess.unzip(zip_file)
 
-def test_service_runner(tmp_path):
-    def predicate(path, *items):
-        return any(path.endswith(item) for item in items)
+    zip_mock.assert_called_with(zip_file)
+    zip_mock.infolist.assert_called_with()
+    zip_mock.close.assert_called()
 
-    target_files = []
+    assert not zip_file.exists(), 'zip file was not removed'
 
-    for i in range(3):
-        target_file = tmp_path / pathlib.Path(str(i))
-        with open(target_file, 'w') as _:
-            pass
-        target_files.append(str(target_file))
 
-    # filter files, only get 0 and 1
-    options = preprocess.get_predicate_template(predicate, '0', '1')
+def test_unzip_keeps_zipfiles(zip_factory):
+    _, _, zip_file = zip_factory
 
-    # worker will succeeded when file matches the match option
-    result = preprocess.service_runner(_foo_worker,
-                                       dict(predicate=options, match='0'),
-                                       'foo',
-                                       str(tmp_path))
+    preprocess.unzip(zip_file, flush=False)
+    assert zip_file.exists(), 'zip file were removed'
 
-    assert result[0] == 2, 'invalid number of files targeted'
-    assert target_files[1:2] == result[1], 'worker returned true when was false'
 
+def test_unzip_members_of_nested_archive(tmp_path):
+    course = tmp_path / 'course' / 'week'
+    os.makedirs(course)
+    target_file = course / 'foo.zip'
+    with zipfile.ZipFile(target_file, mode='w') as writer:
+        writer.writestr('slides/', b'')
+        writer.writestr('slides/a.pdf', b'a')
+        writer.writestr('../../escape.pdf', b'b')
+        writer.writestr('/absolute.pdf', b'c')
 
-def test_chained_foreground_run(monkeypatch):
-    services, service_calls = [], []
+    claimed = []
+    members = list(preprocess.extract.extract_archive(str(target_file), claim=claimed.append))
 
-    for i in range(3):
-        service_args = ([i] * 3, {'yada': i})
-        services.append(service_args)
-        call = mock.call(*service_args[0], **service_args[1])
-        service_calls.append(call)
+    expected = [str(course / 'slides' / 'a.pdf'),
+                str(course / 'escape.pdf'),
+                str(course / 'absolute.pdf')]
+    assert sorted(members) == sorted(expected)
+    assert claimed == expected, 'members were not claimed before extraction'
+    assert (course / 'slides' / 'a.pdf').read_bytes() == b'a'
+    assert not (tmp_path / 'escape.pdf').exists(), 'member escaped the archive directory'
 
-    # create a mock with arbitrary return
-    service_mock = done_mock = mock.Mock(return_value=(1, []))
-    run_args, run_kwargs = 'foo', {'bar': 'baz'}
 
-    service_calls.append(mock.call(run_args, **run_kwargs))
+def test_check_binaries(bin_services_factory):
+    options = bin_services_factory()
+    result = preprocess.check_binaries(options)
+    assert result, 'fake binaries failed to pass verification'
 
-    monkeypatch.setattr(preprocess, 'service_runner', service_mock)
-    preprocess.chained_foreground_run(services, done_mock, run_args, **run_kwargs)
-    service_mock.assert_has_calls(service_calls, any_order=False)
 
+def test_find_missing_binaries(bin_services_factory):
+    # only create binaries from index 1
+    service_options = bin_services_factory(1)
+    expected_missing = [list(service_options.values())[0]['package'],]
 
-def test_chained_foreground_run_with_no_service():
-    # create a mock with arbitrary return
-    done_mock = mock.Mock()
+    faileds = preprocess.find_missing_packages(service_options)
+    assert expected_missing == faileds, 'invalid missing packages found'
 
-    preprocess.chained_foreground_run([], done_mock)
-    done_mock.assert_called_with()
+
+def test_execute_converter_escapes_shell_chars(monkeypatch):
+    fake_binary = 'foo'
+    fake_arguments = ['bar ; yada', 'baz',]
+    expected_cmd = "foo 'bar ; yada' baz"
+
+    check_cmd_mock = mock.Mock()
+    monkeypatch.setattr(preprocess, 'check_cmd', check_cmd_mock)
+
+    preprocess.execute_converter(fake_binary, *fake_arguments)
+    check_cmd_mock.assert_called_with(expected_cmd, timeout=None)
 
 
 def test_ensure_untrusted_images_dir(tmp_path):
@@ -287,9 +323,39 @@ def test_run_images(tmp_path, monkeypatch):
         assert move_target.exists() is return_value
 
 
+def test_run_pdfs_reuses_cached_conversion(tmp_path, monkeypatch):
+    untrusted_dir = tmp_path / pathlib.Path('untrusted')
+    options = preprocess.pdf_options(cache_dir=str(tmp_path / 'cache'),
+                                     untrusted_pdf_dir=str(untrusted_dir))
+    preprocess.open_conversion_cache(options)
+
+    def fake_converter(_, path, **__):
+        with open(preprocess.trusted_path(path), 'w') as writer:
+            writer.write('trusted')
+        os.unlink(path)
+        return True
+
+    exec_mock = mock.Mock(side_effect=fake_converter)
+    monkeypatch.setattr(preprocess, 'execute_converter', exec_mock)
+
+    for name in ['first', 'second']:
+        target_file = tmp_path / pathlib.Path(f'{name}.pdf')
+        target_file.write_text('same content')
+        assert preprocess.run_pdfs(str(target_file), options)
+        assert (tmp_path / f'{name}.trusted.pdf').read_text() == 'trusted'
+
+    exec_mock.assert_called_once()
+    assert not (tmp_path / 'second.pdf').exists(), 'original was left behind'
+    assert (untrusted_dir / 'second.pdf').exists(), 'original was not moved'
+
+
 def test_run_services(monkeypatch):
     cli_args = mock.Mock()
-    cli_args.directory.return_value = 'foo'
+    cli_args.incremental = False
+    cli_args.watch = False
+    cli_args.deliver = False
+    cli_args.priority_rules = None
+    cli_args.directory = 'foo'
     cli_args.max_workers.return_value = 123
 
     hook_mock = mock.Mock()
@@ -302,22 +368,264 @@ def test_run_services(monkeypatch):
         'skipped': preprocess.get_option_template(should_skip=True, hooks=hooks),
     }
 
-    expected_fg_services, expected_bg_services = [], []
-
-    for service in ['bar', 'foo', 'baz',]:
-        # pylint: disable=protected-access
-        preprocess._map_service(service,
-                                cli_args.directory,
-                                options[service],
-                                expected_fg_services,
-                                expected_bg_services)
-
-    run_mock = mock.Mock()
-    monkeypatch.setattr(preprocess, 'chained_foreground_run', run_mock)
+    pipeline_mock = mock.Mock()
+    pipeline_mock.return_value.run.return_value = {}
+    pipeline_mock.return_value.stats = {}
+    monkeypatch.setattr(preprocess.pipeline, 'Pipeline', pipeline_mock)
     preprocess.run_services(cli_args, options)
 
     hook_mock.assert_called_once()
-    run_mock.assert_called_with(expected_fg_services,
-                                preprocess.background_run,
-                                expected_bg_services,
-                                max_workers=cli_args.max_workers)
+
+    index, active_options = pipeline_mock.call_args[0]
+    assert isinstance(index, preprocess.ScanIndex)
+    assert list(active_options) == ['foo', 'bar', 'baz'], 'skipped service was run'
+    assert all(opt['index'] is index for opt in active_options.values())
+    assert list(index.service_options) == ['bar', 'foo', 'baz'], 'priority was not honoured'
+    assert pipeline_mock.call_args[1]['max_workers'] is cli_args.max_workers
+
+    pipeline_mock.return_value.run.assert_called_once_with(cli_args.directory)
+
+
+def test_check_cmd_kills_process_group_on_timeout(tmp_path):
+    pidfile = tmp_path / 'pid'
+    command = tmp_path / 'command'
+    command.write_text(f'#!/bin/sh\nsleep 30 &\necho $! > {pidfile}\nwait\n')
+    command.chmod(0o755)
+
+    start = time.monotonic()
+    with pytest.raises(preprocess.pipeline.JobTimeout):
+        preprocess.check_cmd(str(command), timeout=0.5)
+    assert time.monotonic() - start < 5
+
+    child, state = int(pidfile.read_text()), None
+    for _ in range(100):
+        try:
+            with open(f'/proc/{child}/stat') as reader:
+                state = reader.read().split()[2]
+        except FileNotFoundError:
+            state = 'gone'
+        if state in ('Z', 'gone'):
+            break
+        time.sleep(0.01)
+    assert state in ('Z', 'gone'), 'child of the command is still running'
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_run_services_converts_the_tree(tmp_path, monkeypatch, engine):
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    launches = tmp_path / 'launches.log'
+    stub = tmp_path / 'qvm-convert-pdf'
+    stub.write_text(f'''#!/bin/sh
+echo "$@" >> {launches}
+status=0
+for path; do
+    case "$path" in
+        *bad*) status=1; echo partial > "${{path%.pdf}}.trusted.pdf" ;;
+        *) cp "$path" "${{path%.pdf}}.trusted.pdf" && rm "$path" ;;
+    esac
+done
+exit $status
+''')
+    stub.chmod(0o755)
+
+    def run(tree):
+        for course in ['course1', 'course2']:
+            (tree / course).mkdir(parents=True)
+            (tree / course / 'a.pdf').write_text('%PDF-1.4\nsame')
+        (tree / 'course1' / 'b.pdf').write_text('%PDF-1.4\nb')
+        (tree / 'course1' / 'bad.pdf').write_text('%PDF-1.4\nbad')
+        with zipfile.ZipFile(tree / 'course1' / 'pack.zip', mode='w') as writer:
+            writer.writestr('c.pdf', b'%PDF-1.4\nc')
+
+        monkeypatch.setattr('sys.argv', ['preprocess.py', '--engine', engine,
+                                         '--skip-img', '--batch-files', '2',
+                                         '--pdf-bin-converter', str(stub),
+                                         '--cache-dir', str(tmp_path / 'cache'),
+                                         '--journal-dir', str(tmp_path / 'journals'),
+                                         '--rates-file', str(tmp_path / 'rates.json'),
+                                         str(tree)])
+        cli_args = preprocess.parse_args()
+        preprocess.run_services(cli_args, preprocess.gen_service_options(**vars(cli_args)))
+
+        assert sorted(os.listdir(tree / 'course1')) == ['a.trusted.pdf', 'b.trusted.pdf',
+                                                        'bad.pdf', 'c.trusted.pdf']
+        assert os.listdir(tree / 'course2') == ['a.trusted.pdf']
+        assert (tree / 'course2' / 'a.trusted.pdf').read_text() == '%PDF-1.4\nsame'
+        assert (tree / 'course1' / 'c.trusted.pdf').read_text() == '%PDF-1.4\nc'
+        calls = [call.split() for call in launches.read_text().splitlines()]
+        launches.unlink()
+        return calls
+
+    # one of the copies is shared, the zip member converted with the rest
+    calls = run(tmp_path / 'tree')
+    assert max(len(call) for call in calls) == 2, 'files were not batched'
+    converted = sorted(os.path.relpath(path, tmp_path / 'tree') for call in calls
+                       for path in call)
+    assert len(converted) == 4
+    assert [path for path in converted if not path.endswith('a.pdf')] == [
+        'course1/b.pdf', 'course1/bad.pdf', 'course1/c.pdf']
+
+    # the same files elsewhere come from the cache, failures are retried
+    calls = run(tmp_path / 'other')
+    assert calls == [[str(tmp_path / 'other' / 'course1' / 'bad.pdf')]]
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_resume_redoes_only_interrupted_conversions(tmp_path, monkeypatch, engine):
+    tree, home = tmp_path / 'tree', tmp_path / 'home'
+    tree.mkdir()
+    launches = tmp_path / 'launches.log'
+    stub = tmp_path / 'qvm-convert-pdf'
+    stub.write_text(f'#!/bin/sh\necho "$@" >> {launches}\n'
+                    'cp "$1" "${1%.pdf}.trusted.pdf" && rm "$1"\n')
+    stub.chmod(0o755)
+
+    # done was converted, busy was interrupted leaving a partial output
+    (tree / 'done.trusted.pdf').write_text('trusted')
+    (tree / 'busy.pdf').write_text('%PDF-1.4\nbusy')
+    (tree / 'busy.trusted.pdf').write_text('partial')
+    (tree / 'new.pdf').write_text('%PDF-1.4\nnew')
+
+    def cli(*args):
+        monkeypatch.setattr('sys.argv', ['preprocess.py', '--engine', engine,
+                                         '--no-cache', '--skip-img',
+                                         '--pdf-bin-converter', str(stub),
+                                         '--journal-dir', str(home / 'journals'),
+                                         '--rates-file', str(home / 'rates.json'),
+                                         *args, str(tree)])
+        cli_args = preprocess.parse_args()
+        return cli_args, preprocess.gen_service_options(**vars(cli_args))
+
+    cli_args, _ = cli()
+    run_journal = preprocess.journal.Journal(
+        preprocess.journal.journal_path(str(tree), cli_args.journal_dir))
+    for name, states in [('done', ['converting', 'converted', 'moved']),
+                         ('busy', ['converting'])]:
+        for state in states:
+            run_journal.record(str(tree / f'{name}.pdf'), state,
+                               output=str(tree / f'{name}.trusted.pdf'))
+    run_journal.close()
+
+    preprocess.run_services(*cli('--resume'))
+
+    assert sorted(launches.read_text().split()) == [str(tree / 'busy.pdf'), str(tree / 'new.pdf')]
+    assert sorted(os.listdir(tree)) == ['busy.trusted.pdf', 'done.trusted.pdf',
+                                        'new.trusted.pdf']
+    assert (tree / 'busy.trusted.pdf').read_text() == '%PDF-1.4\nbusy'
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_resume_skips_outputs_of_deduplicated_copies(tmp_path, monkeypatch, engine):
+    tree, home = tmp_path / 'tree', tmp_path / 'home'
+    launches = tmp_path / 'launches.log'
+    stub = tmp_path / 'qvm-convert-pdf'
+    stub.write_text(f'#!/bin/sh\necho "$@" >> {launches}\n'
+                    'cp "$1" "${1%.pdf}.trusted.pdf" && rm "$1"\n')
+    stub.chmod(0o755)
+    for course in ['course1', 'course2']:
+        (tree / course).mkdir(parents=True)
+        (tree / course / 'a.pdf').write_text('%PDF-1.4\nsame')
+
+    def run(*args):
+        monkeypatch.setattr('sys.argv', ['preprocess.py', '--engine', engine,
+                                         '--no-cache', '--skip-img',
+                                         '--pdf-bin-converter', str(stub),
+                                         '--journal-dir', str(home / 'journals'),
+                                         '--rates-file', str(home / 'rates.json'),
+                                         *args, str(tree)])
+        cli_args = preprocess.parse_args()
+        preprocess.run_services(cli_args, preprocess.gen_service_options(**vars(cli_args)))
+
+    run()
+    assert len(launches.read_text().splitlines()) == 1
+
+    # every file is settled, no output may be taken for a new pdf
+    run('--resume')
+    assert len(launches.read_text().splitlines()) == 1
+    for course in ['course1', 'course2']:
+        assert os.listdir(tree / course) == ['a.trusted.pdf']
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_resume_leaves_members_of_interrupted_extraction_to_it(tmp_path, monkeypatch, engine):
+    tree, home = tmp_path / 'tree', tmp_path / 'home'
+    tree.mkdir()
+    launches = tmp_path / 'launches.log'
+    stub = tmp_path / 'qvm-convert-pdf'
+    stub.write_text(f'#!/bin/sh\necho "$@" >> {launches}\n'
+                    'cp "$1" "${1%.pdf}.trusted.pdf" && rm "$1"\n')
+    stub.chmod(0o755)
+
+    inner = tmp_path / 'inner.zip'
+    with zipfile.ZipFile(inner, 'w') as archive:
+        archive.writestr('c.pdf', '%PDF-1.4\nc')
+    with zipfile.ZipFile(tree / 'course.zip', 'w') as archive:
+        archive.writestr('course/a.pdf', '%PDF-1.4\na')
+        archive.writestr('course/b.pdf', '%PDF-1.4\nb')
+        archive.write(inner, 'course/inner.zip')
+
+    # a was converted, b and the member of the flushed nested zip were cut short
+    (tree / 'course').mkdir()
+    (tree / 'course' / 'a.trusted.pdf').write_text('%PDF-1.4\na')
+    (tree / 'course' / 'b.pdf').write_text('%PDF-1.4\n')
+    (tree / 'course' / 'c.pdf').write_text('%PDF')
+
+    def cli(*args):
+        monkeypatch.setattr('sys.argv', ['preprocess.py', '--engine', engine,
+                                         '--no-cache', '--skip-img',
+                                         '--pdf-bin-converter', str(stub),
+                                         '--journal-dir', str(home / 'journals'),
+                                         '--rates-file', str(home / 'rates.json'),
+                                         *args, str(tree)])
+        cli_args = preprocess.parse_args()
+        return cli_args, preprocess.gen_service_options(**vars(cli_args))
+
+    cli_args, _ = cli()
+    run_journal = preprocess.journal.Journal(
+        preprocess.journal.journal_path(str(tree), cli_args.journal_dir))
+    run_journal.record(str(tree / 'course.zip'), 'extracting')
+    for state in ['converting', 'converted', 'moved']:
+        run_journal.record(str(tree / 'course' / 'a.pdf'), state,
+                           output=str(tree / 'course' / 'a.trusted.pdf'))
+    run_journal.close()
+
+    # the walk must not race the extraction for the members
+    cli_args, service_options = cli('--resume')
+    index = preprocess.ScanIndex(service_options)
+    preprocess.open_journal(cli_args, index).close()
+    assert [index._is_claimed(str(tree / 'course' / name))  # pylint: disable=protected-access
+            for name in ['b.pdf', 'inner.zip', 'c.pdf']] == [True, True, True]
+
+    preprocess.run_services(cli_args, service_options)
+
+    assert sorted(launches.read_text().split()) == [str(tree / 'course' / 'b.pdf'),
+                                                    str(tree / 'course' / 'c.pdf')]
+    assert (tree / 'course' / 'b.trusted.pdf').read_text() == '%PDF-1.4\nb'
+    assert (tree / 'course' / 'c.trusted.pdf').read_text() == '%PDF-1.4\nc'
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_deliver_ships_outputs_and_the_rest_of_the_tree(tmp_path, monkeypatch, engine):
+    tree, home, incoming = tmp_path / 'tree', tmp_path / 'home', tmp_path / 'incoming'
+    (tree / 'course').mkdir(parents=True)
+    incoming.mkdir()
+    stub = tmp_path / 'qvm-convert-pdf'
+    stub.write_text('#!/bin/sh\ncp "$1" "${1%.pdf}.trusted.pdf" && rm "$1"\n')
+    stub.chmod(0o755)
+
+    (tree / 'course' / 'book.pdf').write_text('%PDF-1.4\nbook')
+    (tree / 'course' / 'notes.txt').write_text('notes')
+
+    monkeypatch.setattr('sys.argv', ['preprocess.py', '--engine', engine,
+                                     '--no-cache', '--skip-img',
+                                     '--pdf-bin-converter', str(stub),
+                                     '--journal-dir', str(home / 'journals'),
+                                     '--rates-file', str(home / 'rates.json'),
+                                     '--deliver', '--deliver-command', f'cp -r -t {incoming}',
+                                     str(tree)])
+    cli_args = preprocess.parse_args()
+    assert preprocess.run_services(cli_args, preprocess.gen_service_options(**vars(cli_args))) == 0
+
+    delivered = sorted(os.path.relpath(os.path.join(root, name), incoming).split(os.sep, 1)[1]
+                       for root, _, names in os.walk(incoming) for name in names)
+    assert delivered == ['course/book.trusted.pdf', 'course/notes.txt']
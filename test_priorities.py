@@ -0,0 +1,116 @@
+'''
+Functional test of priorities module.
+'''
+
+
+import os
+import json
+import time
+import threading
+
+import pytest
+import pipeline
+import preprocess
+import priorities
+
+
+# pylint: disable=missing-function-docstring
+
+
+class ListIndex:
+    ''' Scan index replacement dispatching a list of files, calling
+        dispatched after each one '''
+
+    def __init__(self, items: list, dispatched: callable):
+        self.sink = None
+        self.items = items
+        self.dispatched = dispatched
+
+    def walk(self, _):
+        for number, (service, path) in enumerate(self.items):
+            self.sink(service, path)
+            self.dispatched(number)
+
+    def claim(self, path):
+        pass
+
+    def finish(self, service, items, failed_items):
+        pass
+
+
+def _touch(path, size=0, age_days=0):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b'x' * size)
+    mtime = time.time() - age_days * 86400
+    os.utime(path, (mtime, mtime))
+    return str(path)
+
+
+def test_rules_add_up(tmp_path):
+    rules = priorities.Priorities([
+        priorities.Rule(-20, glob='courses/*'),
+        priorities.Rule(-10, max_age=2, service='pdf'),
+        priorities.Rule(5, min_size=1000),
+        priorities.Rule(10, extension=['.GIF']),
+    ], str(tmp_path))
+
+    assert rules.rank('pdf', _touch(tmp_path / 'courses' / 'math' / 'a.pdf')) == (-30, 0)
+    assert rules.rank('pdf', _touch(tmp_path / 'old.pdf', age_days=5)) == (0, 0)
+    assert rules.rank('image', _touch(tmp_path / 'big.gif', size=2000)) == (15, 0)
+    assert rules.rank('pdf', str(tmp_path / 'courses' / 'gone.pdf')) == (-20, 0), \
+        'a missing file only matches rules without age or size'
+    assert rules.is_useful((-30, 0)) and not rules.is_useful((0, 0))
+
+    newest = priorities.Priorities([], str(tmp_path), newest_first=True)
+    assert newest.rank('pdf', _touch(tmp_path / 'new.pdf')) < \
+        newest.rank('pdf', str(tmp_path / 'old.pdf'))
+
+
+@pytest.mark.parametrize('config', ['{"rules": [{"priority": -1, "colour": "red"}]}',
+                                    '{"rules": [{"glob": "*.pdf"}]}',
+                                    '{"rules": {}}',
+                                    'not json'])
+def test_broken_rules_are_refused(tmp_path, config):
+    path = tmp_path / 'rules.json'
+    path.write_text(config)
+    with pytest.raises(priorities.RuleError):
+        priorities.load(str(path), str(tmp_path))
+
+
+def test_ranked_files_are_converted_first(tmp_path):
+    path = tmp_path / 'rules.json'
+    path.write_text(json.dumps({'newest_first': True,
+                                'rules': [{'glob': 'courses/*', 'priority': -10},
+                                          {'service': 'image', 'priority': 5}]}))
+    rules = priorities.load(str(path), str(tmp_path / 'tree'))
+
+    tree = tmp_path / 'tree'
+    items = [('pdf', _touch(tree / 'archive' / 'first.pdf', age_days=3)),
+             ('image', _touch(tree / 'archive' / 'a.png')),
+             ('pdf', _touch(tree / 'archive' / 'b.pdf', age_days=2)),
+             ('pdf', _touch(tree / 'archive' / 'c.pdf', age_days=1)),
+             ('pdf', _touch(tree / 'courses' / 'tomorrow.pdf', age_days=4))]
+
+    started, walked, order = threading.Event(), threading.Event(), []
+
+    def worker(path, _):
+        # the first file holds the converter until everything is queued
+        started.set()
+        assert walked.wait(5)
+        order.append(os.path.basename(path))
+        return True
+
+    def dispatched(number):
+        if number == 0:
+            assert started.wait(5)
+        elif number == len(items) - 1:
+            walked.set()
+
+    options = {service: preprocess.get_option_template(worker=worker, weight=1)
+               for service in ('pdf', 'image')}
+    runner = pipeline.Pipeline(ListIndex(items, dispatched), options, max_workers=1,
+                               priorities=rules)
+    runner.run(str(tree))
+
+    assert order == ['first.pdf', 'tomorrow.pdf', 'c.pdf', 'b.pdf', 'a.png']
+    assert runner.first_converted <= runner.first_useful
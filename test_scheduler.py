@@ -0,0 +1,130 @@
+'''
+Functional test of scheduler module.
+'''
+
+
+import threading
+
+import scheduler
+
+
+class Recorder:
+    ''' Job function keeping track of the budget used while it runs '''
+
+    def __init__(self, sched: scheduler.SlotScheduler, hold: float = 0.01):
+        self.sched = sched
+        self.hold = hold
+        self.order, self.used = [], []
+        self._lock = threading.Lock()
+
+    def __call__(self, name):
+        with self._lock:
+            self.order.append(name)
+            self.used.append(self.sched.used)
+        threading.Event().wait(self.hold)
+
+
+def _run(sched, jobs, hold=0.01):
+    recorder = Recorder(sched, hold)
+    for service, weight, name in jobs:
+        sched.submit(scheduler.Job(service, weight, recorder, name))
+    sched.start()
+    sched.close()
+    return recorder
+
+
+# pylint: disable=missing-function-docstring
+
+
+def test_budget_is_never_exceeded():
+    sched = scheduler.SlotScheduler(1000, threads=4, max_queued=100)
+    jobs = [('pdf', 800, f'pdf{i}') for i in range(3)] + \
+        [('img', 400, f'img{i}') for i in range(3)]
+
+    recorder = _run(sched, jobs)
+
+    assert sorted(recorder.order) == sorted(name for _, _, name in jobs)
+    assert max(recorder.used) <= 1000
+    assert sched.peak_used <= 1000
+    assert sched.used == 0 and sched.running == 0
+
+
+def test_smaller_jobs_fill_the_budget():
+    sched = scheduler.SlotScheduler(1000, threads=2, max_queued=100)
+    # the second pdf does not fit next to the first, the image does
+    jobs = [('pdf', 800, 'pdf0'), ('pdf', 800, 'pdf1'), ('img', 200, 'img0')]
+
+    recorder = _run(sched, jobs, hold=0.05)
+
+    assert recorder.order[:2] == ['pdf0', 'img0']
+    assert sched.peak_used == 1000
+
+
+def test_waiting_job_is_not_starved():
+    sched = scheduler.SlotScheduler(1000, threads=2, max_queued=100)
+    jobs = [('pdf', 600, 'pdf0'), ('pdf', 600, 'pdf1')] + \
+        [('img', 100, f'img{i}') for i in range(20)]
+
+    recorder = _run(sched, jobs)
+
+    assert recorder.order.index('pdf1') <= scheduler.MAX_BYPASS + 1
+
+
+def test_job_heavier_than_budget_runs_alone():
+    sched = scheduler.SlotScheduler(100, threads=2, max_queued=100)
+
+    recorder = _run(sched, [('pdf', 500, 'pdf0'), ('img', 50, 'img0')])
+
+    assert recorder.order == ['pdf0', 'img0']
+    assert recorder.used[0] == 500
+
+
+def test_job_and_service_limits():
+    running, peak = {'pdf': 0, 'img': 0, 'all': 0}, {'pdf': 0, 'all': 0}
+    lock = threading.Lock()
+
+    def job(service):
+        with lock:
+            running[service] += 1
+            running['all'] += 1
+            peak['pdf'] = max(peak['pdf'], running['pdf'])
+            peak['all'] = max(peak['all'], running['all'])
+        threading.Event().wait(0.01)
+        with lock:
+            running[service] -= 1
+            running['all'] -= 1
+
+    sched = scheduler.SlotScheduler(1000, max_jobs=3, max_queued=100, threads=6,
+                                    service_limits={'pdf': 1})
+    for service in ['pdf', 'img'] * 6:
+        sched.submit(scheduler.Job(service, 1, job, service))
+    sched.start()
+    sched.close()
+
+    assert peak == {'pdf': 1, 'all': 3}
+
+
+def test_longest_first_policy():
+    sched = scheduler.SlotScheduler(1, threads=1, max_queued=100,
+                                    key=scheduler.POLICIES['lpt'])
+    recorder = Recorder(sched, hold=0)
+    for name, cost in [('a', 1), ('b', 30), ('c', 5)]:
+        sched.submit(scheduler.Job('pdf', 1, recorder, name, cost=cost))
+    sched.start()
+    sched.close()
+
+    assert recorder.order == ['b', 'c', 'a']
+
+
+def test_ranks_go_before_the_policy():
+    sched = scheduler.SlotScheduler(1, threads=1, max_queued=100,
+                                    key=scheduler.POLICIES['lpt'])
+    recorder = Recorder(sched, hold=0)
+    # unranked jobs sit between the raised and the lowered ones, whatever their cost
+    for name, cost, rank in [('plain', 50, scheduler.NO_RANK), ('raised', 1, (-1, 0)),
+                             ('lowered', 90, (1, 0)), ('newer', 1, (-1, -2000.0))]:
+        sched.submit(scheduler.Job('pdf', 1, recorder, name, cost=cost, rank=rank))
+    sched.start()
+    sched.close()
+
+    assert recorder.order == ['newer', 'raised', 'plain', 'lowered']
@@ -0,0 +1,81 @@
+'''
+Functional test of tracing module.
+'''
+
+
+import json
+import zipfile
+
+import pytest
+import tracing
+import pipeline
+import preprocess
+
+
+@pytest.fixture
+def traced(tmp_path):
+    ''' Start tracing to a file, making sure it is stopped afterwards '''
+
+    def factory(fmt):
+        path = tmp_path / f'trace.{fmt}'
+        tracing.start(str(path), fmt)
+        return path
+
+    yield factory
+    tracing.stop()
+
+
+# pylint: disable=missing-function-docstring,redefined-outer-name
+
+
+def test_nothing_is_recorded_while_off():
+    assert not tracing.enabled()
+    assert tracing.span('foo', 'bar', path='baz') is tracing.NULL_SPAN
+    tracing.complete('foo', 'bar', 0.0)
+
+
+def test_stages_of_a_run_in_chrome_format(tmp_path, traced):
+    tree = tmp_path / 'tree'
+    tree.mkdir()
+    (tree / 'a.pdf').write_bytes(b'%PDF-1.4\n')
+    (tree / 'notes').write_bytes(b'\x00\x01 nothing to convert')
+    with zipfile.ZipFile(tree / 'b.zip', mode='w') as writer:
+        writer.writestr('c.pdf', b'%PDF-1.4\n')
+
+    options = {
+        'pdf': preprocess.get_option_template(worker=lambda *_: True,
+                                              mimes=('application/pdf',)),
+        'zip': preprocess.zip_options(),
+    }
+    index = preprocess.ScanIndex(options)
+    options['zip']['index'] = index
+
+    path = traced('chrome')
+    pipeline.Pipeline(index, options).run(str(tree))
+    tracing.stop()
+
+    events = json.loads(path.read_text())['traceEvents']
+    spans = [event for event in events if event['ph'] == 'X']
+    stages = {(event['cat'], event['name']) for event in spans}
+    assert {('scan', 'walk'), ('classify', 'sniff'), ('classify', 'file'),
+            ('wait', 'queued'), ('run', 'pdf'), ('run', 'zip'),
+            ('extract', 'member'), ('move', 'unlink')} <= stages
+
+    threads = {event['tid']: event['args']['name'] for event in events if event['ph'] == 'M'}
+    converted = [event for event in spans if event['name'] == 'pdf']
+    assert len(converted) == 2
+    assert all(threads[event['tid']].startswith('converter-') for event in converted)
+    assert all(event['dur'] >= 0 for event in spans)
+
+
+def test_json_lines_format(traced):
+    path = traced('jsonl')
+    with tracing.span('foo', 'bar', path='baz'):
+        pass
+    tracing.stop()
+
+    events = [json.loads(line) for line in path.read_text().splitlines()]
+    assert len(events) == 1
+    assert events[0]['name'] == 'foo'
+    assert events[0]['args'] == {'path': 'baz'}
+    assert events[0]['worker'] == 'MainThread'
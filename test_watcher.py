@@ -0,0 +1,88 @@
+'''
+Functional test of watcher module.
+'''
+
+
+import os
+import time
+import threading
+
+import pytest
+import watcher
+import pipeline
+import preprocess
+
+from test_pipeline import _options
+
+
+def _producer(tree, done_file):
+    ''' Write files the way a download does, some in several steps '''
+
+    time.sleep(0.2)
+    (tree / 'course' / 'week-2').mkdir(parents=True)
+    with open(tree / 'course' / 'week-2' / 'slow.pdf', 'w') as writer:
+        for chunk in ['first ', 'second ', 'last']:
+            writer.write(chunk)
+            writer.flush()
+            time.sleep(0.1)
+    (tree / 'course' / 'fast.pdf').write_text('fast')
+    (tree / 'course' / '.partial').write_text('hidden')
+    done_file.write_text('')
+
+
+# pylint: disable=missing-function-docstring
+
+
+@pytest.mark.parametrize('polling', [False, True])
+def test_files_are_taken_once_fully_written(tmp_path, polling):
+    tree, done_file = tmp_path / 'tree', tmp_path / 'done'
+    (tree / 'course').mkdir(parents=True)
+    (tree / 'course' / 'old.pdf').write_text('old')
+
+    taken = {}
+
+    def worker(path, _):
+        with open(path) as reader:
+            taken[os.path.relpath(path, tree)] = reader.read()
+        return True
+
+    tree_watcher = watcher.open_watcher(str(tree), polling=polling, done_file=str(done_file),
+                                        settle=0.3, interval=0.05)
+    assert isinstance(tree_watcher, watcher.PollingWatcher) is polling
+    index = preprocess.ScanIndex({'foo': _options(worker, predicate=preprocess.
+                                                   get_predicate_template(lambda _: True))},
+                                 watcher=tree_watcher)
+    producer = threading.Thread(target=_producer, args=(tree, done_file))
+    producer.start()
+    result = pipeline.Pipeline(index, index.service_options).run(str(tree))
+    producer.join()
+
+    assert result == {'foo': (4, [])}
+    assert taken == {'course/old.pdf': 'old',
+                     'course/fast.pdf': 'fast',
+                     'course/week-2/slow.pdf': 'first second last',
+                     'course/.partial': 'hidden'}
+
+
+def test_producer_process_ends_the_watch(tmp_path):
+    pid = os.fork()
+    if pid == 0:
+        time.sleep(0.2)
+        os._exit(0)
+
+    tree_watcher = watcher.open_watcher(str(tmp_path), pid=pid, interval=0.05)
+    assert watcher.process_alive(pid)
+    start = time.monotonic()
+    assert list(tree_watcher.files()) == []
+    # the child is a zombie until waited for, which already counts as gone
+    assert time.monotonic() - start < 5
+    os.waitpid(pid, 0)
+
+
+def test_idle_watch_ends_without_new_files(tmp_path):
+    tree_watcher = watcher.PollingWatcher(str(tmp_path), idle=0.2, interval=0.05)
+    tree_watcher.start()
+    (tmp_path / 'a').write_text('a')
+    tree_watcher.add(str(tmp_path / 'a'))
+
+    assert list(tree_watcher.files()) == [str(tmp_path / 'a')]
@@ -0,0 +1,162 @@
+'''
+Span events of every stage a file goes through, exported as JSON lines or in
+the Chrome trace event format (chrome://tracing, ui.perfetto.dev).
+'''
+
+
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+
+
+from typing import (
+    Dict,
+    List,
+)
+
+
+FORMATS = ('chrome', 'jsonl')
+
+
+class Tracer:
+    ''' Collect events in memory until written to path '''
+
+    def __init__(self, path: str, fmt: str = 'chrome'):
+        if fmt not in FORMATS:
+            raise ValueError(f'unknown trace format: {fmt}')
+
+        self.path = path
+        self.fmt = fmt
+        self.origin = time.perf_counter()
+        self.events: List[dict] = []
+        self._workers: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def worker(self) -> int:
+        ''' Return the id of the current task, or else of the current thread '''
+
+        name = None
+        try:
+            task = asyncio.current_task()
+            if task is not None:
+                name = task.get_name()
+        except RuntimeError:
+            pass
+        name = name or threading.current_thread().name
+
+        with self._lock:
+            if name not in self._workers:
+                self._workers[name] = len(self._workers) + 1
+            return self._workers[name]
+
+    def add(self, name: str, category: str, start: float, end: float, args: dict) -> None:
+        ''' Record a span between two perf_counter instants '''
+
+        self.events.append({
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': round((start - self.origin) * 1e6, 1),
+            'dur': round((end - start) * 1e6, 1),
+            'pid': os.getpid(),
+            'tid': self.worker(),
+            'args': args,
+        })
+
+    def write(self) -> None:
+        ''' Write every recorded event to path '''
+
+        workers = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+                    'args': {'name': name}}
+                   for name, tid in self._workers.items()]
+
+        with open(self.path, 'w') as writer:
+            if self.fmt == 'chrome':
+                json.dump({'traceEvents': workers + self.events,
+                           'displayTimeUnit': 'ms'}, writer)
+            else:
+                names = {tid: name for name, tid in self._workers.items()}
+                for event in self.events:
+                    writer.write(json.dumps({**event, 'worker': names[event['tid']]}))
+                    writer.write('\n')
+        logging.info('trace with %d events written to: %s', len(self.events), self.path)
+
+
+class Span:
+    ''' Context manager recording the time spent inside it '''
+
+    __slots__ = ('tracer', 'name', 'category', 'args', 'start')
+
+    def __init__(self, tracer: Tracer, name: str, category: str, args: dict):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = 0.0
+
+    def __enter__(self) -> 'Span':
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.tracer.add(self.name, self.category, self.start, time.perf_counter(), self.args)
+
+
+class NullSpan:
+    ''' Context manager doing nothing, used while tracing is off '''
+
+    __slots__ = ()
+
+    def __enter__(self) -> 'NullSpan':
+        return self
+
+    def __exit__(self, *_) -> None:
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+_tracer: Tracer = None
+
+
+def start(path: str, fmt: str = 'chrome') -> Tracer:
+    ''' Start recording events of this process '''
+
+    global _tracer  # pylint: disable=global-statement
+    _tracer = Tracer(path, fmt)
+    return _tracer
+
+
+def stop() -> None:
+    ''' Stop recording and write the recorded events, if any '''
+
+    global _tracer  # pylint: disable=global-statement
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.write()
+
+
+def enabled() -> bool:
+    ''' Tell whether events are being recorded '''
+
+    return _tracer is not None
+
+
+def span(name: str, category: str, **args):
+    ''' Return a context manager recording a span named name, which costs a
+        single check while tracing is off '''
+
+    if _tracer is None:
+        return NULL_SPAN
+    return Span(_tracer, name, category, args)
+
+
+def complete(name: str, category: str, start_time: float, **args) -> None:
+    ''' Record a span which started at start_time, a perf_counter instant,
+        and ends now '''
+
+    if _tracer is not None:
+        _tracer.add(name, category, start_time, time.perf_counter(), args)
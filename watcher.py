@@ -0,0 +1,307 @@
+'''
+Detection of files while another process is still writing the tree, through
+inotify or, where it is not available, by polling.
+'''
+
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+
+
+from typing import (
+    Dict,
+    Generator,
+    Tuple,
+    Union,
+)
+
+
+# from linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+# seconds between checks of candidates and of the producer
+INTERVAL = 0.5
+# seconds a file must keep its size to be taken as fully written
+SETTLE = 2.0
+
+
+def process_alive(pid: int) -> bool:
+    ''' Tell whether pid is running, a zombie waiting for its parent is not '''
+
+    try:
+        with open(f'/proc/{pid}/stat') as reader:
+            # the state comes right after the command name between parentheses
+            return reader.read().rpartition(')')[2].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+    except OSError:
+        pass
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Watcher:
+    ''' Yield files of a tree once they are fully written, until the producer
+        writing the tree is done.
+
+        A file is ready when it was closed after being written, or when its
+        size and modification time stayed the same for settle seconds. The
+        producer is done once the process pid is gone, or done_file exists,
+        or, when neither is given, after idle seconds without new files. A
+        last sweep of the tree then yields whatever was not ready before.
+        Hidden files are only picked up by that sweep, as temporary files
+        show up and vanish while the tree is processed. '''
+
+    def __init__(self,
+                 directory: str,
+                 pid: int = None,
+                 done_file: str = None,
+                 idle: float = 60.0,
+                 settle: float = SETTLE,
+                 interval: float = INTERVAL):
+        self.directory = directory
+        self.pid = pid
+        self.done_file = done_file
+        self.idle = idle
+        self.settle = settle
+        self.interval = interval
+        self._candidates: Dict[str, Tuple[tuple, float]] = {}
+        self._last_activity = time.monotonic()
+
+    def start(self) -> None:
+        ''' Start watching, before the tree is walked so no file is missed '''
+
+    def stop(self) -> None:
+        ''' Release what is used to watch the tree '''
+
+    def producer_done(self) -> bool:
+        ''' Tell whether nothing else will be written to the tree '''
+
+        if self.pid is not None and not process_alive(self.pid):
+            logging.info('producer %d is gone', self.pid)
+            return True
+
+        if self.done_file is not None and os.path.exists(self.done_file):
+            logging.info('producer signaled it is done: %s', self.done_file)
+            return True
+
+        if self.pid is None and self.done_file is None:
+            return time.monotonic() - self._last_activity > self.idle
+        return False
+
+    @staticmethod
+    def _signature(path: str) -> Union[tuple, None]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def add(self, path: str) -> None:
+        ''' Make path a candidate, ready once it stops changing '''
+
+        if os.path.basename(path).startswith('.'):
+            return
+        self._candidates[path] = (self._signature(path), time.monotonic())
+        self._last_activity = time.monotonic()
+
+    def _settled(self) -> Generator:
+        now = time.monotonic()
+        for path, (signature, since) in list(self._candidates.items()):
+            current = self._signature(path)
+            if current is None:
+                del self._candidates[path]
+            elif current != signature:
+                self._candidates[path] = (current, now)
+            elif now - since >= self.settle:
+                del self._candidates[path]
+                yield path
+
+    def _ready(self, path: str) -> Generator:
+        self._candidates.pop(path, None)
+        self._last_activity = time.monotonic()
+        yield path
+
+    def _wait(self) -> Generator:
+        ''' Wait up to interval for news on the tree, yielding ready files '''
+
+        time.sleep(self.interval)
+        yield from ()
+
+    def _sweep(self) -> Generator:
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                yield os.path.join(root, name)
+
+    def files(self) -> Generator:
+        ''' Yield files once they are ready, possibly more than once, until
+            the producer is done and the last sweep is over '''
+
+        try:
+            while not self.producer_done():
+                yield from self._wait()
+                yield from self._settled()
+
+            self._candidates.clear()
+            yield from self._sweep()
+        finally:
+            self.stop()
+
+
+class PollingWatcher(Watcher):
+    ''' Watcher walking the tree every interval to find new files '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._known = set()
+
+    def _wait(self) -> Generator:
+        time.sleep(self.interval)
+        for path in self._sweep():
+            if path not in self._known:
+                self._known.add(path)
+                self.add(path)
+        yield from ()
+
+    def add(self, path: str) -> None:
+        self._known.add(path)
+        super().add(path)
+
+
+class InotifyWatcher(Watcher):
+    ''' Watcher told by the kernel about every file written to the tree '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._libc = load_libc()
+        self._fd = -1
+        self._dirs: Dict[int, str] = {}
+
+    def _watch(self, directory: str) -> None:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise OSError(error, f'unable to watch {directory}: {os.strerror(error)}')
+        self._dirs[wd] = directory
+
+    def _watch_tree(self, directory: str) -> None:
+        for root, _, _ in os.walk(directory):
+            self._watch(root)
+
+    def start(self) -> None:
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f'unable to start inotify: {os.strerror(error)}')
+        self._watch_tree(self.directory)
+
+    def stop(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _events(self) -> Generator:
+        try:
+            data = os.read(self._fd, READ_SIZE)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0')
+            offset += EVENT.size + length
+            yield wd, mask, os.fsdecode(name)
+
+    def _wait(self) -> Generator:
+        poller = select.poll()
+        poller.register(self._fd, select.POLLIN)
+        if not poller.poll(self.interval * 1000):
+            return
+
+        for wd, mask, name in self._events():
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, every file is looked at again
+                logging.warning('inotify queue overflowed, rescanning: %s', self.directory)
+                for path in self._sweep():
+                    self.add(path)
+                continue
+
+            directory = self._dirs.get(wd)
+            if directory is None or not name:
+                continue
+
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # files may be written before the new directory is watched
+                    self._watch_tree(path)
+                    for root, _, names in os.walk(path):
+                        for child in names:
+                            self.add(os.path.join(root, child))
+            elif name.startswith('.'):
+                continue
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                yield from self._ready(path)
+            else:
+                self.add(path)
+
+
+_libc = None
+
+
+def load_libc() -> ctypes.CDLL:
+    ''' Load the C library holding the inotify calls '''
+
+    global _libc  # pylint: disable=global-statement
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        _libc = libc
+    return _libc
+
+
+def open_watcher(directory: str, polling: bool = False, **kwargs) -> Watcher:
+    ''' Return an inotify watcher on directory, or a polling one when inotify
+        is not available or polling is asked for '''
+
+    if not polling:
+        watcher = None
+        try:
+            watcher = InotifyWatcher(directory, **kwargs)
+            watcher.start()
+            return watcher
+        except (OSError, AttributeError) as error:
+            logging.warning('inotify unavailable, polling instead: %s', error)
+            if watcher is not None:
+                watcher.stop()
+
+    watcher = PollingWatcher(directory, **kwargs)
+    watcher.start()
+    return watcher